@@ -0,0 +1,245 @@
+import asyncio
+import itertools
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+logger = logging.getLogger("backplane")
+
+MessageHandler = Callable[[bytes], Awaitable[None]]
+ResetHandler = Callable[[], Awaitable[None]]
+
+# waits between attempts to reconnect a lost Redis connection; the last one repeats
+RECONNECT_DELAYS = (0.1, 0.5, 1.0, 2.0, 5.0)
+
+
+class Backplane(ABC):
+    """Pub/sub transport between worker processes. Handlers for one channel run in publish order.
+
+    ``on_reset`` is awaited when a backend loses messages in flight, e.g. on a dropped connection, so users of
+    the transport can give up on whatever was waiting on them.
+    """
+
+    on_reset: ResetHandler | None = None
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def publish(self, channel: str, data: bytes) -> None: ...
+
+    @abstractmethod
+    async def subscribe(self, channel: str, handler: MessageHandler) -> None: ...
+
+    @abstractmethod
+    async def unsubscribe(self, channel: str) -> None: ...
+
+
+class InProcessBackplane(Backplane):
+    """Delivers straight to subscribers in this process; the single-worker default and a test double."""
+
+    def __init__(self):
+        self._handlers: dict[str, MessageHandler] = {}
+
+    async def publish(self, channel: str, data: bytes) -> None:
+        handler = self._handlers.get(channel)
+        if handler is not None:
+            await handler(data)
+
+    async def subscribe(self, channel: str, handler: MessageHandler) -> None:
+        self._handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str) -> None:
+        self._handlers.pop(channel, None)
+
+
+class RedisError(Exception):
+    pass
+
+
+def encode_command(*parts: str | bytes) -> bytes:
+    out = [b"*%d\r\n" % len(parts)]
+    for part in parts:
+        raw = part.encode() if isinstance(part, str) else part
+        out.append(b"$%d\r\n%s\r\n" % (len(raw), raw))
+    return b"".join(out)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body
+    if kind == b"-":
+        raise RedisError(body.decode(errors="replace"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RedisError(f"Unexpected reply type: {line!r}")
+
+
+class RedisBackplane(Backplane):
+    """Redis pub/sub spoken directly over RESP, one connection for PUBLISH and one for SUBSCRIBE.
+
+    Publishes are pipelined: commands are written without waiting and replies are matched in order by a
+    reader task, so many writers share the connection without serializing on round trips.
+    """
+
+    def __init__(self, url: str, reconnect_delays: tuple[float, ...] = RECONNECT_DELAYS):
+        parsed = urlparse(url)
+        self._host = parsed.hostname or "localhost"
+        self._port = parsed.port or 6379
+        self._password = parsed.password
+        self._reconnect_delays = reconnect_delays
+        self._handlers: dict[str, MessageHandler] = {}
+        self._replies: deque[asyncio.Future] = deque()
+        self._pub_writer: asyncio.StreamWriter | None = None
+        self._sub_writer: asyncio.StreamWriter | None = None
+        self._readers: list[asyncio.Task] = []
+        self._supervisor: asyncio.Task | None = None
+
+    async def _connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        if self._password:
+            try:
+                writer.write(encode_command("AUTH", self._password))
+                await writer.drain()
+                await read_reply(reader)
+            except BaseException:
+                writer.close()
+                raise
+        return reader, writer
+
+    async def start(self) -> None:
+        await self._open()
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _open(self) -> None:
+        pub_reader, pub_writer = await self._connect()
+        try:
+            sub_reader, sub_writer = await self._connect()
+        except Exception:
+            pub_writer.close()
+            raise
+        # a reconnect picks up every channel subscribed so far
+        for channel in self._handlers:
+            sub_writer.write(encode_command("SUBSCRIBE", channel))
+        await sub_writer.drain()
+        self._pub_writer, self._sub_writer = pub_writer, sub_writer
+        self._readers = [
+            asyncio.create_task(self._read_replies(pub_reader)),
+            asyncio.create_task(self._read_messages(sub_reader)),
+        ]
+
+    async def _supervise(self) -> None:
+        while True:
+            done, _ = await asyncio.wait(self._readers, return_when=asyncio.FIRST_COMPLETED)
+            error = next((task.exception() for task in done if task.exception() is not None), None)
+            logger.warning(f"Backplane connection lost: {error!r}")
+            await self._drop(ConnectionError("Backplane connection lost"))
+            if self.on_reset is not None:
+                try:
+                    await self.on_reset()
+                except Exception:
+                    logger.exception("Backplane reset handler failed")
+            for attempt in itertools.count():
+                await asyncio.sleep(self._reconnect_delays[min(attempt, len(self._reconnect_delays) - 1)])
+                try:
+                    await self._open()
+                    break
+                except Exception as e:
+                    # refused connections and garbled or refused handshakes alike; keep trying
+                    logger.warning(f"Backplane reconnect failed: {e!r}")
+            logger.info("Backplane reconnected")
+
+    async def _drop(self, error: Exception) -> None:
+        for task in self._readers:
+            task.cancel()
+        await asyncio.gather(*self._readers, return_exceptions=True)
+        self._readers = []
+        for writer in (self._pub_writer, self._sub_writer):
+            if writer is not None:
+                writer.close()
+        self._pub_writer = self._sub_writer = None
+        # their replies were lost with the connection
+        while self._replies:
+            reply = self._replies.popleft()
+            if not reply.done():
+                reply.set_exception(error)
+
+    async def close(self) -> None:
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+            self._supervisor = None
+        await self._drop(ConnectionError("Backplane closed"))
+
+    async def publish(self, channel: str, data: bytes) -> None:
+        if self._pub_writer is None:
+            raise ConnectionError("Backplane is not connected")
+        reply = asyncio.get_running_loop().create_future()
+        self._replies.append(reply)
+        self._pub_writer.write(encode_command("PUBLISH", channel, data))
+        await self._pub_writer.drain()
+        await reply
+
+    async def subscribe(self, channel: str, handler: MessageHandler) -> None:
+        self._handlers[channel] = handler
+        if self._sub_writer is not None:
+            self._sub_writer.write(encode_command("SUBSCRIBE", channel))
+            await self._sub_writer.drain()
+
+    async def unsubscribe(self, channel: str) -> None:
+        self._handlers.pop(channel, None)
+        if self._sub_writer is not None:
+            self._sub_writer.write(encode_command("UNSUBSCRIBE", channel))
+            await self._sub_writer.drain()
+
+    async def _read_replies(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            try:
+                reply = await read_reply(reader)
+            except RedisError as e:
+                if self._replies:
+                    self._replies.popleft().set_exception(e)
+                continue
+            if self._replies:
+                future = self._replies.popleft()
+                if not future.done():
+                    future.set_result(reply)
+
+    async def _read_messages(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            reply = await read_reply(reader)
+            # subscribe/unsubscribe confirmations share the stream with ["message", channel, data] pushes
+            if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                handler = self._handlers.get(reply[1].decode())
+                if handler is None:
+                    continue
+                try:
+                    await handler(reply[2])
+                except Exception:
+                    logger.exception("Backplane handler failed")
+
+
+def create_backplane(url: str | None) -> Backplane:
+    if not url:
+        return InProcessBackplane()
+    if url.startswith("redis://"):
+        return RedisBackplane(url)
+    raise ValueError(f"Unsupported backplane URL: {url}")
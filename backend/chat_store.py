@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from encoding import Frame, dumps, loads
+from message_types import MessageType, chat_history_message
+from metrics import registry
+
+logger = logging.getLogger("chat_store")
+
+# messages kept in memory per room; older ones are only reachable through CHAT_DB_PATH
+CHAT_HISTORY_SIZE = int(os.getenv("CHAT_HISTORY_SIZE", "200"))
+# messages per chat-history page, sent on join and on each request for older ones
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "50"))
+# SQLite file chat is written behind to, so history outlives its room and the process; unset keeps it in memory
+CHAT_DB_PATH = os.getenv("CHAT_DB_PATH")
+CHAT_FLUSH_INTERVAL = float(os.getenv("CHAT_FLUSH_INTERVAL_MS", "500")) / 1000
+
+chat_writes = registry.counter("chat_log_writes_total", "Chat messages written behind to the chat log, by outcome")
+chat_log_pending = registry.gauge("chat_log_pending", "Chat messages waiting to be written to the chat log")
+
+_last_id = 0
+
+
+def next_chat_id() -> int:
+    """Ids increase across rooms and, being microsecond timestamps at heart, across restarts too."""
+    global _last_id
+    _last_id = max(_last_id + 1, time.time_ns() // 1000)
+    return _last_id
+
+
+@dataclass(frozen=True, slots=True)
+class ChatEntry:
+    """A chat message with its JSON encoding, made once and reused by the broadcast and every history page."""
+
+    id: int
+    message: dict
+    text: str
+
+    @classmethod
+    def encode(cls, message: dict) -> "ChatEntry":
+        message["id"] = next_chat_id()
+        return cls(message["id"], message, dumps(message))
+
+    @property
+    def frame(self) -> Frame:
+        return Frame(type=MessageType.CHAT, text=self.text)
+
+
+def chat_history_frame(entries: list[ChatEntry], before: int | None, has_more: bool) -> Frame:
+    """A chat-history page spliced together from pre-encoded entries; ``before`` echoes the request."""
+    # the envelope ends in "messages":[]}; the entries' own text goes between the brackets
+    envelope = dumps(chat_history_message([], before, has_more))
+    messages = ",".join(entry.text for entry in entries)
+    return Frame(type=MessageType.CHAT_HISTORY, text=f"{envelope[:-2]}{messages}]}}")
+
+
+class ChatRing:
+    """A room's most recent chat entries, oldest first; appending past capacity drops the oldest."""
+
+    def __init__(self, capacity: int = CHAT_HISTORY_SIZE):
+        self._entries: deque[ChatEntry] = deque(maxlen=capacity)
+        # set once nothing older than the oldest entry exists anywhere, so pages never need the chat log
+        self.complete = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    @property
+    def oldest(self) -> int | None:
+        return self._entries[0].id if self._entries else None
+
+    def append(self, entry: ChatEntry) -> None:
+        if len(self._entries) == self._entries.maxlen:
+            self.complete = False
+        self._entries.append(entry)
+
+    def backfill(self, older: list[ChatEntry], has_more: bool) -> None:
+        """Put entries read back from the chat log in front of the ring, as many as there is room for."""
+        space = self._entries.maxlen - len(self._entries)
+        for entry in reversed(older[-space:] if space else []):
+            self._entries.appendleft(entry)
+        self.complete = not has_more and len(older) <= space
+
+    def page(self, before: int | None, limit: int) -> tuple[list[ChatEntry], bool]:
+        """Up to ``limit`` entries older than ``before`` (newest if None), oldest first.
+
+        The flag is True when the page stops short of the ring's oldest entry, i.e. the ring has more.
+        """
+        page: list[ChatEntry] = []
+        for index in range(len(self._entries) - 1, -1, -1):
+            entry = self._entries[index]
+            if before is not None and entry.id >= before:
+                continue
+            if len(page) == limit:
+                return page[::-1], True
+            page.append(entry)
+        return page[::-1], False
+
+
+class ChatLog:
+    """Write-behind SQLite store for chat, one append-only table across rooms.
+
+    ``append`` only queues; a background task writes what has queued up every ``flush_interval``, so posting
+    a message never waits on the disk. All database work runs on one thread that owns the connection.
+    """
+
+    def __init__(self, path: str, flush_interval: float = CHAT_FLUSH_INTERVAL):
+        self._path = path
+        self._flush_interval = flush_interval
+        self._pending: list[tuple[str, int, str]] = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-log")
+        self._db: sqlite3.Connection | None = None
+        self._task: asyncio.Task | None = None
+
+    def append(self, room_id: str, entry: ChatEntry) -> None:
+        self._pending.append((room_id, entry.id, entry.text))
+        chat_log_pending.set(len(self._pending))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def load(self, room_id: str, before: int | None, limit: int) -> list[ChatEntry]:
+        """Up to ``limit`` stored entries older than ``before`` (newest if None), oldest first."""
+        # whatever is still queued goes in first, in case it belongs to this page
+        pending = self._take()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._load, pending, room_id, before, limit)
+
+    async def flush(self) -> None:
+        pending = self._take()
+        if pending:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, pending)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=True)
+
+    def _take(self) -> list[tuple[str, int, str]]:
+        pending, self._pending = self._pending, []
+        chat_log_pending.set(0)
+        return pending
+
+    async def _run(self) -> None:
+        try:
+            # like the cursor ticker, the writer stops once a round finds nothing queued
+            while self._pending:
+                await asyncio.sleep(self._flush_interval)
+                await self.flush()
+        finally:
+            self._task = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat (room TEXT NOT NULL, id INTEGER NOT NULL, body TEXT NOT NULL, "
+                "PRIMARY KEY (room, id)) WITHOUT ROWID"
+            )
+        return self._db
+
+    def _write(self, pending: list[tuple[str, int, str]]) -> None:
+        try:
+            db = self._connect()
+            with db:
+                db.executemany("INSERT OR IGNORE INTO chat (room, id, body) VALUES (?, ?, ?)", pending)
+        except sqlite3.Error:
+            chat_writes.inc(len(pending), outcome="failed")
+            logger.exception(f"Lost {len(pending)} chat messages writing to {self._path}")
+        else:
+            chat_writes.inc(len(pending), outcome="written")
+
+    def _load(
+        self, pending: list[tuple[str, int, str]], room_id: str, before: int | None, limit: int
+    ) -> list[ChatEntry]:
+        if pending:
+            self._write(pending)
+        rows = self._connect().execute(
+            "SELECT id, body FROM chat WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (room_id, before if before is not None else 2**63 - 1, limit),
+        )
+        return [ChatEntry(id, loads(body), body) for id, body in reversed(rows.fetchall())]
+
+    def _close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
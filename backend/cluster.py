@@ -0,0 +1,226 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import uuid
+from bisect import bisect
+from typing import Awaitable, Callable
+
+from backplane import Backplane, InProcessBackplane, create_backplane
+from encoding import Frame, dumps, loads
+from fastapi import WebSocket, WebSocketDisconnect
+from send_queue import SendQueue
+
+logger = logging.getLogger("cluster")
+
+WORKER_ID = os.getenv("WORKER_ID", "local")
+CLUSTER_WORKERS = [w.strip() for w in os.getenv("CLUSTER_WORKERS", "").split(",") if w.strip()] or [WORKER_ID]
+BACKPLANE_URL = os.getenv("BACKPLANE_URL")
+RING_REPLICAS = 64
+# close code for sockets whose envelopes the backplane may have lost; not a clean close, so sessions are kept
+BACKPLANE_RESET_CODE = 1011
+
+Receive = Callable[[], Awaitable[dict | None]]
+SessionRunner = Callable[[WebSocket, str, str, bool, Receive], Awaitable[None]]
+
+
+class HashRing:
+    """Consistent hashing of room ids onto workers; adding a worker only moves about 1/N of the rooms."""
+
+    def __init__(self, nodes: list[str], replicas: int = RING_REPLICAS):
+        points = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def node_for(self, key: str) -> str:
+        return self._nodes[bisect(self._keys, self._hash(key)) % len(self._nodes)]
+
+
+class RemoteWebSocket:
+    """Stand-in for a client socket held by another worker. What the room owner sends is forwarded there."""
+
+    def __init__(self, cluster: "Cluster", worker_id: str, conn_id: str):
+        self._cluster = cluster
+        self._worker_id = worker_id
+        self._conn_id = conn_id
+
+    async def send_text(self, text: str) -> None:
+        await self._cluster.send_envelope(self._worker_id, {"op": "send", "conn": self._conn_id, "text": text})
+
+    async def send_bytes(self, data: bytes) -> None:
+        envelope = {"op": "send", "conn": self._conn_id, "bytes": base64.b64encode(data).decode()}
+        await self._cluster.send_envelope(self._worker_id, envelope)
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        envelope = {"op": "close", "conn": self._conn_id, "code": code, "reason": reason}
+        await self._cluster.send_envelope(self._worker_id, envelope)
+
+
+class Cluster:
+    """Routes each room to one owner worker that holds all of its state, SFU peer connections included.
+
+    A socket that lands on any other worker is proxied: its messages are forwarded to the owner over the
+    backplane, and the owner serves it through a RemoteWebSocket exactly like a local connection, so
+    broadcasts, send_to_user and sharer state all stay consistent within the owner's ConnectionManager.
+
+    Envelopes on a worker's channel, proxy -> owner: open, message, disconnect; owner -> proxy: send, close.
+    """
+
+    def __init__(self, worker_id: str, workers: list[str], backplane: Backplane):
+        if worker_id not in workers:
+            raise ValueError(f"Worker {worker_id!r} is not in the cluster {workers}")
+        self.worker_id = worker_id
+        self._ring = HashRing(workers)
+        self._backplane = backplane
+        self._runner: SessionRunner | None = None
+        # owner side: inbound message queues of proxied sessions we serve
+        self._remote: dict[str, asyncio.Queue] = {}
+        self._remote_tasks: set[asyncio.Task] = set()
+        # proxy side: client sockets we hold for rooms owned elsewhere
+        self._proxied: dict[str, tuple[WebSocket, SendQueue]] = {}
+        self._close_tasks: set[asyncio.Task] = set()
+        backplane.on_reset = self._on_backplane_reset
+
+    @staticmethod
+    def channel(worker_id: str) -> str:
+        return f"purestream:worker:{worker_id}"
+
+    async def start(self, runner: SessionRunner) -> None:
+        self._runner = runner
+        await self._backplane.start()
+        await self._backplane.subscribe(self.channel(self.worker_id), self._on_envelope)
+
+    async def close(self) -> None:
+        for task in list(self._remote_tasks):
+            task.cancel()
+        await asyncio.gather(*self._remote_tasks, return_exceptions=True)
+        await self._backplane.unsubscribe(self.channel(self.worker_id))
+        await self._backplane.close()
+
+    def owner(self, room_id: str) -> str:
+        return self._ring.node_for(room_id)
+
+    def owns(self, room_id: str) -> bool:
+        return self.owner(room_id) == self.worker_id
+
+    async def send_envelope(self, worker_id: str, envelope: dict) -> None:
+        await self._backplane.publish(self.channel(worker_id), dumps(envelope).encode())
+
+    async def proxy(self, websocket: WebSocket, room_id: str, user_id: str, binary: bool, receive: Receive) -> None:
+        owner = self.owner(room_id)
+        conn_id = uuid.uuid4().hex
+        # the owner already applied per-type overflow policies; here every frame is simply delivered in order
+        outbox = SendQueue(websocket, policies={}, binary=binary)
+        self._proxied[conn_id] = (websocket, outbox)
+        outbox.start()
+        open_envelope = {
+            "op": "open",
+            "conn": conn_id,
+            "origin": self.worker_id,
+            "room": room_id,
+            "user": user_id,
+            "binary": binary,
+        }
+        code = 1000
+        try:
+            await self.send_envelope(owner, open_envelope)
+            while True:
+                message = await receive()
+                await self.send_envelope(owner, {"op": "message", "conn": conn_id, "message": message})
+        except WebSocketDisconnect as e:
+            code = e.code
+        except ConnectionError as e:
+            # the backplane is down; the client reconnects, and resumes once it is back
+            logger.warning(f"Backplane unavailable, closing proxied {conn_id}: {e!r}")
+            code = BACKPLANE_RESET_CODE
+            await self._close_proxied(websocket, code, "backplane unavailable")
+        finally:
+            self._proxied.pop(conn_id, None)
+            await outbox.close()
+            # the owner keeps a session that dropped uncleanly around for the client to resume
+            try:
+                await self.send_envelope(owner, {"op": "disconnect", "conn": conn_id, "code": code})
+            except ConnectionError as e:
+                logger.info(f"Could not tell {owner} that {conn_id} disconnected: {e!r}")
+
+    async def _on_envelope(self, data: bytes) -> None:
+        # runs inline on the backplane reader, so nothing here may wait on a client socket
+        envelope = loads(data)
+        op = envelope.get("op")
+        conn_id = envelope.get("conn")
+
+        if op == "open":
+            queue = self._remote[conn_id] = asyncio.Queue()
+            task = asyncio.create_task(self._serve_remote(envelope, queue))
+            self._remote_tasks.add(task)
+            task.add_done_callback(self._remote_tasks.discard)
+        elif op == "message":
+            queue = self._remote.get(conn_id)
+            if queue is not None:
+                queue.put_nowait(envelope["message"])
+        elif op == "disconnect":
+            queue = self._remote.get(conn_id)
+            if queue is not None:
+                queue.put_nowait(envelope.get("code", 1000))
+        elif op == "send":
+            proxied = self._proxied.get(conn_id)
+            if proxied is not None:
+                if "bytes" in envelope:
+                    proxied[1].put(Frame(type=None, text="", binary=base64.b64decode(envelope["bytes"])))
+                else:
+                    proxied[1].put(Frame(type=None, text=envelope["text"]))
+        elif op == "close":
+            proxied = self._proxied.get(conn_id)
+            if proxied is not None:
+                self._spawn_close(proxied[0], envelope.get("code", 1000), envelope.get("reason"))
+        else:
+            logger.warning(f"Unknown backplane envelope: {op!r}")
+
+    async def _on_backplane_reset(self) -> None:
+        # envelopes may have been lost either way, so every session crossing the backplane is ended uncleanly;
+        # the owner parks it and the client reconnects and resumes it
+        for queue in self._remote.values():
+            queue.put_nowait(BACKPLANE_RESET_CODE)
+        for websocket, _ in self._proxied.values():
+            self._spawn_close(websocket, BACKPLANE_RESET_CODE, "backplane reset")
+
+    async def _serve_remote(self, envelope: dict, queue: asyncio.Queue) -> None:
+        conn_id = envelope["conn"]
+
+        async def receive() -> dict:
+            message = await queue.get()
+            if isinstance(message, int):
+                raise WebSocketDisconnect(message)
+            return message
+
+        websocket = RemoteWebSocket(self, envelope["origin"], conn_id)
+        try:
+            await self._runner(websocket, envelope["room"], envelope["user"], envelope["binary"], receive)
+        finally:
+            self._remote.pop(conn_id, None)
+
+    def _spawn_close(self, websocket: WebSocket, code: int, reason: str | None) -> None:
+        task = asyncio.create_task(self._close_proxied(websocket, code, reason))
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+
+    async def _close_proxied(self, websocket: WebSocket, code: int, reason: str | None) -> None:
+        try:
+            await websocket.close(code=code, reason=reason)
+        except Exception as e:
+            logger.debug(f"Closing proxied socket failed: {e!r}")
+
+
+def create_cluster() -> Cluster:
+    if len(CLUSTER_WORKERS) > 1 and not BACKPLANE_URL:
+        raise ValueError("CLUSTER_WORKERS lists several workers but no BACKPLANE_URL is set")
+    backplane = create_backplane(BACKPLANE_URL) if BACKPLANE_URL else InProcessBackplane()
+    return Cluster(WORKER_ID, CLUSTER_WORKERS, backplane)
+
+
+cluster = create_cluster()
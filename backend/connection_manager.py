@@ -1,67 +1,233 @@
 import asyncio
-import json
+import heapq
+import itertools
+import logging
+import os
+import secrets
 import time
 from dataclasses import dataclass, field
 
+from chat_store import CHAT_DB_PATH, CHAT_HISTORY_SIZE, CHAT_PAGE_SIZE, ChatEntry, ChatLog, ChatRing, chat_history_frame
+from encoding import Frame, encode_frame
 from fastapi import WebSocket
+from message_types import (
+    session_message,
+    sharer_changed_message,
+    user_joined_message,
+    user_left_message,
+    user_list_message,
+    user_updated_message,
+    whiteboard_snapshot_message,
+)
+from metrics import TimedLock, registry
+from send_queue import REPLAY_BUFFER_SIZE, SEND_QUEUE_SIZE, SLOW_CONSUMER_TIMEOUT, OverflowPolicy, SendQueue
 
 HEARTBEAT_INTERVAL = 10
 HEARTBEAT_TIMEOUT = 30
+STALE_CLOSE_CODE = 1001
+# how long a dropped connection keeps its place in the room, waiting for the client to resume it
+RESUME_GRACE = int(os.getenv("RESUME_GRACE_MS", "15000")) / 1000
+
+logger = logging.getLogger("connection_manager")
+
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+lock_wait_seconds = registry.histogram("lock_wait_seconds", "Time spent waiting to acquire a lock, by lock")
+broadcast_fanout = registry.histogram("broadcast_fanout", "Recipients per room broadcast", FANOUT_BUCKETS)
+rooms_gauge = registry.gauge("rooms", "Rooms with at least one connection")
+connections_gauge = registry.gauge("connections", "Client connections across all rooms")
+send_queue_frames = registry.gauge("send_queue_frames", "Frames waiting in outbound queues: total and deepest queue")
+send_queue_dropped = registry.gauge("send_queue_dropped_frames", "Frames evicted from open connections' queues")
+resumes = registry.counter("session_resumes_total", "Attempts to resume a dropped connection, by outcome")
 
 
 @dataclass
 class User:
     ws: WebSocket
+    outbox: SendQueue
     username: str
     last_heartbeat: float = field(default_factory=time.time)
     muted: bool = False
     deafened: bool = False
     in_call: bool = False
+    # presented by the client to resume this connection over a new socket
+    token: str = field(default_factory=lambda: secrets.token_urlsafe(16))
+    # monotonic time the socket dropped, while the connection waits to be resumed
+    parked_at: float | None = None
 
 
 @dataclass
 class Room:
     users: dict[str, User] = field(default_factory=dict)
     sharer_id: str | None = None
-    chat: list[dict] = field(default_factory=list)
+    chat: ChatRing = field(default_factory=ChatRing)
+    # live canvas keyed by object id, in drawing order; ops are applied, not logged
+    whiteboard: dict[str, dict] = field(default_factory=dict)
+    whiteboard_owner: str | None = None
+    whiteboard_anon_ids: int = 0
+    # guards this room's state only; never held across socket I/O
+    lock: asyncio.Lock = field(default_factory=lambda: TimedLock(lock_wait_seconds, lock="room"))
+    # bumped once per roster delta (or snapshot replacing a batch of them) sent to the room
+    roster_seq: int = 0
+    # encoded once per state change, reset to None whenever the state they describe changes
+    user_list_frame: Frame | None = None
+    sharer_frame: Frame | None = None
+    whiteboard_frame: Frame | None = None
+
+    def invalidate_user_list(self) -> None:
+        self.user_list_frame = None
+
+    def invalidate_sharer(self) -> None:
+        self.sharer_frame = None
+
+    def invalidate_whiteboard(self) -> None:
+        self.whiteboard_frame = None
 
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(
+        self,
+        send_queue_size: int = SEND_QUEUE_SIZE,
+        slow_consumer_timeout: float = SLOW_CONSUMER_TIMEOUT,
+        overflow_policies: dict[str, OverflowPolicy] | None = None,
+        chat_log: ChatLog | None = None,
+        chat_history_size: int = CHAT_HISTORY_SIZE,
+        replay_size: int = REPLAY_BUFFER_SIZE,
+        resume_grace: float = RESUME_GRACE,
+    ):
         self._rooms: dict[str, Room] = {}
-        self._lock = asyncio.Lock()
-
-    async def join_room(self, room_id: str, user_id: str, ws: WebSocket, username: str) -> None:
+        # registry lock: only taken to create or remove rooms, always before a room lock
+        self._lock = TimedLock(lock_wait_seconds, lock="registry")
+        # min-heap of (deadline, tiebreak, room_id, user_id, user); entries are rechecked lazily when due,
+        # so heartbeats never touch it and cleanup only visits connections whose deadline has passed
+        self._expiry: list[tuple[float, int, str, str, User]] = []
+        self._expiry_ids = itertools.count()
+        self._send_queue_size = send_queue_size
+        self._slow_consumer_timeout = slow_consumer_timeout
+        self._overflow_policies = overflow_policies
+        # with a chat log, history older than the rooms' rings, or from rooms that emptied, is read back from it
+        self._chat_log = chat_log
+        self._chat_history_size = chat_history_size
+        self._replay_size = replay_size
+        self._resume_grace = resume_grace
+
+    async def close(self) -> None:
+        if self._chat_log is not None:
+            await self._chat_log.close()
+
+    async def join_room(self, room_id: str, user_id: str, ws: WebSocket, username: str, binary: bool = False) -> User:
+        outbox = SendQueue(
+            ws,
+            max_size=self._send_queue_size,
+            slow_consumer_timeout=self._slow_consumer_timeout,
+            policies=self._overflow_policies,
+            binary=binary,
+            replay_size=self._replay_size,
+        )
         async with self._lock:
-            if room_id not in self._rooms:
-                self._rooms[room_id] = Room()
-            self._rooms[room_id].users[user_id] = User(ws=ws, username=username)
-
-    async def leave_room(self, room_id: str, user_id: str) -> bool:
+            room = self._rooms.get(room_id)
+            if room is None:
+                room = self._rooms[room_id] = Room(chat=ChatRing(self._chat_history_size))
+            async with room.lock:
+                replaced = room.users.get(user_id)
+                user = room.users[user_id] = User(ws=ws, outbox=outbox, username=username)
+                room.invalidate_user_list()
+                if room.sharer_id == user_id:
+                    room.invalidate_sharer()
+        self._schedule_expiry(room_id, user_id, user)
+        outbox.start()
+        if replaced is not None:
+            await replaced.outbox.close()
+        return user
+
+    async def leave_room(self, room_id: str, user_id: str, user: User | None = None) -> bool | None:
+        """Remove a user from a room, only if it is still ``user`` when given.
+
+        Returns whether they were sharing, or None if there was nobody to remove.
+        """
         async with self._lock:
-            if room_id not in self._rooms:
-                return False
-            room = self._rooms[room_id]
-            if user_id not in room.users:
-                return False
-
-            del room.users[user_id]
-
-            was_sharer = room.sharer_id == user_id
-            if was_sharer:
-                room.sharer_id = None
-
-            if not room.users:
-                del self._rooms[room_id]
+            room = self._rooms.get(room_id)
+            if room is None:
+                return None
+            async with room.lock:
+                current = room.users.get(user_id)
+                if current is None or (user is not None and current is not user):
+                    return None
+                was_sharer = self._remove_user(room_id, room, user_id)
+
+        await current.outbox.close()
+        return was_sharer
+
+    async def park(self, room_id: str, user_id: str, user: User, ws: WebSocket) -> float | None:
+        """Keep ``user`` in the room after ``ws`` dropped, so the client can resume; returns when it was parked.
+
+        Returns None when there is nothing to keep: the user already left, or another socket has taken over.
+        """
+        room = self._rooms.get(room_id)
+        if room is None or self._resume_grace <= 0:
+            return None
+        async with room.lock:
+            if room.users.get(user_id) is not user or user.ws is not ws or user.outbox.closed:
+                return None
+            user.parked_at = time.monotonic()
+            return user.parked_at
+
+    async def resume(
+        self, room_id: str, user_id: str, token: str, ws: WebSocket, received: int, binary: bool = False
+    ) -> User | None:
+        """Move a parked or still-connected user onto ``ws``, replaying the frames after the client's ``received``.
+
+        Returns None if the session cannot be resumed (unknown, expired, wrong token, or too far behind to
+        replay), in which case the client joins afresh.
+        """
+        room = self._rooms.get(room_id)
+        user = room.users.get(user_id) if room is not None else None
+        if user is None or not secrets.compare_digest(user.token, token):
+            resumes.inc(outcome="unknown")
+            return None
+        if user.parked_at is not None and time.monotonic() - user.parked_at >= self._resume_grace:
+            resumes.inc(outcome="expired")
+            return None
+        if not await user.outbox.reattach(ws, binary, received, encode_frame(session_message(token, True))):
+            resumes.inc(outcome="behind")
+            return None
+        old_ws = user.ws
+        user.ws = ws
+        user.parked_at = None
+        user.last_heartbeat = time.time()
+        resumes.inc(outcome="resumed")
+        if old_ws is not ws:
+            # the old socket may not have noticed it is dead yet; its session sees it was taken over and stops
+            try:
+                await old_ws.close()
+            except Exception as e:
+                logger.debug(f"Closing superseded socket failed: {e!r}")
+        return user
+
+    def _remove_user(self, room_id: str, room: Room, user_id: str) -> bool:
+        """Drop a user from a room; caller holds the registry and room locks. Returns whether they were sharing."""
+        del room.users[user_id]
+        room.invalidate_user_list()
+
+        was_sharer = room.sharer_id == user_id
+        if was_sharer:
+            room.sharer_id = None
+            room.invalidate_sharer()
+        if room.whiteboard_owner == user_id:
+            # the owner leaving ends the whiteboard, as stopping it does; nobody else may edit or clear the board
+            room.whiteboard_owner = None
+            room.whiteboard.clear()
+            room.invalidate_whiteboard()
 
-            return was_sharer
+        if not room.users:
+            del self._rooms[room_id]
+        return was_sharer
 
     async def set_sharer(self, room_id: str, user_id: str | None) -> tuple[str | None, str | None]:
-        async with self._lock:
-            if room_id not in self._rooms:
-                return None, None
-            room = self._rooms[room_id]
-
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None, None
+        async with room.lock:
             if user_id is not None:
                 if room.sharer_id is not None and room.sharer_id != user_id:
                     current = room.sharer_id
@@ -69,132 +235,340 @@ class ConnectionManager:
                         return current, room.users[current].username
                     return None, None
 
-                room.sharer_id = user_id
+                if room.sharer_id != user_id:
+                    room.sharer_id = user_id
+                    room.invalidate_sharer()
                 if user_id in room.users:
                     return user_id, room.users[user_id].username
                 return None, None
 
-            room.sharer_id = None
+            if room.sharer_id is not None:
+                room.sharer_id = None
+                room.invalidate_sharer()
             return None, None
 
     async def get_sharer(self, room_id: str) -> tuple[str | None, str | None]:
-        async with self._lock:
-            if room_id not in self._rooms:
-                return None, None
-            room = self._rooms[room_id]
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None, None
+        async with room.lock:
             if room.sharer_id and room.sharer_id in room.users:
                 return room.sharer_id, room.users[room.sharer_id].username
             return None, None
 
     async def update_username(self, room_id: str, user_id: str, username: str) -> None:
-        async with self._lock:
-            if room_id in self._rooms and user_id in self._rooms[room_id].users:
-                self._rooms[room_id].users[user_id].username = username
+        room = self._rooms.get(room_id)
+        if room is None:
+            return
+        async with room.lock:
+            user = room.users.get(user_id)
+            if user is not None and user.username != username:
+                user.username = username
+                room.invalidate_user_list()
+                if room.sharer_id == user_id:
+                    room.invalidate_sharer()
 
     async def get_username(self, room_id: str, user_id: str) -> str | None:
-        async with self._lock:
-            if room_id in self._rooms and user_id in self._rooms[room_id].users:
-                return self._rooms[room_id].users[user_id].username
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None
+        async with room.lock:
+            if user_id in room.users:
+                return room.users[user_id].username
             return None
 
     async def update_heartbeat(self, room_id: str, user_id: str) -> None:
-        async with self._lock:
-            if room_id in self._rooms and user_id in self._rooms[room_id].users:
-                self._rooms[room_id].users[user_id].last_heartbeat = time.time()
+        # a single attribute write; the expiry heap picks the new value up when the old deadline comes due
+        room = self._rooms.get(room_id)
+        user = room.users.get(user_id) if room is not None else None
+        if user is not None:
+            user.last_heartbeat = time.time()
 
     async def get_user_list(self, room_id: str) -> list[dict]:
-        async with self._lock:
-            if room_id not in self._rooms:
-                return []
-            return [
-                {
-                    "id": uid,
-                    "username": u.username,
-                    "muted": u.muted,
-                    "deafened": u.deafened,
-                    "inCall": u.in_call,
-                }
-                for uid, u in self._rooms[room_id].users.items()
-            ]
+        room = self._rooms.get(room_id)
+        if room is None:
+            return []
+        async with room.lock:
+            return self._user_list(room)
+
+    async def get_user_list_frame(self, room_id: str) -> Frame | None:
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None
+        async with room.lock:
+            return self._user_list_frame(room)
+
+    async def get_roster_frames(self, room_id: str, changes: dict[str, bool]) -> list[Frame]:
+        """Encode one batch of roster changes, keyed by user id with a joined flag, as seq-numbered deltas.
+
+        Users who are gone become user-left, joined ones user-joined and the rest user-updated. When the batch
+        touches most of the room a single snapshot is cheaper and is sent instead.
+        """
+        room = self._rooms.get(room_id)
+        if room is None:
+            return []
+        async with room.lock:
+            if len(changes) > 1 and len(changes) > len(room.users) // 2:
+                room.roster_seq += 1
+                room.invalidate_user_list()
+                return [self._user_list_frame(room)]
+
+            frames = []
+            for user_id, joined in changes.items():
+                room.roster_seq += 1
+                user = room.users.get(user_id)
+                if user is None:
+                    message = user_left_message(user_id, room.roster_seq)
+                elif joined:
+                    message = user_joined_message(self._user_entry(user_id, user), room.roster_seq)
+                else:
+                    message = user_updated_message(self._user_entry(user_id, user), room.roster_seq)
+                frames.append(encode_frame(message))
+            if frames:
+                room.invalidate_user_list()
+            return frames
+
+    async def get_sharer_frame(self, room_id: str) -> Frame | None:
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None
+        async with room.lock:
+            if room.sharer_frame is None:
+                sharer = room.users.get(room.sharer_id) if room.sharer_id else None
+                if sharer is not None:
+                    room.sharer_frame = encode_frame(sharer_changed_message(room.sharer_id, sharer.username))
+                else:
+                    room.sharer_frame = encode_frame(sharer_changed_message(None, None))
+            return room.sharer_frame
+
+    def _user_list_frame(self, room: Room) -> Frame:
+        if room.user_list_frame is None:
+            room.user_list_frame = encode_frame(user_list_message(self._user_list(room), room.roster_seq))
+        return room.user_list_frame
+
+    def _user_list(self, room: Room) -> list[dict]:
+        return [self._user_entry(uid, u) for uid, u in room.users.items()]
+
+    def _user_entry(self, user_id: str, user: User) -> dict:
+        return {
+            "id": user_id,
+            "username": user.username,
+            "muted": user.muted,
+            "deafened": user.deafened,
+            "inCall": user.in_call,
+        }
 
     async def update_voice_state(self, room_id: str, user_id: str, muted: bool, deafened: bool) -> bool:
-        async with self._lock:
-            if room_id in self._rooms and user_id in self._rooms[room_id].users:
-                user = self._rooms[room_id].users[user_id]
-                user.muted = muted
-                user.deafened = deafened
+        room = self._rooms.get(room_id)
+        if room is None:
+            return False
+        async with room.lock:
+            if user_id in room.users:
+                user = room.users[user_id]
+                if user.muted != muted or user.deafened != deafened:
+                    user.muted = muted
+                    user.deafened = deafened
+                    room.invalidate_user_list()
                 return True
             return False
 
+    async def get_voice_state(self, room_id: str, user_id: str) -> tuple[bool, bool]:
+        """(muted, deafened) as the user last reported them."""
+        room = self._rooms.get(room_id)
+        if room is None:
+            return False, False
+        async with room.lock:
+            user = room.users.get(user_id)
+            return (user.muted, user.deafened) if user is not None else (False, False)
+
     async def update_call_state(self, room_id: str, user_id: str, in_call: bool) -> bool:
-        async with self._lock:
-            if room_id in self._rooms and user_id in self._rooms[room_id].users:
-                self._rooms[room_id].users[user_id].in_call = in_call
+        room = self._rooms.get(room_id)
+        if room is None:
+            return False
+        async with room.lock:
+            if user_id in room.users:
+                user = room.users[user_id]
+                if user.in_call != in_call:
+                    user.in_call = in_call
+                    room.invalidate_user_list()
                 return True
             return False
 
-    async def add_chat_message(self, room_id: str, message: dict) -> list[dict]:
-        async with self._lock:
-            if room_id not in self._rooms:
-                return []
-            room = self._rooms[room_id]
-            room.chat.append(message)
-            # keep only recent messages to bound memory
-            if len(room.chat) > 200:
-                room.chat = room.chat[-200:]
-            return list(room.chat)
+    async def add_chat_message(self, room_id: str, message: dict) -> Frame | None:
+        """Stamp ``message`` with an id and keep it; returns its frame to broadcast, or None without a room."""
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None
+        entry = ChatEntry.encode(message)
+        async with room.lock:
+            room.chat.append(entry)
+        if self._chat_log is not None:
+            self._chat_log.append(room_id, entry)
+        return entry.frame
 
     async def get_chat_history(self, room_id: str) -> list[dict]:
-        async with self._lock:
-            if room_id not in self._rooms:
-                return []
-            return list(self._rooms[room_id].chat)
+        room = self._rooms.get(room_id)
+        if room is None:
+            return []
+        async with room.lock:
+            return [entry.message for entry in room.chat]
+
+    async def get_chat_page(self, room_id: str, before: int | None = None, limit: int = CHAT_PAGE_SIZE) -> Frame | None:
+        """A chat-history frame of up to ``limit`` messages older than ``before``, or the latest if None.
+
+        Returns None when there is nothing to send for the latest page, so joins into a quiet room send nothing.
+        """
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None
+        async with room.lock:
+            entries, has_more = room.chat.page(before, limit)
+            anchor = room.chat.oldest
+            complete = room.chat.complete
+        if not has_more and not complete and len(entries) < limit and self._chat_log is not None:
+            # the ring ran out; the rest of the page, and whether there is more, comes from the log
+            wanted = limit - len(entries)
+            older = await self._chat_log.load(room_id, entries[0].id if entries else before, wanted + 1)
+            has_more = len(older) > wanted
+            older = older[-wanted:]
+            if before is None:
+                async with room.lock:
+                    # a room that emptied starts with a blank ring; refill it so later joins stay in memory
+                    if room.chat.oldest == anchor:
+                        room.chat.backfill(older, has_more)
+            entries = older + entries
+        if not entries and before is None:
+            return None
+        return chat_history_frame(entries, before, has_more)
+
+    async def set_whiteboard_owner(self, room_id: str, user_id: str | None) -> None:
+        room = self._rooms.get(room_id)
+        if room is None:
+            return
+        async with room.lock:
+            room.whiteboard_owner = user_id
+            if user_id is None:
+                # viewers drop their canvas when the whiteboard stops, so the server does too
+                room.whiteboard.clear()
+            room.invalidate_whiteboard()
+
+    async def apply_whiteboard_update(self, room_id: str, data: dict) -> bool:
+        room = self._rooms.get(room_id)
+        if room is None:
+            return False
+        async with room.lock:
+            op = data.get("type")
+            if op in ("add", "path", "modify"):
+                obj = data.get("obj")
+                if not isinstance(obj, dict):
+                    return False
+                obj_id = obj.get("id")
+                if obj_id is None:
+                    # objects without an id can never be modified or deleted, but still belong on the canvas
+                    room.whiteboard_anon_ids += 1
+                    obj_id = f"_anon-{room.whiteboard_anon_ids}"
+                room.whiteboard[obj_id] = obj
+            elif op == "delete":
+                for obj_id in data.get("ids") or []:
+                    room.whiteboard.pop(obj_id, None)
+            elif op == "clear":
+                room.whiteboard.clear()
+            else:
+                return False
+            room.invalidate_whiteboard()
+            return True
+
+    async def get_whiteboard_frame(self, room_id: str) -> Frame | None:
+        room = self._rooms.get(room_id)
+        if room is None or (room.whiteboard_owner is None and not room.whiteboard):
+            return None
+        async with room.lock:
+            if room.whiteboard_frame is None:
+                message = whiteboard_snapshot_message(room.whiteboard_owner, list(room.whiteboard.values()))
+                room.whiteboard_frame = encode_frame(message)
+            return room.whiteboard_frame
 
     async def broadcast(self, room_id: str, message: dict, exclude_id: str | None = None) -> None:
-        async with self._lock:
-            if room_id not in self._rooms:
-                return
-            json_msg = json.dumps(message)
-            tasks = []
-            for uid, user in self._rooms[room_id].users.items():
-                if uid != exclude_id:
-                    tasks.append(self._safe_send(user.ws, json_msg))
-            if tasks:
-                await asyncio.gather(*tasks)
+        await self.broadcast_frame(room_id, encode_frame(message), exclude_id)
+
+    async def broadcast_frame(self, room_id: str, frame: Frame, exclude_id: str | None = None) -> None:
+        room = self._rooms.get(room_id)
+        if room is None:
+            return
+        # snapshot recipients under the lock; each connection's writer task does the actual send
+        async with room.lock:
+            targets = [user.outbox for uid, user in room.users.items() if uid != exclude_id]
+        broadcast_fanout.observe(len(targets))
+        for outbox in targets:
+            outbox.put(frame)
 
     async def send_to_user(self, room_id: str, user_id: str, message: dict) -> bool:
-        async with self._lock:
-            if room_id not in self._rooms or user_id not in self._rooms[room_id].users:
-                return False
-            json_msg = json.dumps(message)
-            await self._safe_send(self._rooms[room_id].users[user_id].ws, json_msg)
-            return True
+        return await self.send_frame_to_user(room_id, user_id, encode_frame(message))
+
+    async def send_frame_to_user(self, room_id: str, user_id: str, frame: Frame) -> bool:
+        room = self._rooms.get(room_id)
+        if room is None:
+            return False
+        async with room.lock:
+            user = room.users.get(user_id)
+        if user is None:
+            return False
+        return user.outbox.put(frame)
+
+    def _schedule_expiry(self, room_id: str, user_id: str, user: User) -> None:
+        deadline = user.last_heartbeat + HEARTBEAT_TIMEOUT
+        heapq.heappush(self._expiry, (deadline, next(self._expiry_ids), room_id, user_id, user))
+
+    def _pop_expired(self, now: float) -> list[tuple[str, str, User]]:
+        expired = []
+        while self._expiry and self._expiry[0][0] < now:
+            _, _, room_id, user_id, user = heapq.heappop(self._expiry)
+            room = self._rooms.get(room_id)
+            if room is None or room.users.get(user_id) is not user:
+                continue  # already left, or replaced by a reconnect with its own entry
+            if now - user.last_heartbeat > HEARTBEAT_TIMEOUT:
+                expired.append((room_id, user_id, user))
+            else:
+                self._schedule_expiry(room_id, user_id, user)
+        return expired
 
     async def cleanup_stale_connections(self) -> list[tuple[str, str, bool]]:
+        expired = self._pop_expired(time.time())
+        if not expired:
+            return []
+
         removed = []
-        current_time = time.time()
+        stale = []
         async with self._lock:
-            for room_id, room in list(self._rooms.items()):
-                for user_id, user in list(room.users.items()):
-                    if current_time - user.last_heartbeat > HEARTBEAT_TIMEOUT:
-                        was_sharer = room.sharer_id == user_id
-                        if was_sharer:
-                            room.sharer_id = None
-                        del room.users[user_id]
-                        removed.append((room_id, user_id, was_sharer))
-
-                if not room.users:
-                    del self._rooms[room_id]
+            for room_id, user_id, user in expired:
+                room = self._rooms.get(room_id)
+                if room is None:
+                    continue
+                async with room.lock:
+                    if room.users.get(user_id) is not user:
+                        continue
+                    was_sharer = self._remove_user(room_id, room, user_id)
+                stale.append(user)
+                removed.append((room_id, user_id, was_sharer))
+
+        for user in stale:
+            await user.outbox.close()
+            try:
+                await user.ws.close(code=STALE_CLOSE_CODE, reason="heartbeat timeout")
+            except Exception as e:
+                logger.debug(f"Closing stale socket failed: {e!r}")
         return removed
 
-    async def _safe_send(self, ws: WebSocket, message: str) -> None:
-        try:
-            await ws.send_text(message)
-        except Exception:
-            pass
-
     def room_exists(self, room_id: str) -> bool:
         return room_id in self._rooms
 
+    def collect_metrics(self) -> None:
+        users = [user for room in self._rooms.values() for user in room.users.values()]
+        depths = [len(user.outbox) for user in users]
+        rooms_gauge.set(len(self._rooms))
+        connections_gauge.set(len(users))
+        send_queue_frames.replace([({"stat": "total"}, sum(depths)), ({"stat": "max"}, max(depths, default=0))])
+        send_queue_dropped.set(sum(user.outbox.dropped for user in users))
+
 
-manager = ConnectionManager()
+manager = ConnectionManager(chat_log=ChatLog(CHAT_DB_PATH) if CHAT_DB_PATH else None)
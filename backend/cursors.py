@@ -0,0 +1,63 @@
+import asyncio
+import os
+
+from connection_manager import ConnectionManager, manager
+from encoding import encode_frame
+from message_types import whiteboard_cursors_message
+from metrics import registry
+
+CURSOR_TICK_RATE = float(os.getenv("CURSOR_TICK_HZ", "25"))
+
+cursor_updates = registry.counter("cursor_updates_total", "Whiteboard cursor positions received")
+cursor_flushes = registry.counter("cursor_flushes_total", "Batched cursor frames broadcast to a room")
+
+
+class CursorAggregator:
+    """Keeps the latest cursor per user and broadcasts one batched frame per room per tick.
+
+    Positions that arrive between ticks overwrite each other, so a room costs at most ``tick_rate`` cursor
+    frames per second no matter how many people are drawing or how fast their clients send.
+    """
+
+    def __init__(self, manager: ConnectionManager, tick_rate: float = CURSOR_TICK_RATE):
+        self._manager = manager
+        self._interval = 1 / tick_rate
+        self._pending: dict[str, dict[str, dict]] = {}
+        self._task: asyncio.Task | None = None
+
+    def update(self, room_id: str, user_id: str, username: str, data: dict) -> None:
+        cursor_updates.inc()
+        self._pending.setdefault(room_id, {})[user_id] = {"sender": user_id, "username": username, "data": data}
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def remove_user(self, room_id: str, user_id: str) -> None:
+        room = self._pending.get(room_id)
+        if room is not None:
+            room.pop(user_id, None)
+
+    async def _run(self) -> None:
+        try:
+            # the ticker stops itself once a tick finds nothing to send
+            while self._pending:
+                await asyncio.sleep(self._interval)
+                pending, self._pending = self._pending, {}
+                for room_id, cursors in pending.items():
+                    if cursors:
+                        cursor_flushes.inc()
+                        frame = encode_frame(whiteboard_cursors_message(list(cursors.values())))
+                        await self._manager.broadcast_frame(room_id, frame)
+        finally:
+            self._task = None
+
+    async def close(self) -> None:
+        self._pending.clear()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+cursors = CursorAggregator(manager)
@@ -0,0 +1,87 @@
+import logging
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Awaitable, Callable
+
+from connection_manager import User
+from fastapi import WebSocket
+from metrics import registry
+
+logger = logging.getLogger("dispatch")
+
+messages_received = registry.counter("messages_received_total", "Messages received, by type")
+messages_rejected = registry.counter("messages_rejected_total", "Messages dropped as unknown or invalid, by type")
+handler_seconds = registry.histogram("message_handler_seconds", "Time spent handling a message, by type")
+
+
+@dataclass
+class Session:
+    room_id: str
+    user_id: str
+    user: User
+    websocket: WebSocket
+
+
+Handler = Callable[[Session, dict], Awaitable[None]]
+
+
+def compile_schema(fields: dict[str, type | tuple[type, ...]], required: tuple[str, ...]) -> Callable[[dict], bool]:
+    """Build a validator for one message type up front so the hot path is a few isinstance calls.
+
+    Every listed field must have the given type when present; fields in ``required`` must also be present.
+    """
+    checks = tuple((name, types, name in required) for name, types in fields.items())
+
+    def validate(message: dict) -> bool:
+        for name, types, is_required in checks:
+            value = message.get(name)
+            if value is None:
+                if is_required:
+                    return False
+            elif not isinstance(value, types):
+                return False
+        return True
+
+    return validate
+
+
+class Dispatcher:
+    """Maps message types to handler coroutines, validating and timing each call."""
+
+    def __init__(self):
+        self._routes: dict[str, tuple[Handler, Callable[[dict], bool], str]] = {}
+
+    def route(
+        self, msg_type: str, required: tuple[str, ...] = (), **fields: type | tuple[type, ...]
+    ) -> Callable[[Handler], Handler]:
+        label = msg_type.value if isinstance(msg_type, Enum) else msg_type
+
+        def register(handler: Handler) -> Handler:
+            self._routes[msg_type] = (handler, compile_schema(fields, required), label)
+            return handler
+
+        return register
+
+    async def dispatch(self, session: Session, message: dict | None) -> None:
+        if not isinstance(message, dict):
+            # a frame that did not decode, or JSON that is not an object
+            messages_rejected.inc(type="malformed")
+            return
+        route = self._routes.get(message.get("type"))
+        if route is None:
+            messages_rejected.inc(type="unknown")
+            return
+        handler, validate, label = route
+
+        messages_received.inc(type=label)
+        if not validate(message):
+            messages_rejected.inc(type=label)
+            logger.debug(f"Dropping invalid {label} message from {session.user_id}")
+            return
+
+        start = time.perf_counter()
+        try:
+            await handler(session, message)
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, type=label)
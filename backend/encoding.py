@@ -0,0 +1,37 @@
+import json
+from dataclasses import dataclass
+
+from message_types import encode_binary
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
+
+@dataclass(frozen=True, slots=True)
+class Frame:
+    """A message serialized once and shared by every recipient it is queued for.
+
+    ``binary`` is set for message types with a compact form, sent instead of ``text`` to binary clients.
+    """
+
+    type: str | None
+    text: str
+    binary: bytes | None = None
+
+
+def dumps(message: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message, separators=(",", ":"))
+
+
+def loads(data: str | bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def encode_frame(message: dict) -> Frame:
+    return Frame(type=message.get("type"), text=dumps(message), binary=encode_binary(message))
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from metrics import registry
+
+logger = logging.getLogger("handshake")
+
+# SFU offers handled at once per SFU process; the rest wait their turn
+HANDSHAKE_CONCURRENCY = int(os.getenv("SFU_HANDSHAKE_CONCURRENCY", "8"))
+# an offer still waiting after this long is refused, as the client has likely given up on it
+HANDSHAKE_DEADLINE = int(os.getenv("SFU_HANDSHAKE_DEADLINE_MS", "5000")) / 1000
+HANDSHAKE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+handshakes = registry.counter(
+    "sfu_handshakes_total", "SFU offers by outcome; steps queued behind one that did not go through as follower_*"
+)
+handshake_seconds = registry.histogram(
+    "sfu_handshake_seconds", "SFU offer time waiting for a slot and running, by stage", HANDSHAKE_BUCKETS
+)
+handshakes_pending = registry.gauge("sfu_handshakes_pending", "SFU offers not answered yet, by state")
+
+Step = Callable[[], Awaitable[None]]
+
+
+@dataclass
+class _Handshake:
+    key: str
+    run: Step
+    shed: Step | None
+    queued_at: float = field(default_factory=time.monotonic)
+    # steps that only make sense once the handshake is through, such as the same user's ICE candidates
+    followers: list[Step] = field(default_factory=list)
+
+
+class HandshakeExecutor:
+    """Runs SFU offer/answer handshakes off the receive loops, at most ``concurrency`` at a time.
+
+    Offers are started in arrival order. One that waited past the deadline is shed instead, and one that fails
+    is refused the same way: its ``shed`` step runs so the client can retry later, and the steps following it
+    are dropped, as the retry brings its own. A newer offer from the same key replaces one still waiting, since
+    only the latest describes the client's peer connection.
+    """
+
+    def __init__(self, concurrency: int = HANDSHAKE_CONCURRENCY, deadline: float = HANDSHAKE_DEADLINE):
+        self._concurrency = concurrency
+        self._deadline = deadline
+        self._queued: dict[str, _Handshake] = {}
+        self._running: dict[str, _Handshake] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queued)
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def collect_metrics(self) -> None:
+        handshakes_pending.replace([({"state": "queued"}, self.queued), ({"state": "running"}, self.running)])
+
+    def submit(self, key: str, run: Step, shed: Step | None = None) -> None:
+        stale = self._queued.pop(key, None)
+        if stale is not None:
+            handshakes.inc(outcome="superseded")
+        self._queued[key] = _Handshake(key, run, shed)
+        self._pump()
+
+    def follow(self, key: str, step: Step) -> bool:
+        """Runs ``step`` after the key's pending handshake; False if there is none and it may run right away."""
+        handshake = self._queued.get(key) or self._running.get(key)
+        if handshake is None:
+            return False
+        handshake.followers.append(step)
+        return True
+
+    async def close(self) -> None:
+        self._queued.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _pump(self) -> None:
+        while self._queued and len(self._tasks) < self._concurrency:
+            handshake = self._queued.pop(next(iter(self._queued)))
+            waited = time.monotonic() - handshake.queued_at
+            if waited > self._deadline:
+                handshakes.inc(outcome="shed")
+                logger.warning(f"Shed SFU handshake for {handshake.key} after {waited:.1f}s in the queue")
+                self._drop_followers(handshake, "follower_shed")
+                if handshake.shed is not None:
+                    self._start(handshake.shed)
+                continue
+            handshake_seconds.observe(waited, stage="queued")
+            self._running[handshake.key] = handshake
+            self._start(lambda handshake=handshake: self._run(handshake))
+
+    def _start(self, step: Step) -> None:
+        task = asyncio.create_task(self._guard(step))
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._pump()
+
+    async def _guard(self, step: Step) -> None:
+        try:
+            await step()
+        except Exception:
+            logger.exception("SFU handshake step failed")
+
+    def _drop_followers(self, handshake: _Handshake, outcome: str) -> None:
+        if handshake.followers:
+            handshakes.inc(len(handshake.followers), outcome=outcome)
+            handshake.followers.clear()
+
+    async def _run(self, handshake: _Handshake) -> None:
+        started = time.monotonic()
+        try:
+            await handshake.run()
+        except Exception:
+            handshakes.inc(outcome="failed")
+            self._drop_followers(handshake, "follower_failed")
+            if handshake.shed is not None:
+                # the client would otherwise wait on an answer that never comes
+                self._start(handshake.shed)
+            raise
+        else:
+            handshakes.inc(outcome="answered")
+            handshake_seconds.observe(time.monotonic() - started, stage="running")
+            while handshake.followers:
+                await handshake.followers.pop(0)()
+        finally:
+            if self._running.get(handshake.key) is handshake:
+                del self._running[handshake.key]
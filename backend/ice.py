@@ -0,0 +1,72 @@
+import logging
+import time
+from dataclasses import dataclass, field
+
+from metrics import registry
+
+logger = logging.getLogger("ice")
+
+# a client trickles a handful of candidates per transport; more than this is a broken or hostile client
+MAX_BUFFERED_CANDIDATES = 64
+# candidates for a user whose offer never comes are forgotten after this long
+CANDIDATE_BUFFER_TTL = 30.0
+
+ice_candidates = registry.counter("sfu_ice_candidates_total", "ICE candidates from clients, by outcome")
+
+
+@dataclass
+class _Pending:
+    since: float = field(default_factory=time.monotonic)
+    candidates: list[dict] = field(default_factory=list)
+
+
+class CandidateBuffer:
+    """ICE candidates held per user until there is a peer connection with a remote description to take them.
+
+    Clients trickle candidates as soon as they gather them, which is often before their offer has been
+    answered, or even handled.
+    """
+
+    def __init__(self, max_per_user: int = MAX_BUFFERED_CANDIDATES, ttl: float = CANDIDATE_BUFFER_TTL):
+        self._max_per_user = max_per_user
+        self._ttl = ttl
+        self._pending: dict[str, _Pending] = {}
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return sum(len(pending.candidates) for pending in self._pending.values())
+
+    def add(self, user_id: str, candidate: dict) -> None:
+        pending = self._pending.get(user_id)
+        if pending is None:
+            self._sweep()
+            pending = self._pending[user_id] = _Pending()
+        if len(pending.candidates) >= self._max_per_user:
+            ice_candidates.inc(outcome="dropped", reason="overflow")
+            return
+        pending.candidates.append(candidate)
+        ice_candidates.inc(outcome="buffered")
+
+    def take(self, user_id: str) -> list[dict]:
+        pending = self._pending.pop(user_id, None)
+        if pending is None:
+            return []
+        if time.monotonic() - pending.since > self._ttl:
+            ice_candidates.inc(len(pending.candidates), outcome="dropped", reason="expired")
+            return []
+        return pending.candidates
+
+    def discard(self, user_id: str) -> None:
+        pending = self._pending.pop(user_id, None)
+        if pending is not None and pending.candidates:
+            ice_candidates.inc(len(pending.candidates), outcome="dropped", reason="abandoned")
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        if now - self._last_sweep < self._ttl:
+            return
+        self._last_sweep = now
+        for user_id in [user for user, pending in self._pending.items() if now - pending.since > self._ttl]:
+            expired = self._pending.pop(user_id)
+            ice_candidates.inc(len(expired.candidates), outcome="dropped", reason="expired")
+            logger.info(f"Dropped {len(expired.candidates)} ICE candidates from {user_id}, no offer followed")
@@ -0,0 +1,469 @@
+"""Load generator and benchmark for the signaling server.
+
+Starts main.app under uvicorn in a child process (or targets a running server with --url), connects simulated
+clients spread over many rooms, and drives a join storm followed by a steady phase of chat bursts, 60 Hz
+whiteboard cursors and pings. It reports throughput, end-to-end delivery latency percentiles, and the server's
+CPU and memory use. With --baseline it compares against a saved run and exits non-zero on a regression, so it can
+gate changes to the hot paths. With --startup it instead times cold starts: how long a fresh server takes to
+accept connections, next to the cost of importing FastAPI and the media stack on their own.
+
+    python loadtest.py --clients 2000 --rooms 100 --duration 30 --save baseline.json
+    python loadtest.py --clients 2000 --rooms 100 --duration 30 --baseline baseline.json
+    python loadtest.py --startup 10 --baseline startup.json
+
+One Python process cannot drive thousands of sockets at 60 Hz, so use --procs to spread the rooms over several
+generator processes. Every client of a room lives in the same process, which timestamps both ends of a delivery.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from multiprocessing import get_context
+from pathlib import Path
+
+import websockets
+
+BACKEND_DIR = Path(__file__).resolve().parent
+SERVER_START_TIMEOUT = 15.0
+# fine enough to time a cold start by
+SERVER_POLL_INTERVAL = 0.01
+# latency samples kept per kind and generator process; beyond this a uniform reservoir sample stands in
+MAX_SAMPLES = 200_000
+# a run can regress this much against its baseline before the gate fails, as runs on one machine are noisy
+DEFAULT_TOLERANCE = 0.25
+# latencies within this many seconds of the baseline never count as a regression
+LATENCY_SLACK = 0.002
+
+
+@dataclass
+class Scenario:
+    clients: int = 200
+    rooms: int = 20
+    duration: float = 10.0
+    # chat bursts per room per second, and messages per burst
+    chat_rate: float = 0.5
+    chat_burst: int = 5
+    # clients per room moving a whiteboard cursor, and how often each sends its position
+    cursor_senders: int = 2
+    cursor_hz: float = 60.0
+    ping_interval: float = 5.0
+    procs: int = 1
+
+
+@dataclass
+class Samples:
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    seen: dict[str, int] = field(default_factory=dict)
+    sent: dict[str, int] = field(default_factory=dict)
+    received: int = 0
+    failed_joins: int = 0
+    disconnects: int = 0
+
+    def observe(self, kind: str, value: float) -> None:
+        values = self.latencies.setdefault(kind, [])
+        seen = self.seen[kind] = self.seen.get(kind, 0) + 1
+        if len(values) < MAX_SAMPLES:
+            values.append(value)
+        else:
+            slot = random.randrange(seen)
+            if slot < MAX_SAMPLES:
+                values[slot] = value
+
+    def count_sent(self, kind: str, n: int = 1) -> None:
+        self.sent[kind] = self.sent.get(kind, 0) + n
+
+    def merge(self, other: "Samples") -> None:
+        for kind, values in other.latencies.items():
+            self.latencies.setdefault(kind, []).extend(values)
+            self.seen[kind] = self.seen.get(kind, 0) + other.seen.get(kind, 0)
+        for kind, n in other.sent.items():
+            self.count_sent(kind, n)
+        self.received += other.received
+        self.failed_joins += other.failed_joins
+        self.disconnects += other.disconnects
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Client:
+    """One simulated user: a socket, a reader that timestamps deliveries, and the sends the scenario asks for."""
+
+    def __init__(self, url: str, room_id: str, user_id: str, samples: Samples):
+        self.url = f"{url}/ws/{room_id}/{user_id}"
+        self.user_id = user_id
+        self.samples = samples
+        self.ws = None
+        self.joined = asyncio.Event()
+        self._pings: list[float] = []
+        self._reader: asyncio.Task | None = None
+
+    async def join(self) -> None:
+        started = time.monotonic()
+        try:
+            self.ws = await websockets.connect(self.url, max_size=None, open_timeout=60, ping_interval=None)
+            self._reader = asyncio.create_task(self._read())
+            await self.send({"type": "join", "username": self.user_id})
+            await asyncio.wait_for(self.joined.wait(), timeout=60)
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            self.samples.failed_joins += 1
+            return
+        self.samples.observe("join", time.monotonic() - started)
+
+    async def send(self, message: dict) -> None:
+        await self.ws.send(json.dumps(message))
+
+    async def ping(self) -> None:
+        self._pings.append(time.monotonic())
+        await self.send({"type": "ping"})
+        self.samples.count_sent("ping")
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            self._reader.cancel()
+
+    async def _read(self) -> None:
+        try:
+            async for raw in self.ws:
+                now = time.monotonic()
+                self.samples.received += 1
+                message = json.loads(raw)
+                kind = message.get("type")
+                if kind in ("user-list", "user-joined"):
+                    self.joined.set()
+                elif kind == "pong" and self._pings:
+                    self.samples.observe("ping", now - self._pings.pop(0))
+                elif kind == "chat" and message.get("text", "").startswith("bench:"):
+                    self.samples.observe("chat", now - float(message["text"][6:]))
+                elif kind == "whiteboard-cursors":
+                    for cursor in message.get("cursors", []):
+                        sent_at = (cursor.get("data") or {}).get("t")
+                        if sent_at is not None and cursor.get("sender") != self.user_id:
+                            self.samples.observe("cursor", now - sent_at)
+        except websockets.ConnectionClosedError:
+            self.samples.disconnects += 1
+
+
+async def _every(interval: float, until: float, action) -> None:
+    # random phase, so a room's senders do not all fire on the same tick
+    await asyncio.sleep(random.random() * interval)
+    next_at = time.monotonic()
+    while next_at < until:
+        try:
+            await action()
+        except websockets.ConnectionClosed:
+            return
+        next_at += interval
+        await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+
+
+async def _run_rooms(scenario: Scenario, url: str, rooms: list[tuple[str, int]]) -> Samples:
+    samples = Samples()
+    clients = {
+        room_id: [Client(url, room_id, f"{room_id}-u{i}", samples) for i in range(size)] for room_id, size in rooms
+    }
+    everyone = [client for members in clients.values() for client in members]
+
+    # join storm: every client connects and joins at once
+    await asyncio.gather(*(client.join() for client in everyone))
+    joined = {room_id: [c for c in members if c.joined.is_set()] for room_id, members in clients.items()}
+
+    until = time.monotonic() + scenario.duration
+    tasks = []
+    for client in (c for members in joined.values() for c in members):
+        tasks.append(_every(scenario.ping_interval, until, client.ping))
+    for members in joined.values():
+        if not members:
+            continue
+
+        async def chat_burst(members=members):
+            sender = random.choice(members)
+            for _ in range(scenario.chat_burst):
+                await sender.send({"type": "chat", "text": f"bench:{time.monotonic()}", "username": sender.user_id})
+            samples.count_sent("chat", scenario.chat_burst)
+
+        if scenario.chat_rate > 0:
+            tasks.append(_every(1 / scenario.chat_rate, until, chat_burst))
+        for sender in members[: scenario.cursor_senders]:
+
+            async def move_cursor(sender=sender):
+                position = {"x": random.random() * 1000, "y": random.random() * 1000, "t": time.monotonic()}
+                await sender.send({"type": "whiteboard-cursor", "data": position})
+                samples.count_sent("cursor")
+
+            if scenario.cursor_hz > 0:
+                tasks.append(_every(1 / scenario.cursor_hz, until, move_cursor))
+
+    await asyncio.gather(*tasks)
+    # let the last deliveries land before hanging up
+    await asyncio.sleep(1.0)
+    await asyncio.gather(*(client.close() for client in everyone), return_exceptions=True)
+    return samples
+
+
+def _run_slice(scenario: Scenario, url: str, rooms: list[tuple[str, int]]) -> Samples:
+    _raise_file_limit()
+    return asyncio.run(_run_rooms(scenario, url, rooms))
+
+
+def _raise_file_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class ServerProcess:
+    """main.app under uvicorn in a child process, with its CPU time and memory read from /proc."""
+
+    def __init__(self, port: int | None = None, env: dict | None = None):
+        self.port = port or _free_port()
+        self.url = f"ws://127.0.0.1:{self.port}"
+        self._env = {**os.environ, **(env or {})}
+        self.process: subprocess.Popen | None = None
+        # from spawning the process until it accepted a connection
+        self.startup_seconds: float | None = None
+
+    def start(self) -> None:
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port)]
+        started = time.monotonic()
+        self.process = subprocess.Popen(
+            command + ["--log-level", "warning"], cwd=BACKEND_DIR, env=self._env, preexec_fn=_raise_file_limit
+        )
+        deadline = started + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                self.startup_seconds = time.monotonic() - started
+                return
+            except OSError:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError("The server did not come up")
+                time.sleep(SERVER_POLL_INTERVAL)
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(10)
+
+    def cpu_seconds(self) -> float | None:
+        try:
+            fields = Path(f"/proc/{self.process.pid}/stat").read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # utime and stime, fields 14 and 15 of stat(5), counted after the ")" that closes the command name
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def peak_rss_bytes(self) -> int | None:
+        try:
+            status = Path(f"/proc/{self.process.pid}/status").read_text()
+        except OSError:
+            return None
+        for line in status.splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+        return None
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(scenario: Scenario, url: str | None = None, server_env: dict | None = None) -> dict:
+    run_id = uuid.uuid4().hex[:6]
+    rooms = [(f"bench-{run_id}-{r}", size) for r, size in _room_sizes(scenario)]
+    slices = [rooms[i :: scenario.procs] for i in range(scenario.procs)]
+
+    server = None
+    if url is None:
+        server = ServerProcess(env=server_env)
+        server.start()
+        url = server.url
+    try:
+        cpu_before = server.cpu_seconds() if server else None
+        started = time.monotonic()
+        samples = Samples()
+        if scenario.procs == 1:
+            samples = _run_slice(scenario, url, slices[0])
+        else:
+            with ProcessPoolExecutor(scenario.procs, mp_context=get_context("spawn")) as pool:
+                for result in pool.map(_run_slice, [scenario] * scenario.procs, [url] * scenario.procs, slices):
+                    samples.merge(result)
+        elapsed = time.monotonic() - started
+        cpu = server.cpu_seconds() - cpu_before if server and cpu_before is not None else None
+        peak_rss = server.peak_rss_bytes() if server else None
+    finally:
+        if server is not None:
+            server.stop()
+    return report(scenario, samples, elapsed, cpu, peak_rss)
+
+
+def _room_sizes(scenario: Scenario) -> list[tuple[int, int]]:
+    base, extra = divmod(scenario.clients, scenario.rooms)
+    return [(r, base + (r < extra)) for r in range(scenario.rooms)]
+
+
+def report(scenario: Scenario, samples: Samples, elapsed: float, cpu: float | None, peak_rss: int | None) -> dict:
+    latency = {}
+    for kind, values in samples.latencies.items():
+        latency[kind] = {
+            "count": samples.seen[kind],
+            "p50": percentile(values, 0.50),
+            "p99": percentile(values, 0.99),
+            "max": max(values),
+        }
+    sent = sum(samples.sent.values())
+    return {
+        "scenario": asdict(scenario),
+        "elapsed": elapsed,
+        "latency": latency,
+        "throughput": {
+            "sent_per_second": sent / elapsed,
+            "delivered_per_second": samples.received / elapsed,
+            "sent": dict(samples.sent),
+        },
+        "errors": {"failed_joins": samples.failed_joins, "disconnects": samples.disconnects},
+        "server": {
+            "cpu_percent": 100 * cpu / elapsed if cpu is not None else None,
+            "cpu_ms_per_1k_delivered": 1e6 * cpu / samples.received if cpu is not None and samples.received else None,
+            "peak_rss_mb": peak_rss / 2**20 if peak_rss is not None else None,
+        },
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    """The ways ``result`` is worse than ``baseline`` beyond ``tolerance``; empty when the gate passes."""
+    regressions = []
+    for kind, stats in baseline["latency"].items():
+        now = result["latency"].get(kind)
+        if now is None:
+            regressions.append(f"{kind}: no deliveries")
+            continue
+        for q in ("p50", "p99"):
+            if now[q] > stats[q] * (1 + tolerance) + LATENCY_SLACK:
+                regressions.append(f"{kind} {q} latency {now[q] * 1000:.1f} ms, baseline {stats[q] * 1000:.1f} ms")
+    delivered, base_delivered = (r["throughput"]["delivered_per_second"] for r in (result, baseline))
+    if delivered < base_delivered * (1 - tolerance):
+        regressions.append(f"delivered {delivered:.0f}/s, baseline {base_delivered:.0f}/s")
+    cost, base_cost = (r["server"]["cpu_ms_per_1k_delivered"] for r in (result, baseline))
+    if cost is not None and base_cost is not None and cost > base_cost * (1 + tolerance):
+        regressions.append(f"server CPU {cost:.1f} ms per 1k deliveries, baseline {base_cost:.1f} ms")
+    if result["errors"]["failed_joins"] > baseline["errors"]["failed_joins"]:
+        regressions.append(f"{result['errors']['failed_joins']} failed joins")
+    return regressions
+
+
+def _import_seconds(module: str) -> float:
+    """How long a fresh interpreter takes to import ``module``, as every new server process must."""
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, capture_output=True, check=True, text=True)
+    return float(output.stdout.split()[-1])
+
+
+def measure_startup(runs: int, server_env: dict | None = None) -> dict:
+    ready = []
+    for _ in range(runs):
+        server = ServerProcess(env=server_env)
+        server.start()
+        server.stop()
+        ready.append(server.startup_seconds)
+    return {
+        "startup": {
+            "runs": runs,
+            "ready_p50": percentile(ready, 0.50),
+            "ready_max": max(ready),
+            # the floor a server cannot start below, and what the media stack would add if loaded up front
+            "fastapi_import": _import_seconds("fastapi"),
+            "media_import": _import_seconds("sfu"),
+        }
+    }
+
+
+def compare_startup(result: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    now, base = result["startup"]["ready_p50"], baseline["startup"]["ready_p50"]
+    if now > base * (1 + tolerance) + SERVER_POLL_INTERVAL:
+        return [f"startup {now * 1000:.0f} ms, baseline {base * 1000:.0f} ms"]
+    return []
+
+
+def print_startup_report(result: dict) -> None:
+    startup = result["startup"]
+    print(
+        f"{startup['runs']} cold starts: ready in {startup['ready_p50'] * 1000:.0f} ms (p50), "
+        f"{startup['ready_max'] * 1000:.0f} ms (max)"
+    )
+    print(f"  importing fastapi {startup['fastapi_import'] * 1000:.0f} ms, sfu {startup['media_import'] * 1000:.0f} ms")
+
+
+def print_report(result: dict) -> None:
+    scenario = result["scenario"]
+    print(f"{scenario['clients']} clients in {scenario['rooms']} rooms for {result['elapsed']:.1f}s")
+    for kind, stats in sorted(result["latency"].items()):
+        print(
+            f"  {kind:<7} p50 {stats['p50'] * 1000:8.2f} ms  p99 {stats['p99'] * 1000:8.2f} ms"
+            f"  max {stats['max'] * 1000:8.2f} ms  n={stats['count']}"
+        )
+    throughput = result["throughput"]
+    print(f"  sent {throughput['sent_per_second']:.0f}/s, delivered {throughput['delivered_per_second']:.0f}/s")
+    server = result["server"]
+    if server["cpu_percent"] is not None:
+        print(
+            f"  server CPU {server['cpu_percent']:.0f}% ({server['cpu_ms_per_1k_delivered']:.1f} ms per 1k "
+            f"deliveries), peak RSS {server['peak_rss_mb']:.0f} MiB"
+        )
+    errors = result["errors"]
+    if errors["failed_joins"] or errors["disconnects"]:
+        print(f"  {errors['failed_joins']} failed joins, {errors['disconnects']} dropped connections")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    defaults = Scenario()
+    for name, value in asdict(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument("--url", help="ws:// base URL of a running server; by default one is started")
+    parser.add_argument("--save", type=Path, help="write the result as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", type=Path, help="fail if the run regresses against this saved result")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--startup", type=int, default=0, metavar="RUNS", help="time this many cold starts instead")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        result = measure_startup(args.startup)
+        print_startup_report(result)
+        gate = compare_startup
+    else:
+        scenario = Scenario(**{name: getattr(args, name) for name in asdict(defaults)})
+        result = run(scenario, url=args.url)
+        print_report(result)
+        gate = compare
+    if args.save:
+        args.save.write_text(json.dumps(result, indent=2))
+    if args.baseline:
+        regressions = gate(result, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
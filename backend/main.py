@@ -1,53 +1,105 @@
 import asyncio
-import json
+import functools
+import logging
 import os
 import time
 import uuid
 from contextlib import asynccontextmanager
 from pathlib import Path
 
-from connection_manager import HEARTBEAT_INTERVAL, manager
+from chat_store import CHAT_PAGE_SIZE
+from cluster import Receive, cluster
+from connection_manager import HEARTBEAT_INTERVAL, RESUME_GRACE, User, manager
+from cursors import cursors
+from dispatch import Dispatcher, Session
+from encoding import encode_frame, loads
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
+from handshake import HANDSHAKE_CONCURRENCY, HANDSHAKE_DEADLINE, HandshakeExecutor
 from message_types import (
+    BINARY_SUBPROTOCOL,
     MessageType,
     call_state_message,
-    chat_history_message,
     chat_message,
+    decode_binary,
     pong_message,
-    sharer_changed_message,
+    session_message,
     signal_message,
-    user_list_message,
-    voice_signal_message,
     voice_state_message,
-    whiteboard_cursor_message,
     whiteboard_start_message,
     whiteboard_stop_message,
     whiteboard_update_message,
 )
-from sfu import sfu
+from metrics import registry
+from roster import roster
+from sfu_loader import SFU_WARMUP, LazySFU, record_peer_stats, voice_peer, voice_user
+from sfu_pool import SFU_WORKERS
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
+from static_assets import StaticBundle
+
+logging.basicConfig(level=logging.INFO)
 
 limiter = Limiter(key_func=get_remote_address)
+# with SFU_WORKERS set, peer connections and media fan-out run in worker processes off the signaling loop;
+# either way the media stack is only loaded once something needs it
+sfu = LazySFU(SFU_WORKERS)
+# every SFU process gets its own share of concurrent handshakes
+handshakes = HandshakeExecutor(HANDSHAKE_CONCURRENCY * max(SFU_WORKERS, 1))
+
+PONG_FRAME = encode_frame(pong_message())
+# close codes of a client that meant to leave; any other drop keeps its session open for a while to resume
+CLEAN_CLOSE_CODES = (1000, 1001)
+# policy violation: a user id the server cannot accept
+INVALID_USER_CLOSE_CODE = 1008
+
+sfu_worker_load = registry.gauge("sfu_worker_peer_connections", "Peer connections hosted by each SFU worker process")
+
+
+# signal targets for the SFU: the screen share connection and the call audio one
+SFU_TARGET = "sfu"
+SFU_VOICE_TARGET = "sfu-voice"
+
+
+async def send_sfu_signal(room_id: str, peer_id: str, data: dict):
+    user_id = voice_user(peer_id)
+    if user_id is not None:
+        await manager.send_to_user(room_id, user_id, signal_message(SFU_VOICE_TARGET, data))
+    else:
+        await manager.send_to_user(room_id, peer_id, signal_message(SFU_TARGET, data))
+
+
+sfu.on_signal = send_sfu_signal
 
 
 async def heartbeat_cleanup_task():
     while True:
         await asyncio.sleep(HEARTBEAT_INTERVAL)
-        removed = await manager.cleanup_stale_connections()
-        for room_id, user_id, was_sharer in removed:
-            await broadcast_user_list(room_id)
-            if was_sharer:
-                await broadcast_sharer_changed(room_id, None, None)
+        await expire_stale_connections()
+
+
+async def expire_stale_connections():
+    for room_id, user_id, was_sharer in await manager.cleanup_stale_connections():
+        await user_removed(room_id, user_id, was_sharer)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    if SFU_WARMUP:
+        sfu.warm_up()
+    await cluster.start(serve_session)
     task = asyncio.create_task(heartbeat_cleanup_task())
     yield
     task.cancel()
+    for parked in list(parked_sessions):
+        parked.cancel()
+    await cluster.close()
+    await handshakes.close()
+    await roster.close()
+    await cursors.close()
+    await sfu.close()
+    await manager.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -58,142 +110,299 @@ BASE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BASE_DIR.parent / "frontend" / "dist"
 
 
+async def receive_message(websocket: WebSocket) -> dict | None:
+    """The next message from the client, or None for a frame that does not decode, which the router drops."""
+    event = await websocket.receive()
+    if event["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(event.get("code", 1000))
+    try:
+        if event.get("bytes") is not None:
+            return decode_binary(event["bytes"])
+        return loads(event["text"])
+    except ValueError:
+        # unknown or truncated binary frames and invalid JSON alike; one bad frame does not end the session
+        return None
+
+
+router = Dispatcher()
+
+
+@router.route(MessageType.JOIN, username=str)
+async def handle_join(session: Session, message: dict):
+    room_id, user_id = session.room_id, session.user_id
+    username = message.get("username", "Anonymous")
+    # the token to resume with, and the frame the client starts counting after
+    await manager.send_to_user(room_id, user_id, session_message(session.user.token, False))
+    await manager.update_username(room_id, user_id, username)
+    await roster.user_joined(room_id, user_id)
+    await send_user_list(room_id, user_id)
+    # only the latest page; clients ask for older ones as they scroll back
+    history = await manager.get_chat_page(room_id)
+    if history is not None:
+        await manager.send_frame_to_user(room_id, user_id, history)
+    sharer_id, _ = await manager.get_sharer(room_id)
+    if sharer_id:
+        await manager.send_frame_to_user(room_id, user_id, await manager.get_sharer_frame(room_id))
+    whiteboard = await manager.get_whiteboard_frame(room_id)
+    if whiteboard is not None:
+        await manager.send_frame_to_user(room_id, user_id, whiteboard)
+
+
+@router.route(MessageType.SIGNAL, required=("data",), target=str, data=dict)
+async def handle_signal(session: Session, message: dict):
+    room_id, user_id = session.room_id, session.user_id
+    target_id = message.get("target")
+    data = message["data"]
+
+    if target_id in (SFU_TARGET, SFU_VOICE_TARGET):
+        # everything SFU-side is keyed by peer, so call audio runs through the same handshake as screen sharing
+        peer_id = voice_peer(user_id) if target_id == SFU_VOICE_TARGET else user_id
+        if data.get("type") == "offer":
+            # Determine if this offer is from a publisher based on the provided intent
+            # Use intent instead of relying on the current sharer to avoid races
+            is_sharer = data.get("intent") == "publish"
+
+            async def answer_offer():
+                answer = await sfu.handle_offer(room_id, peer_id, data["sdp"], is_sharer, data.get("layers"))
+                await send_sfu_signal(room_id, peer_id, {"type": "answer", "sdp": answer.sdp})
+                if peer_id != user_id:
+                    await sfu.set_voice_state(room_id, user_id, *await manager.get_voice_state(room_id, user_id))
+                # tracks the offer left out are offered back now that the answer is on its way
+                await sfu.renegotiate(peer_id)
+
+            async def refuse_offer():
+                retry_after = int(HANDSHAKE_DEADLINE * 1000)
+                await send_sfu_signal(room_id, peer_id, {"type": "busy", "retryAfter": retry_after})
+
+            # handshakes run in the background, so a join storm cannot stall this user's other messages
+            handshakes.submit(peer_id, answer_offer, refuse_offer)
+        elif data.get("type") == "answer":
+            # the client answering an offer the SFU made to renegotiate its connection
+            await sfu.handle_answer(peer_id, data["sdp"])
+        elif data.get("type") == "candidate":
+            # candidates belong to the peer connection the pending offer is about to create
+            candidate = functools.partial(sfu.handle_ice_candidate, peer_id, data["candidate"])
+            if not handshakes.follow(peer_id, candidate):
+                await candidate()
+
+    elif target_id:
+        await manager.send_to_user(room_id, target_id, signal_message(user_id, data))
+
+
+@router.route(MessageType.START_SHARING)
+async def handle_start_sharing(session: Session, message: dict):
+    room_id, user_id = session.room_id, session.user_id
+    sharer_id, _ = await manager.set_sharer(room_id, user_id)
+    if sharer_id == user_id:
+        await broadcast_sharer_changed(room_id)
+    else:
+        await manager.send_frame_to_user(room_id, user_id, await manager.get_sharer_frame(room_id))
+
+
+@router.route(MessageType.STOP_SHARING)
+async def handle_stop_sharing(session: Session, message: dict):
+    room_id, user_id = session.room_id, session.user_id
+    current_sharer, _ = await manager.get_sharer(room_id)
+    await sfu.cleanup_user(room_id, user_id)
+    if current_sharer == user_id:
+        await manager.set_sharer(room_id, None)
+        await broadcast_sharer_changed(room_id)
+
+
+@router.route(MessageType.PING)
+async def handle_ping(session: Session, message: dict):
+    session.user.last_heartbeat = time.time()
+    await manager.send_frame_to_user(session.room_id, session.user_id, PONG_FRAME)
+
+
+@router.route(MessageType.VOICE_STATE, muted=bool, deafened=bool)
+async def handle_voice_state(session: Session, message: dict):
+    room_id, user_id = session.room_id, session.user_id
+    muted = message.get("muted", False)
+    deafened = message.get("deafened", False)
+    await manager.update_voice_state(room_id, user_id, muted, deafened)
+    await manager.broadcast(room_id, voice_state_message(user_id, muted, deafened), exclude_id=user_id)
+    await sfu.set_voice_state(room_id, user_id, muted, deafened)
+
+
+@router.route(MessageType.CALL_STATE, inCall=bool)
+async def handle_call_state(session: Session, message: dict):
+    room_id, user_id = session.room_id, session.user_id
+    in_call = message.get("inCall", False)
+    updated = await manager.update_call_state(room_id, user_id, in_call)
+    if updated:
+        await manager.broadcast(room_id, call_state_message(user_id, in_call), exclude_id=None)
+        await roster.user_updated(room_id, user_id)
+    if not in_call:
+        # frees the user's place among the call's speakers now rather than when ICE gives up on it
+        await sfu.cleanup_user(room_id, voice_peer(user_id))
+
+
+@router.route(MessageType.ROSTER_SYNC)
+async def handle_roster_sync(session: Session, message: dict):
+    await send_user_list(session.room_id, session.user_id)
+
+
+@router.route(MessageType.CHAT, text=str, username=str)
+async def handle_chat(session: Session, message: dict):
+    text = (message.get("text") or "").strip()
+    if text:
+        username = message.get("username") or "Anonymous"
+        ts = time.time()
+        msg = chat_message(session.user_id, username, text[:400], ts)
+        frame = await manager.add_chat_message(session.room_id, msg)
+        if frame is not None:
+            await manager.broadcast_frame(session.room_id, frame)
+
+
+@router.route(MessageType.CHAT_HISTORY, required=("before",), before=int, limit=int)
+async def handle_chat_history(session: Session, message: dict):
+    limit = min(max(message.get("limit") or CHAT_PAGE_SIZE, 1), CHAT_PAGE_SIZE)
+    page = await manager.get_chat_page(session.room_id, message["before"], limit)
+    if page is not None:
+        await manager.send_frame_to_user(session.room_id, session.user_id, page)
+
+
+@router.route(MessageType.WHITEBOARD_START)
+async def handle_whiteboard_start(session: Session, message: dict):
+    # Optional: Check if someone else is already sharing screen or whiteboarding
+    # For now, we trust the clientstate, but we could enforce it here.
+    await manager.set_whiteboard_owner(session.room_id, session.user_id)
+    await manager.broadcast(session.room_id, whiteboard_start_message(session.user_id), exclude_id=session.user_id)
+
+
+@router.route(MessageType.WHITEBOARD_STOP)
+async def handle_whiteboard_stop(session: Session, message: dict):
+    await manager.set_whiteboard_owner(session.room_id, None)
+    await manager.broadcast(session.room_id, whiteboard_stop_message(session.user_id), exclude_id=session.user_id)
+
+
+@router.route(MessageType.WHITEBOARD_UPDATE, required=("data",), data=dict)
+async def handle_whiteboard_update(session: Session, message: dict):
+    data = message["data"]
+    if await manager.apply_whiteboard_update(session.room_id, data):
+        await manager.broadcast(
+            session.room_id, whiteboard_update_message(session.user_id, data), exclude_id=session.user_id
+        )
+
+
+@router.route(MessageType.WHITEBOARD_CURSOR, required=("data",), data=dict)
+async def handle_whiteboard_cursor(session: Session, message: dict):
+    # the aggregator batches cursors per tick; the username comes straight off our own User
+    cursors.update(session.room_id, session.user_id, session.user.username, message["data"])
+
+
 @app.websocket("/ws/{room_id}/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, room_id: str, user_id: str):
-    await websocket.accept()
-    await manager.join_room(room_id, user_id, websocket, "Anonymous")
+    if voice_user(user_id) is not None:
+        # the SFU keys a user's call audio by this id, so connecting as it would hijack someone else's call
+        await websocket.close(code=INVALID_USER_CLOSE_CODE)
+        return
+    binary = BINARY_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+    await websocket.accept(subprotocol=BINARY_SUBPROTOCOL if binary else None)
+    receive = functools.partial(receive_message, websocket)
 
-    try:
-        while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            msg_type = message.get("type")
-
-            if msg_type == MessageType.JOIN:
-                username = message.get("username", "Anonymous")
-                await manager.update_username(room_id, user_id, username)
-                await broadcast_user_list(room_id)
-                history = await manager.get_chat_history(room_id)
-                if history:
-                    await manager.send_to_user(room_id, user_id, chat_history_message(history))
-                sharer_id, sharer_name = await manager.get_sharer(room_id)
-                if sharer_id:
-                    await manager.send_to_user(room_id, user_id, sharer_changed_message(sharer_id, sharer_name))
-
-            elif msg_type == MessageType.SIGNAL:
-                target_id = message.get("target")
-                data = message.get("data")
-
-                if target_id == "sfu":
-                    if data.get("type") == "offer":
-                        # Determine if this offer is from a publisher based on the provided intent
-                        # Use intent instead of relying on the current sharer to avoid races
-                        is_sharer = data.get("intent") == "publish"
-
-                        answer = await sfu.handle_offer(room_id, user_id, data["sdp"], is_sharer)
-                        await manager.send_to_user(
-                            room_id, user_id, signal_message("sfu", {"type": "answer", "sdp": answer.sdp})
-                        )
-                    elif data.get("type") == "candidate":
-                        await sfu.handle_ice_candidate(user_id, data["candidate"])
-
-                elif target_id:
-                    await manager.send_to_user(room_id, target_id, signal_message(user_id, data))
-
-            elif msg_type == MessageType.START_SHARING:
-                sharer_id, sharer_name = await manager.set_sharer(room_id, user_id)
-                if sharer_id == user_id:
-                    await broadcast_sharer_changed(room_id, sharer_id, sharer_name)
-                else:
-                    await manager.send_to_user(room_id, user_id, sharer_changed_message(sharer_id, sharer_name))
-
-            elif msg_type == MessageType.STOP_SHARING:
-                current_sharer, _ = await manager.get_sharer(room_id)
-                await sfu.cleanup_user(room_id, user_id)
-                if current_sharer == user_id:
-                    await manager.set_sharer(room_id, None)
-                    await broadcast_sharer_changed(room_id, None, None)
-
-            elif msg_type == MessageType.PING:
-                await manager.update_heartbeat(room_id, user_id)
-                await manager.send_to_user(room_id, user_id, pong_message())
-
-            elif msg_type == MessageType.VOICE_SIGNAL:
-                target_id = message.get("target")
-                if target_id:
-                    await manager.send_to_user(room_id, target_id, voice_signal_message(user_id, message.get("data")))
-
-            elif msg_type == MessageType.VOICE_STATE:
-                muted = message.get("muted", False)
-                deafened = message.get("deafened", False)
-                await manager.update_voice_state(room_id, user_id, muted, deafened)
-                await manager.broadcast(room_id, voice_state_message(user_id, muted, deafened), exclude_id=user_id)
-
-            elif msg_type == MessageType.CALL_STATE:
-                in_call = message.get("inCall", False)
-                updated = await manager.update_call_state(room_id, user_id, in_call)
-                if updated:
-                    await manager.broadcast(room_id, call_state_message(user_id, in_call), exclude_id=None)
-                    await broadcast_user_list(room_id)
-
-            elif msg_type == MessageType.CHAT:
-                text = (message.get("text") or "").strip()
-                if text:
-                    username = message.get("username") or "Anonymous"
-                    ts = time.time()
-                    msg = chat_message(user_id, username, text[:400], ts)
-                    await manager.add_chat_message(room_id, msg)
-                    await manager.broadcast(room_id, msg)
-
-            elif msg_type == MessageType.WHITEBOARD_START:
-                # Optional: Check if someone else is already sharing screen or whiteboarding
-                # For now, we trust the clientstate, but we could enforce it here.
-                await manager.broadcast(room_id, whiteboard_start_message(user_id), exclude_id=user_id)
-
-            elif msg_type == MessageType.WHITEBOARD_STOP:
-                await manager.broadcast(room_id, whiteboard_stop_message(user_id), exclude_id=user_id)
-
-            elif msg_type == MessageType.WHITEBOARD_UPDATE:
-                data = message.get("data")
-                if data:
-                    await manager.broadcast(room_id, whiteboard_update_message(user_id, data), exclude_id=user_id)
-
-            elif msg_type == MessageType.WHITEBOARD_CURSOR:
-                data = message.get("data")
-                if data:
-                    # Get username from manager or message? Ideally manager has it.
-                    # check if we can get it from connection info, or just pass it through if client sends it.
-                    # Client sends it? `whiteboard.ts` sends data: {x,y}, no username.
-                    # But `websocket_endpoint` knows `user_id`. `manager` likely knows `username`.
-                    # Let's fetch username from the session or manager if possible, or just Anonymous if not found.
-                    # Optimization: Just pass what's needed. frontend `whiteboard.ts` expects `username` in the event.
-                    # We can get it from manager.
-                    # For speed, let's trust the client if they sent it? No, client doesn't send it in `data`.
-                    # We should look it up.
-                    # But that's an async call `manager.get_username`.
-                    # Let's try to get it.
-                    username = await manager.get_username(room_id, user_id) or "Anonymous"
-                    await manager.broadcast(
-                        room_id, whiteboard_cursor_message(user_id, data, username), exclude_id=user_id
-                    )
+    # every room lives on one worker; sockets that land elsewhere are forwarded to it
+    if cluster.owns(room_id):
+        await serve_session(websocket, room_id, user_id, binary, receive)
+    else:
+        await cluster.proxy(websocket, room_id, user_id, binary, receive)
+
+
+# expiry timers of sessions whose socket dropped, waiting to be resumed
+parked_sessions: set[asyncio.Task] = set()
 
+
+async def serve_session(websocket: WebSocket, room_id: str, user_id: str, binary: bool, receive: Receive):
+    try:
+        message = await receive()
     except WebSocketDisconnect:
-        pass
+        return
+    # a reconnecting client opens with resume and, if its session is still there, carries on where it left off
+    user = None
+    resuming = isinstance(message, dict) and message.get("type") == MessageType.RESUME
+    if resuming:
+        token, received = message.get("token"), message.get("seq")
+        if isinstance(token, str) and isinstance(received, int):
+            user = await manager.resume(room_id, user_id, token, websocket, received, binary=binary)
+        if user is None:
+            user = await manager.join_room(room_id, user_id, websocket, "Anonymous", binary=binary)
+            await manager.send_to_user(room_id, user_id, session_message(user.token, False))
+    else:
+        user = await manager.join_room(room_id, user_id, websocket, "Anonymous", binary=binary)
+    session = Session(room_id=room_id, user_id=user_id, user=user, websocket=websocket)
+
+    code = 1000
+    try:
+        if not resuming:
+            await router.dispatch(session, message)
+        while True:
+            await router.dispatch(session, await receive())
+
+    except WebSocketDisconnect as e:
+        code = e.code
+    except Exception:
+        # the client did nothing wrong, so it gets to resume
+        code = 1011
+        raise
     finally:
-        was_sharer = await manager.leave_room(room_id, user_id)
-        if manager.room_exists(room_id):
-            await broadcast_user_list(room_id)
-            if was_sharer:
-                await broadcast_sharer_changed(room_id, None, None)
+        cursors.remove_user(room_id, user_id)
+        # a resume moved the session onto another socket, which now owns it
+        if user.ws is websocket:
+            parked_at = None
+            if code not in CLEAN_CLOSE_CODES:
+                parked_at = await manager.park(room_id, user_id, user, websocket)
+            if parked_at is None:
+                await leave_session(room_id, user_id, user)
+            else:
+                task = asyncio.create_task(expire_parked_session(room_id, user_id, user, parked_at))
+                parked_sessions.add(task)
+                task.add_done_callback(parked_sessions.discard)
+
+
+async def expire_parked_session(room_id: str, user_id: str, user: User, parked_at: float):
+    await asyncio.sleep(RESUME_GRACE)
+    if user.parked_at == parked_at:
+        await leave_session(room_id, user_id, user)
+
+
+async def leave_session(room_id: str, user_id: str, user: User):
+    was_sharer = await manager.leave_room(room_id, user_id, user)
+    if was_sharer is None:
+        # already gone, or replaced by a newer connection that now owns the user's state
+        return
+    await user_removed(room_id, user_id, was_sharer)
+
+
+async def user_removed(room_id: str, user_id: str, was_sharer: bool):
+    """Whatever outlives a user taken out of the room, however they went: the roster and their call audio."""
+    if manager.room_exists(room_id):
+        await roster.user_left(room_id, user_id)
+        if was_sharer:
+            await broadcast_sharer_changed(room_id)
+    await sfu.cleanup_user(room_id, voice_peer(user_id))
+
+
+async def send_user_list(room_id: str, user_id: str):
+    frame = await manager.get_user_list_frame(room_id)
+    if frame is not None:
+        await manager.send_frame_to_user(room_id, user_id, frame)
 
 
-async def broadcast_user_list(room_id: str):
-    users = await manager.get_user_list(room_id)
-    await manager.broadcast(room_id, user_list_message(users))
+async def broadcast_sharer_changed(room_id: str):
+    frame = await manager.get_sharer_frame(room_id)
+    if frame is not None:
+        await manager.broadcast_frame(room_id, frame)
 
 
-async def broadcast_sharer_changed(room_id: str, sharer_id: str | None, sharer_name: str | None):
-    await manager.broadcast(room_id, sharer_changed_message(sharer_id, sharer_name))
+@app.get("/metrics")
+async def metrics():
+    manager.collect_metrics()
+    handshakes.collect_metrics()
+    record_peer_stats(await sfu.get_peer_stats())
+    if SFU_WORKERS:
+        sfu_worker_load.replace([({"worker": str(i)}, load) for i, load in enumerate(sfu.get_worker_loads())])
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/new-room")
@@ -218,7 +427,8 @@ async def get_turn_credentials(request: Request):
 
 
 if STATIC_DIR.exists():
-    app.mount("/", StaticFiles(directory=str(STATIC_DIR), html=True), name="static")
+    # loaded into memory once here, so page loads cost the event loop next to nothing
+    app.mount("/", StaticBundle(STATIC_DIR), name="static")
 
 if __name__ == "__main__":
     import uvicorn
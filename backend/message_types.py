@@ -1,16 +1,24 @@
+import struct
 from enum import Enum
 
+# Offered by clients in Sec-WebSocket-Protocol to receive the hot message types below as binary frames.
+# Everything else keeps flowing as JSON text on the same socket.
+BINARY_SUBPROTOCOL = "purestream.bin"
+
 
 class MessageType(str, Enum):
     JOIN = "join"
     SIGNAL = "signal"
     USER_LIST = "user-list"
+    USER_JOINED = "user-joined"
+    USER_LEFT = "user-left"
+    USER_UPDATED = "user-updated"
+    ROSTER_SYNC = "roster-sync"
     SHARER_CHANGED = "sharer-changed"
     START_SHARING = "start-sharing"
     STOP_SHARING = "stop-sharing"
     PING = "ping"
     PONG = "pong"
-    VOICE_SIGNAL = "voice-signal"
     VOICE_STATE = "voice-state"
     CHAT = "chat"
     CALL_STATE = "call-state"
@@ -19,10 +27,26 @@ class MessageType(str, Enum):
     WHITEBOARD_STOP = "whiteboard-stop"
     WHITEBOARD_UPDATE = "whiteboard-update"
     WHITEBOARD_CURSOR = "whiteboard-cursor"
+    WHITEBOARD_CURSORS = "whiteboard-cursors"
+    WHITEBOARD_SNAPSHOT = "whiteboard-snapshot"
+    RESUME = "resume"
+    SESSION = "session"
+
+
+def user_list_message(users: list, seq: int) -> dict:
+    return {"type": MessageType.USER_LIST, "users": users, "seq": seq}
+
+
+def user_joined_message(user: dict, seq: int) -> dict:
+    return {"type": MessageType.USER_JOINED, "user": user, "seq": seq}
+
 
+def user_left_message(user_id: str, seq: int) -> dict:
+    return {"type": MessageType.USER_LEFT, "userId": user_id, "seq": seq}
 
-def user_list_message(users: list) -> dict:
-    return {"type": MessageType.USER_LIST, "users": users}
+
+def user_updated_message(user: dict, seq: int) -> dict:
+    return {"type": MessageType.USER_UPDATED, "user": user, "seq": seq}
 
 
 def sharer_changed_message(sharer_id: str | None, sharer_name: str | None) -> dict:
@@ -37,10 +61,6 @@ def pong_message() -> dict:
     return {"type": MessageType.PONG}
 
 
-def voice_signal_message(sender_id: str, data: dict) -> dict:
-    return {"type": MessageType.VOICE_SIGNAL, "sender": sender_id, "data": data}
-
-
 def voice_state_message(user_id: str, muted: bool, deafened: bool, in_call: bool | None = None) -> dict:
     return {"type": MessageType.VOICE_STATE, "userId": user_id, "muted": muted, "deafened": deafened, "inCall": in_call}
 
@@ -53,8 +73,12 @@ def call_state_message(user_id: str, in_call: bool) -> dict:
     return {"type": MessageType.CALL_STATE, "userId": user_id, "inCall": in_call}
 
 
-def chat_history_message(messages: list[dict]) -> dict:
-    return {"type": MessageType.CHAT_HISTORY, "messages": messages}
+def chat_history_message(messages: list[dict], before: int | None = None, has_more: bool = False) -> dict:
+    return {"type": MessageType.CHAT_HISTORY, "before": before, "hasMore": has_more, "messages": messages}
+
+
+def session_message(token: str, resumed: bool) -> dict:
+    return {"type": MessageType.SESSION, "token": token, "resumed": resumed}
 
 
 def whiteboard_start_message(sender_id: str) -> dict:
@@ -69,5 +93,92 @@ def whiteboard_update_message(sender_id: str, data: dict) -> dict:
     return {"type": MessageType.WHITEBOARD_UPDATE, "sender": sender_id, "data": data}
 
 
-def whiteboard_cursor_message(sender_id: str, data: dict, username: str) -> dict:
-    return {"type": MessageType.WHITEBOARD_CURSOR, "sender": sender_id, "data": data, "username": username}
+def whiteboard_cursors_message(cursors: list[dict]) -> dict:
+    return {"type": MessageType.WHITEBOARD_CURSORS, "cursors": cursors}
+
+
+def whiteboard_snapshot_message(sender_id: str | None, objects: list[dict]) -> dict:
+    return {"type": MessageType.WHITEBOARD_SNAPSHOT, "sender": sender_id, "objects": objects}
+
+
+class BinaryOp(int, Enum):
+    PING = 0x01
+    PONG = 0x02
+    CURSOR = 0x03
+    CURSORS = 0x04
+
+
+_OP = struct.Struct("!B")
+_POINT = struct.Struct("!ff")
+_COUNT = struct.Struct("!H")
+_PING_FRAME = _OP.pack(BinaryOp.PING)
+_PONG_FRAME = _OP.pack(BinaryOp.PONG)
+
+
+def _pack_str(value: str) -> bytes:
+    raw = value.encode()[:255]
+    return _OP.pack(len(raw)) + raw
+
+
+def _unpack_str(data: bytes, offset: int) -> tuple[str, int]:
+    (length,) = _OP.unpack_from(data, offset)
+    offset += 1
+    return data[offset : offset + length].decode(errors="replace"), offset + length
+
+
+def encode_binary(message: dict) -> bytes | None:
+    """Binary form of ``message`` for clients on BINARY_SUBPROTOCOL, or None if it has none.
+
+    Layouts (network byte order), each starting with a one-byte BinaryOp:
+      ping / pong:  op
+      cursor:       op, x f32, y f32
+      cursors:      op, count u16, then per cursor: sender (u8 len + utf-8), username (u8 len + utf-8), x f32, y f32
+    """
+    msg_type = message.get("type")
+    if msg_type == MessageType.PONG:
+        return _PONG_FRAME
+    if msg_type == MessageType.PING:
+        return _PING_FRAME
+    try:
+        if msg_type == MessageType.WHITEBOARD_CURSOR:
+            data = message["data"]
+            return _OP.pack(BinaryOp.CURSOR) + _POINT.pack(data["x"], data["y"])
+        if msg_type == MessageType.WHITEBOARD_CURSORS:
+            cursors = message["cursors"]
+            parts = [_OP.pack(BinaryOp.CURSORS), _COUNT.pack(len(cursors))]
+            for cursor in cursors:
+                parts.append(_pack_str(cursor["sender"]))
+                parts.append(_pack_str(cursor["username"]))
+                parts.append(_POINT.pack(cursor["data"]["x"], cursor["data"]["y"]))
+            return b"".join(parts)
+    except (KeyError, TypeError, struct.error):
+        # cursor payloads come from clients; anything malformed just stays JSON-only
+        return None
+    return None
+
+
+def decode_binary(data: bytes) -> dict:
+    """Inverse of encode_binary. Raises ValueError on unknown or truncated frames."""
+    try:
+        (op,) = _OP.unpack_from(data, 0)
+        if op == BinaryOp.PING:
+            return {"type": MessageType.PING}
+        if op == BinaryOp.PONG:
+            return pong_message()
+        if op == BinaryOp.CURSOR:
+            x, y = _POINT.unpack_from(data, 1)
+            return {"type": MessageType.WHITEBOARD_CURSOR, "data": {"x": x, "y": y}}
+        if op == BinaryOp.CURSORS:
+            (count,) = _COUNT.unpack_from(data, 1)
+            offset = 1 + _COUNT.size
+            cursors = []
+            for _ in range(count):
+                sender, offset = _unpack_str(data, offset)
+                username, offset = _unpack_str(data, offset)
+                x, y = _POINT.unpack_from(data, offset)
+                offset += _POINT.size
+                cursors.append({"sender": sender, "username": username, "data": {"x": x, "y": y}})
+            return whiteboard_cursors_message(cursors)
+    except struct.error as e:
+        raise ValueError(f"Truncated binary frame: {e}") from e
+    raise ValueError(f"Unknown binary opcode: {op}")
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+# seconds; tuned for in-process handler work, from 100 µs up to a slow SFU handshake
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: dict[tuple, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        self._values[tuple(sorted(labels.items()))] += amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+
+class Gauge:
+    """A value sampled when metrics are collected; ``replace`` swaps every label set at once, so gone peers vanish."""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def replace(self, samples: list[tuple[dict, float]]) -> None:
+        self._values = {tuple(sorted(labels.items())): value for labels, value in samples}
+
+    def value(self, **labels: str) -> float | None:
+        return self._values.get(tuple(sorted(labels.items())))
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # per label set: [count per bucket..., +Inf count], sum
+        self._counts: dict[tuple, list[int]] = {}
+        self._sums: dict[tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def count(self, **labels: str) -> int:
+        return sum(self._counts.get(tuple(sorted(labels.items())), ()))
+
+    def quantile(self, q: float, **labels: str) -> float | None:
+        """Upper bound of the bucket holding the q-th observation; None without data."""
+        counts = self._counts.get(tuple(sorted(labels.items())))
+        if not counts:
+            return None
+        rank = q * sum(counts)
+        seen = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class TimedLock(asyncio.Lock):
+    """An asyncio.Lock that records how long each acquire waited."""
+
+    def __init__(self, histogram: Histogram, **labels: str):
+        super().__init__()
+        self._histogram = histogram
+        self._labels = labels
+
+    async def acquire(self) -> bool:
+        if not self.locked():
+            # uncontended: the base class returns without yielding, so there is no wait to time
+            self._histogram.observe(0.0, **self._labels)
+            return await super().acquire()
+        started = time.perf_counter()
+        try:
+            return await super().acquire()
+        finally:
+            self._histogram.observe(time.perf_counter() - started, **self._labels)
+
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str, quotes: bool = True) -> str:
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def counter(self, name: str, description: str) -> Counter:
+        if name not in self._metrics:
+            self._metrics[name] = Counter(name, description)
+        return self._metrics[name]
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        if name not in self._metrics:
+            self._metrics[name] = Gauge(name, description)
+        return self._metrics[name]
+
+    def histogram(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, description, buckets)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format, version 0.0.4."""
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {_escape(metric.description, quotes=False)}")
+            if isinstance(metric, Histogram):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, counts in sorted(metric._counts.items()):
+                    cumulative = 0
+                    for bound, n in zip(metric.buckets + (float("inf"),), counts):
+                        cumulative += n
+                        le = f'le="{_format_value(bound)}"'
+                        lines.append(f"{name}_bucket{_format_labels(labels, le)} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(metric._sums[labels])}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+            else:
+                lines.append(f"# TYPE {name} {'counter' if isinstance(metric, Counter) else 'gauge'}")
+                for labels, value in sorted(metric._values.items()):
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
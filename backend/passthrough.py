@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import os
+import queue
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from fractions import Fraction
+from typing import Callable
+
+import av
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCRtpReceiver, RTCRtpSender, RTCRtpTransceiver
+from aiortc.codecs import is_rtx
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
+from aiortc.rtp import RTCP_PSFB_FIR, RTCP_PSFB_PLI, RtcpPsfbPacket
+from metrics import registry
+
+logger = logging.getLogger("passthrough")
+
+# at most one keyframe request per sharer stream in this window, however many viewers ask
+KEYFRAME_REQUEST_INTERVAL = int(os.getenv("KEYFRAME_REQUEST_INTERVAL_MS", "1000")) / 1000
+# frames since the last keyframe kept for late joiners; a longer GOP is not cached until the next keyframe
+GOP_CACHE_FRAMES = 300
+GOP_CACHE_BYTES = 4 * 1024 * 1024
+
+keyframe_requests = registry.counter("sfu_keyframe_requests_total", "Keyframe requests by outcome")
+
+H264_START_CODE = b"\x00\x00\x01"
+H264_KEYFRAME_NAL_TYPES = (5, 7)  # IDR slice, sequence parameter set
+
+
+def is_keyframe(mime_type: str, data: bytes) -> bool:
+    codec = mime_type.lower()
+    if codec == "video/vp8":
+        # inverse key frame flag in the first byte of the VP8 frame header, RFC 6386 section 9.1
+        return bool(data) and not data[0] & 0x01
+    if codec == "video/h264":
+        # aiortc depayloads H.264 to an Annex B bitstream; keyframes lead with an SPS or an IDR slice
+        pos = data.find(H264_START_CODE)
+        while pos != -1 and pos + 3 < len(data):
+            if data[pos + 3] & 0x1F in H264_KEYFRAME_NAL_TYPES:
+                return True
+            pos = data.find(H264_START_CODE, pos + 3)
+        return False
+    # audio frames decode independently
+    return True
+
+
+class GopCache:
+    """The frames since the last keyframe, so a new viewer can start decoding without waiting for another."""
+
+    def __init__(self, max_frames: int = GOP_CACHE_FRAMES, max_bytes: int = GOP_CACHE_BYTES):
+        self._max_frames = max_frames
+        self._max_bytes = max_bytes
+        self._frames: list[av.Packet] = []
+        self._bytes = 0
+
+    def add(self, packet: av.Packet) -> None:
+        if packet.is_keyframe:
+            self._frames = [packet]
+            self._bytes = packet.size
+        elif self._frames:
+            if len(self._frames) >= self._max_frames or self._bytes + packet.size > self._max_bytes:
+                self._frames = []
+                self._bytes = 0
+            else:
+                self._frames.append(packet)
+                self._bytes += packet.size
+
+    def frames_before(self, packet: av.Packet) -> list[av.Packet] | None:
+        """The cached run from the keyframe up to ``packet``, or None when ``packet`` is not in this GOP."""
+        for i, cached in enumerate(self._frames):
+            if cached is packet:
+                return self._frames[:i]
+        return None
+
+
+class KeyframeRequester:
+    """Coalesces keyframe requests for one sharer stream to at most one per interval.
+
+    A request inside the interval is held back and sent when it ends, unless a keyframe that satisfies it
+    arrives first.
+    """
+
+    def __init__(self, send: Callable[[], None], interval: float = KEYFRAME_REQUEST_INTERVAL):
+        self._send = send
+        self._interval = interval
+        self._last_sent = float("-inf")
+        self._timer: asyncio.TimerHandle | None = None
+
+    def request(self) -> None:
+        if self._timer is not None:
+            keyframe_requests.inc(outcome="coalesced")
+            return
+        wait = self._last_sent + self._interval - time.monotonic()
+        if wait <= 0:
+            self._flush()
+        else:
+            keyframe_requests.inc(outcome="coalesced")
+            self._timer = asyncio.get_running_loop().call_later(wait, self._flush)
+
+    def keyframe_received(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def close(self) -> None:
+        self.keyframe_received()
+
+    def _flush(self) -> None:
+        self._timer = None
+        self._last_sent = time.monotonic()
+        keyframe_requests.inc(outcome="sent")
+        self._send()
+
+
+class EncodedTrack(MediaStreamTrack):
+    """Reassembled but still encoded frames of one incoming stream, as av.Packets ready for encoder.pack.
+
+    The GOP cache is updated as frames are read rather than as they arrive. The relay fans a frame out in the
+    same step it reads it, so the cache always holds exactly what subscribers have been offered.
+    """
+
+    def __init__(self, kind: str):
+        super().__init__()
+        self.kind = kind
+        self.cache = GopCache()
+        self.on_keyframe: Callable[[], None] | None = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def push(self, codec, frame) -> None:
+        packet = av.Packet(frame.data)
+        packet.pts = frame.timestamp
+        packet.time_base = Fraction(1, codec.clockRate)
+        packet.is_keyframe = is_keyframe(codec.mimeType, frame.data)
+        self._queue.put_nowait(packet)
+
+    def end(self) -> None:
+        self._queue.put_nowait(None)
+
+    async def recv(self) -> av.Packet:
+        if self.readyState != "live":
+            raise MediaStreamError
+        packet = await self._queue.get()
+        if packet is None:
+            self.stop()
+            raise MediaStreamError
+        self.cache.add(packet)
+        if packet.is_keyframe and self.on_keyframe is not None:
+            self.on_keyframe()
+        return packet
+
+
+class EncodedFrameTap(queue.Queue):
+    """Takes the place of an RTCRtpReceiver's decoder queue and hands every frame to an EncodedTrack.
+
+    Frames continue on to the decoder thread only while ``decode`` is set, that is while at least one
+    viewer negotiated a different codec and has to be served by transcoding.
+    """
+
+    def __init__(self, track: EncodedTrack):
+        super().__init__()
+        self.track = track
+        self.decode = False
+
+    def put(self, item, block: bool = True, timeout: float | None = None) -> None:
+        if item is None:
+            self.track.end()
+            super().put(item, block, timeout)
+            return
+        codec, frame = item
+        self.track.push(codec, frame)
+        if self.decode:
+            super().put(item, block, timeout)
+
+
+@dataclass
+class MediaSource:
+    """One track the sharer publishes, readable as encoded packets for pass-through or as decoded frames."""
+
+    kind: str
+    receiver: RTCRtpReceiver | None
+    decoded: MediaStreamTrack
+    encoded: MediaStreamTrack | None = None
+    codec: str | None = None
+    tap: EncodedFrameTap | None = None
+    requester: KeyframeRequester = field(init=False)
+
+    def __post_init__(self):
+        self.requester = KeyframeRequester(self._send_pli)
+
+    def track_for(self, codec: str | None) -> MediaStreamTrack:
+        if self.encoded is not None and codec is not None and codec.lower() == (self.codec or "").lower():
+            return self.encoded
+        if self.tap is not None and not self.tap.decode:
+            logger.info(f"Transcoding {self.codec} for a viewer that negotiated {codec}")
+            self.tap.decode = True
+            # the decoder starts cold and needs a keyframe before it can produce anything
+            self.request_keyframe()
+        return self.decoded
+
+    def catch_up(self, frame) -> list | None:
+        """What to send a viewer whose first frame is ``frame``, or None if it has to wait for a keyframe."""
+        if getattr(frame, "is_keyframe", True):
+            return [frame]
+        prefix = self.tap.track.cache.frames_before(frame) if self.tap is not None else None
+        return prefix + [frame] if prefix else None
+
+    def request_keyframe(self) -> None:
+        if self.kind == "video" and self.receiver is not None:
+            self.requester.request()
+
+    def _send_pli(self) -> None:
+        if not hasattr(self.receiver, "_send_rtcp_pli"):
+            return
+        for source in self.receiver.getSynchronizationSources():
+            asyncio.ensure_future(self.receiver._send_rtcp_pli(source.source))
+
+
+def negotiated_codec(transceiver: RTCRtpTransceiver | None) -> str | None:
+    for codec in getattr(transceiver, "_codecs", None) or []:
+        if not is_rtx(codec):
+            return codec.mimeType
+    return None
+
+
+def viewer_codec(pc: RTCPeerConnection | None, sender: RTCRtpSender | None) -> str | None:
+    if pc is None or sender is None:
+        return None
+    return negotiated_codec(next((t for t in pc.getTransceivers() if t.sender is sender), None))
+
+
+def open_source(pc: RTCPeerConnection, track: MediaStreamTrack) -> MediaSource:
+    """Wraps an incoming track; must run from the track event, before the receiver starts its decoder."""
+    transceiver = next((t for t in pc.getTransceivers() if t.receiver.track is track), None)
+    receiver = transceiver.receiver if transceiver else None
+    source = MediaSource(kind=track.kind, receiver=receiver, decoded=track, codec=negotiated_codec(transceiver))
+    if source.codec is not None and hasattr(receiver, "_RTCRtpReceiver__decoder_queue"):
+        source.encoded = EncodedTrack(track.kind)
+        source.encoded.on_keyframe = source.requester.keyframe_received
+        source.tap = EncodedFrameTap(source.encoded)
+        receiver._RTCRtpReceiver__decoder_queue = source.tap
+    else:
+        logger.warning(f"No pass-through for {track.kind} track, every viewer will be transcoded")
+    return source
+
+
+def forward_keyframe_requests(sender: RTCRtpSender, request: Callable[[], None]) -> None:
+    """Passes a viewer's PLI/FIR on to ``request``. The sender alone would only flag its unused encoder."""
+    handle_rtcp = getattr(sender, "_handle_rtcp_packet", None)
+    if handle_rtcp is None:
+        logger.warning("Cannot see this viewer's keyframe requests, it waits for the sharer's own keyframes")
+        return
+
+    async def handle(packet) -> None:
+        if isinstance(packet, RtcpPsfbPacket) and packet.fmt in (RTCP_PSFB_PLI, RTCP_PSFB_FIR):
+            request()
+        await handle_rtcp(packet)
+
+    sender._handle_rtcp_packet = handle
+
+
+class ForwardingTrack(MediaStreamTrack):
+    """A viewer's copy of a source. It carries encoded packets if the viewer negotiated the sharer's codec.
+
+    The source is picked on the first recv, once negotiation has settled the viewer's codec. The viewer
+    starts from the cached GOP when the stream is mid-GOP, or else from the next keyframe.
+
+    The track lives as long as the viewer's connection. When the source ends it waits for ``published`` and
+    picks up whatever ``resolve`` returns next, so the sender keeps running across sharers.
+    """
+
+    def __init__(
+        self,
+        relay: MediaRelay,
+        resolve: Callable[[], MediaSource | None],
+        published: asyncio.Event,
+        pc: RTCPeerConnection | None,
+        kind: str,
+    ):
+        super().__init__()
+        self.kind = kind
+        self.sender: RTCRtpSender | None = None
+        self._relay = relay
+        self._resolve = resolve
+        self._published = published
+        self._pc = pc
+        self._source: MediaSource | None = None
+        self._track: MediaStreamTrack | None = None
+        self._synced = False
+        self._replay: deque = deque()
+        self._forwarding = False
+
+    def _request_keyframe(self) -> None:
+        if self._source is not None:
+            self._source.request_keyframe()
+
+    async def _subscribe(self) -> None:
+        while (source := self._resolve()) is None:
+            await self._published.wait()
+        self._source = source
+        self._track = self._relay.subscribe(source.track_for(viewer_codec(self._pc, self.sender)))
+        self._synced = False
+
+    async def recv(self):
+        if self._replay:
+            return self._replay.popleft()
+        if not self._forwarding and self.sender is not None:
+            forward_keyframe_requests(self.sender, self._request_keyframe)
+            self._forwarding = True
+        while True:
+            if self._track is None:
+                await self._subscribe()
+            try:
+                frame = await self._track.recv()
+            except MediaStreamError:
+                # the sharer stopped; stay attached to the viewer and wait for whoever shares next
+                self._track.stop()
+                self._source = self._track = None
+                continue
+            if self._synced:
+                return frame
+            frames = self._source.catch_up(frame)
+            if frames is None:
+                self._source.request_keyframe()
+                continue
+            self._synced = True
+            self._replay.extend(frames[1:])
+            return frames[0]
+
+    def stop(self) -> None:
+        super().stop()
+        if self._track is not None:
+            self._track.stop()
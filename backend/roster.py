@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+from connection_manager import ConnectionManager, manager
+from metrics import registry
+
+USER_LIST_DEBOUNCE = float(os.getenv("USER_LIST_DEBOUNCE_MS", "75")) / 1000
+
+roster_flushes = registry.counter("roster_flushes_total", "Batches of roster changes sent to a room")
+roster_merged = registry.counter("roster_merged_total", "Roster changes folded into an already pending batch")
+
+
+class RosterScheduler:
+    """Batches roster changes per room and sends them as seq-numbered deltas once per window.
+
+    A join storm therefore costs one flush per window instead of one full user-list per event, and each
+    flush only carries the users that changed.
+    """
+
+    def __init__(self, manager: ConnectionManager, window: float = USER_LIST_DEBOUNCE):
+        self._manager = manager
+        self._window = window
+        # room_id -> {user_id: joined}; joined sticks once set so join-then-update still reads as a join
+        self._changes: dict[str, dict[str, bool]] = {}
+        self._pending: dict[str, asyncio.Task] = {}
+
+    async def user_joined(self, room_id: str, user_id: str) -> None:
+        await self._record(room_id, user_id, True)
+
+    async def user_updated(self, room_id: str, user_id: str) -> None:
+        await self._record(room_id, user_id, False)
+
+    async def user_left(self, room_id: str, user_id: str) -> None:
+        await self._record(room_id, user_id, False)
+
+    async def _record(self, room_id: str, user_id: str, joined: bool) -> None:
+        changes = self._changes.setdefault(room_id, {})
+        changes[user_id] = changes.get(user_id, False) or joined
+
+        if self._window <= 0:
+            await self._flush(room_id)
+            return
+        if room_id in self._pending:
+            roster_merged.inc()
+            return
+        self._pending[room_id] = asyncio.create_task(self._flush_later(room_id))
+
+    async def _flush_later(self, room_id: str) -> None:
+        try:
+            await asyncio.sleep(self._window)
+        finally:
+            self._pending.pop(room_id, None)
+        await self._flush(room_id)
+
+    async def _flush(self, room_id: str) -> None:
+        changes = self._changes.pop(room_id, None)
+        if not changes:
+            return
+        frames = await self._manager.get_roster_frames(room_id, changes)
+        if frames:
+            roster_flushes.inc()
+        for frame in frames:
+            await self._manager.broadcast_frame(room_id, frame)
+
+    async def close(self) -> None:
+        tasks = list(self._pending.values())
+        self._pending.clear()
+        self._changes.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+roster = RosterScheduler(manager)
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from enum import Enum
+
+from encoding import Frame
+from fastapi import WebSocket
+from message_types import MessageType
+
+logger = logging.getLogger("send_queue")
+
+SEND_QUEUE_SIZE = 256
+SLOW_CONSUMER_TIMEOUT = 5.0
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# frames kept after sending, so a client that reconnects can be sent what its old socket lost
+REPLAY_BUFFER_SIZE = int(os.getenv("RESUME_REPLAY_FRAMES", "256"))
+# queue key of a resumed session's greeting; unlike a new session's, it carries on the numbering
+_RESUMED = "session-resumed"
+
+
+class OverflowPolicy(Enum):
+    # a full queue with nothing to evict closes the connection
+    DISCONNECT = "disconnect"
+    # frames are disposable; the oldest queued one of any such type is evicted first
+    DROP_OLDEST = "drop-oldest"
+    # only the latest frame of this type matters; a queued one is replaced in place
+    COALESCE = "coalesce"
+
+
+DEFAULT_OVERFLOW_POLICIES: dict[str, OverflowPolicy] = {
+    MessageType.WHITEBOARD_CURSORS: OverflowPolicy.DROP_OLDEST,
+    MessageType.USER_LIST: OverflowPolicy.COALESCE,
+}
+
+
+class SendQueue:
+    """Bounded outbound queue drained by a dedicated writer task, one per connection.
+
+    With a replay buffer, the queue outlives its socket: frames after the session frame are numbered as they are
+    sent, the last ``replay_size`` of them are kept, and ``reattach`` carries on over a new socket from wherever
+    the client says it got to. Without one, a failed send ends the queue.
+    """
+
+    def __init__(
+        self,
+        ws: WebSocket,
+        max_size: int = SEND_QUEUE_SIZE,
+        slow_consumer_timeout: float = SLOW_CONSUMER_TIMEOUT,
+        policies: dict[str, OverflowPolicy] | None = None,
+        binary: bool = False,
+        replay_size: int = 0,
+    ):
+        self._ws = ws
+        self._binary = binary
+        self._max_size = max_size
+        self._slow_consumer_timeout = slow_consumer_timeout
+        self._policies = DEFAULT_OVERFLOW_POLICIES if policies is None else policies
+        # entries are [msg_type, frame] lists so coalescing can swap the frame in place
+        self._frames: deque[list] = deque()
+        self._coalesced: dict[str, list] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closed = False
+        self._close_reason: str | None = None
+        self._saturated_since: float | None = None
+        self.dropped = 0
+        # frames sent since the session frame, the sequence number of the last one
+        self.sent = 0
+        self._sequenced = False
+        self._replay: deque[tuple[int, Frame]] | None = deque(maxlen=replay_size) if replay_size else None
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def put(self, frame: Frame) -> bool:
+        if self._closed:
+            return False
+
+        msg_type = frame.type
+        policy = self._policies.get(msg_type, OverflowPolicy.DISCONNECT)
+        if policy is OverflowPolicy.COALESCE:
+            pending = self._coalesced.get(msg_type)
+            if pending is not None:
+                pending[1] = frame
+                return True
+
+        if len(self._frames) >= self._max_size:
+            now = time.monotonic()
+            if self._saturated_since is None:
+                self._saturated_since = now
+            elif now - self._saturated_since > self._slow_consumer_timeout:
+                self._shutdown("slow consumer")
+                return False
+
+            if not self._evict():
+                if policy is OverflowPolicy.DROP_OLDEST:
+                    self.dropped += 1
+                    return True
+                self._shutdown("send queue overflow")
+                return False
+
+        entry = [msg_type, frame]
+        self._frames.append(entry)
+        if policy is OverflowPolicy.COALESCE:
+            self._coalesced[msg_type] = entry
+        self._wakeup.set()
+        return True
+
+    def _evict(self) -> bool:
+        for i, (msg_type, _) in enumerate(self._frames):
+            if self._policies.get(msg_type) is OverflowPolicy.DROP_OLDEST:
+                del self._frames[i]
+                self.dropped += 1
+                return True
+        return False
+
+    def _shutdown(self, reason: str) -> None:
+        self._closed = True
+        self._close_reason = reason
+        self._frames.clear()
+        self._coalesced.clear()
+        self._wakeup.set()
+
+    async def close(self) -> None:
+        self._closed = True
+        self._frames.clear()
+        self._coalesced.clear()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def reattach(self, ws: WebSocket, binary: bool, received: int, hello: Frame) -> bool:
+        """Continue on ``ws`` after the client's first ``received`` frames; False if those cannot be replayed.
+
+        ``hello`` goes first, then the frames the client missed, then whatever was still queued.
+        """
+        replayed = len(self._replay) if self._replay is not None else 0
+        if self._closed or not self.sent - replayed <= received <= self.sent:
+            return False
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        missed = []
+        while self._replay and self._replay[-1][0] > received:
+            missed.append(self._replay.pop()[1])
+        # they are numbered again as they go out, from where the client left off
+        self.sent = received
+        self._frames.extendleft([frame.type, frame] for frame in missed)
+        self._frames.appendleft([_RESUMED, hello])
+        self._ws = ws
+        self._binary = binary
+        self._wakeup.set()
+        self.start()
+        return True
+
+    async def _send(self, frame: Frame) -> None:
+        if self._binary and frame.binary is not None:
+            await self._ws.send_bytes(frame.binary)
+        else:
+            await self._ws.send_text(frame.text)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self._frames:
+                entry = self._frames.popleft()
+                if self._coalesced.get(entry[0]) is entry:
+                    del self._coalesced[entry[0]]
+                if entry[0] == MessageType.SESSION:
+                    # the client counts what it receives from here on
+                    self.sent = 0
+                    self._sequenced = True
+                    if self._replay is not None:
+                        self._replay.clear()
+                elif self._sequenced and entry[0] != _RESUMED:
+                    self.sent += 1
+                    if self._replay is not None:
+                        self._replay.append((self.sent, entry[1]))
+                # asyncio.wait rather than wait_for: on 3.10/3.11 wait_for can swallow our own cancellation
+                send = asyncio.ensure_future(self._send(entry[1]))
+                try:
+                    done, _ = await asyncio.wait((send,), timeout=self._slow_consumer_timeout)
+                finally:
+                    if not send.done():
+                        send.cancel()
+                if not done:
+                    self._shutdown("slow consumer")
+                    break
+                try:
+                    send.result()
+                except Exception as e:
+                    logger.info(f"Send failed, stopping writer: {e!r}")
+                    if self._replay is None:
+                        self._closed = True
+                        self._frames.clear()
+                        self._coalesced.clear()
+                    # otherwise frames keep queueing, bounded as usual, in case the client reattaches
+                    return
+                if self._saturated_since is not None and len(self._frames) < self._max_size // 2:
+                    self._saturated_since = None
+
+            if self._close_reason is not None:
+                logger.warning(f"Closing connection: {self._close_reason}")
+                try:
+                    await self._ws.close(code=SLOW_CONSUMER_CLOSE_CODE, reason=self._close_reason)
+                except Exception:
+                    pass
+                return
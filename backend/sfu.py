@@ -1,26 +1,90 @@
+import asyncio
 import logging
+import time
 from dataclasses import dataclass, field
 from enum import Enum
 from typing import Dict, List, Optional, Set
 
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.contrib.media import MediaRelay
-from aiortc.sdp import candidate_from_sdp
+from aiortc.sdp import SessionDescription, candidate_from_sdp
+from aiortc.stats import (
+    RTCInboundRtpStreamStats,
+    RTCOutboundRtpStreamStats,
+    RTCRemoteInboundRtpStreamStats,
+    RTCRemoteOutboundRtpStreamStats,
+)
+from ice import CandidateBuffer, ice_candidates
+from passthrough import ForwardingTrack, MediaSource, open_source
+from sfu_loader import SignalHandler, voice_user
+from simulcast import LayerSelectorTrack, TimelineTrack, VideoLayer
+from speakers import VOICE_SPEAKERS, SpeakerSlotTrack, VoiceRoom, watch_audio_levels
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("sfu")
 
 
+VIEWER_TRACK_KINDS = {"video", "audio"}
+
+
 class UserRole(Enum):
     SHARER = "sharer"
     VIEWER = "viewer"
+    VOICE = "voice"
+
+
+class NegotiationState(Enum):
+    """Where a user's peer connection is, as far as its ICE candidates are concerned.
+
+    A user with no connection yet has its candidates held in the manager's CandidateBuffer. A connection
+    starts NEGOTIATING, and candidates keep being buffered. Once the offer is applied and answered it is
+    ESTABLISHED: the buffer is applied in one batch and later candidates go straight to ICE. CLOSED
+    connections take no more candidates.
+    """
+
+    NEGOTIATING = "negotiating"
+    ESTABLISHED = "established"
+    CLOSED = "closed"
 
 
 @dataclass
 class RoomMedia:
-    sharer_id: str
-    video_track: Optional[object] = None
-    audio_track: Optional[object] = None
+    """What the room's current sharer publishes. It outlives sharers, as viewers' tracks stay attached to it."""
+
+    sharer_id: Optional[str] = None
+    # best first; viewers' selector tracks hold this same list
+    video_layers: List[VideoLayer] = field(default_factory=list)
+    audio: Optional[MediaSource] = None
+    # kept across sharers, so a viewer's timestamps keep increasing when the next sharer starts
+    origin: float = field(default_factory=time.monotonic)
+    video_published: asyncio.Event = field(default_factory=asyncio.Event)
+    audio_published: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def video_track(self) -> Optional[object]:
+        return self.video_layers[0].source.decoded if self.video_layers else None
+
+    @property
+    def audio_track(self) -> Optional[object]:
+        return self.audio.decoded if self.audio else None
+
+    def add_video_layer(self, layer: VideoLayer) -> None:
+        self.video_layers.append(layer)
+        self.video_layers.sort(key=lambda layer: -layer.bitrate if layer.bitrate is not None else float("-inf"))
+        self.video_published.set()
+
+    def set_audio(self, source: MediaSource) -> None:
+        self.audio = source
+        self.audio_published.set()
+
+    def clear(self) -> List[MediaSource]:
+        """Forgets the sharer and returns its sources; viewers go quiet until the next sharer publishes."""
+        sources = [layer.source for layer in self.video_layers] + ([self.audio] if self.audio else [])
+        self.sharer_id = None
+        self.video_layers.clear()
+        self.audio = None
+        self.video_published.clear()
+        self.audio_published.clear()
+        return sources
 
     def has_tracks(self) -> bool:
         return self.video_track is not None or self.audio_track is not None
@@ -32,7 +96,14 @@ class UserConnection:
     room_id: str
     peer_connection: RTCPeerConnection
     role: UserRole
-    pending_ice_candidates: List[dict] = field(default_factory=list)
+    state: NegotiationState = NegotiationState.NEGOTIATING
+    # sharer: mid -> (rid, bitrate) of each published layer; viewer: the track choosing among them
+    layers: Dict[str, tuple] = field(default_factory=dict)
+    selector: Optional[LayerSelectorTrack] = None
+    # voice: the tracks carrying the call's active speakers to this user
+    slots: List[SpeakerSlotTrack] = field(default_factory=list)
+    # an offer was due while another was outstanding; sent once the answer arrives
+    renegotiation_pending: bool = False
 
 
 class SFUManager:
@@ -41,10 +112,18 @@ class SFUManager:
         self._rooms: Dict[str, Set[str]] = {}  # room_id -> set of user_ids
         self._relay = MediaRelay()
         self._room_media: Dict[str, RoomMedia] = {}
+        self._voice: Dict[str, VoiceRoom] = {}
+        self._candidates = CandidateBuffer()
+        # (user, ssrc, direction) -> (bytes, time) at the previous get_peer_stats, for bitrates
+        self._byte_samples: Dict[tuple, tuple] = {}
+        # sends an SFU-initiated signal ({"type": "offer", ...}) to a user over the signaling channel
+        self.on_signal: Optional[SignalHandler] = None
 
     async def create_connection(self, room_id: str, user_id: str, role: UserRole) -> RTCPeerConnection:
-        if user_id in self._connections:
-            await self.cleanup_user(room_id, user_id)
+        previous = self._connections.get(user_id)
+        if previous:
+            # keeps buffered candidates, which belong to the connection about to be created
+            await self._close_connection(previous.room_id, user_id)
 
         pc = RTCPeerConnection()
         connection = UserConnection(user_id=user_id, room_id=room_id, peer_connection=pc, role=role)
@@ -58,87 +137,198 @@ class SFUManager:
     def _setup_connection_handlers(self, pc: RTCPeerConnection, room_id: str, user_id: str) -> None:
         @pc.on("connectionstatechange")
         async def on_connectionstatechange():
-            if pc.connectionState in ["failed", "closed"]:
+            connection = self._connections.get(user_id)
+            # a connection replaced by a newer offer reports closed too, after its successor took its place
+            if pc.connectionState in ["failed", "closed"] and connection and connection.peer_connection is pc:
                 await self.cleanup_user(room_id, user_id)
 
-    async def handle_offer(self, room_id: str, user_id: str, sdp: str, is_sharer: bool) -> RTCSessionDescription:
+    async def handle_offer(
+        self, room_id: str, user_id: str, sdp: str, is_sharer: bool, layers: Optional[list] = None
+    ) -> RTCSessionDescription:
+        if voice_user(user_id) is not None:
+            return await self._handle_voice_offer(room_id, user_id, sdp)
         role = UserRole.SHARER if is_sharer else UserRole.VIEWER
 
-        if is_sharer and room_id in self._room_media:
-            existing_sharer = self._room_media[room_id].sharer_id
-            if existing_sharer != user_id:
-                raise ValueError(f"Room {room_id} already has a sharer: {existing_sharer}")
+        room_media = self._room_media.get(room_id)
+        if is_sharer and room_media and room_media.sharer_id not in (None, user_id):
+            raise ValueError(f"Room {room_id} already has a sharer: {room_media.sharer_id}")
 
         pc = await self.create_connection(room_id, user_id, role)
+        connection = self._connections[user_id]
+        room_media = self._media(room_id)
+        offered = {media.kind for media in SessionDescription.parse(sdp).media}
         if is_sharer:
+            room_media.sharer_id = user_id
+            connection.layers = parse_layers(layers)
             self._setup_sharer_tracks(pc, room_id, user_id)
         else:
-            await self._add_viewer_tracks(pc, room_id, user_id)
+            # added whether or not anyone shares yet: the tracks follow the room's media from sharer to sharer,
+            # so a change of sharer needs neither a new peer connection nor another offer/answer
+            for kind in VIEWER_TRACK_KINDS & offered:
+                self._add_viewer_track(connection, room_media, kind)
 
         # Process the offer
         await pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type="offer"))
         answer = await pc.createAnswer()
         await pc.setLocalDescription(answer)
-        await self._process_pending_ice_candidates(user_id)
+        if connection.state is NegotiationState.NEGOTIATING:
+            connection.state = NegotiationState.ESTABLISHED
+            await self._apply_ice_candidates(connection, self._candidates.take(user_id))
+
+        if not is_sharer:
+            # aiortc cannot answer with transceivers the offer has no m-line for, so these wait for renegotiate
+            for kind in VIEWER_TRACK_KINDS - offered:
+                self._add_viewer_track(connection, room_media, kind)
         return answer
 
-    def _setup_sharer_tracks(self, pc: RTCPeerConnection, room_id: str, user_id: str) -> None:
+    async def _handle_voice_offer(self, room_id: str, peer_id: str, sdp: str) -> RTCSessionDescription:
+        """Takes the user's microphone and sends back the call's loudest speakers, VOICE_SPEAKERS tracks of them.
+
+        The client's offer has one audio m-line, which carries its microphone in and the first slot out. The
+        other slots are offered by renegotiate.
+        """
+        user_id = voice_user(peer_id)
+        pc = await self.create_connection(room_id, peer_id, UserRole.VOICE)
+        connection = self._connections[peer_id]
+        voice = self._voice_room(room_id)
+        offered = [media.kind for media in SessionDescription.parse(sdp).media]
+
         @pc.on("track")
         def on_track(track):
-            if room_id not in self._room_media:
-                self._room_media[room_id] = RoomMedia(sharer_id=user_id)
-
-            room_media = self._room_media[room_id]
-            if track.kind == "video":
-                room_media.video_track = track
-            elif track.kind == "audio":
-                room_media.audio_track = track
-            else:
-                logger.warning(f"Unknown track kind: {track.kind}")
+            if track.kind != "audio" or self._connections.get(peer_id) is not connection:
+                return
+            source = open_source(pc, track)
+            if source.receiver is not None:
+                watch_audio_levels(source.receiver, lambda level: voice.report(user_id, level))
+            source.decoded = TimelineTrack(source.decoded, voice.origin)
+            if source.encoded is not None:
+                source.encoded = TimelineTrack(source.encoded, voice.origin)
+            voice.publish(user_id, source)
+
+        for _ in range(min(offered.count("audio"), VOICE_SPEAKERS)):
+            self._add_speaker_slot(connection)
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type="offer"))
+        answer = await pc.createAnswer()
+        await pc.setLocalDescription(answer)
+        connection.state = NegotiationState.ESTABLISHED
+        await self._apply_ice_candidates(connection, self._candidates.take(peer_id))
 
-            self._notify_viewers_of_new_track(room_id, track)
+        while len(connection.slots) < VOICE_SPEAKERS:
+            self._add_speaker_slot(connection)
+        voice.listen(user_id, connection.slots)
+        return answer
 
-    def _notify_viewers_of_new_track(self, room_id: str, track) -> None:
-        if room_id not in self._rooms:
+    def _add_speaker_slot(self, connection: UserConnection) -> None:
+        pc = connection.peer_connection
+        slot = SpeakerSlotTrack(self._relay, pc)
+        slot.sender = pc.addTrack(slot)
+        connection.slots.append(slot)
+
+    def _voice_room(self, room_id: str) -> VoiceRoom:
+        if room_id not in self._voice:
+            self._voice[room_id] = VoiceRoom()
+        return self._voice[room_id]
+
+    async def set_voice_state(self, room_id: str, user_id: str, muted: bool, deafened: bool) -> None:
+        """Mirrors a user's mute and deafen buttons: muted users are never picked, deafened ones get no audio."""
+        voice = self._voice.get(room_id)
+        if voice is not None:
+            voice.set_state(user_id, muted, deafened)
+
+    def _media(self, room_id: str) -> RoomMedia:
+        if room_id not in self._room_media:
+            self._room_media[room_id] = RoomMedia()
+        return self._room_media[room_id]
+
+    async def renegotiate(self, user_id: str) -> None:
+        """Offers tracks the user's last negotiation left out over the signaling channel, if there are any.
+
+        Call it once the user has our answer. The user's answer comes back through handle_answer.
+        """
+        connection = self._connections.get(user_id)
+        if not connection or self.on_signal is None:
             return
-        for user_id in self._rooms[room_id]:
-            connection = self._connections.get(user_id)
-            if connection and connection.role == UserRole.VIEWER:
-                relayed_track = self._relay.subscribe(track)
-                connection.peer_connection.addTrack(relayed_track)
-
-    async def _add_viewer_tracks(self, pc: RTCPeerConnection, room_id: str, user_id: str) -> None:
-        room_media = self._room_media.get(room_id)
+        pc = connection.peer_connection
+        if not any(t.mid is None and t.sender.track is not None for t in pc.getTransceivers()):
+            return
+        if pc.signalingState != "stable":
+            connection.renegotiation_pending = True
+            return
+        connection.renegotiation_pending = False
+        await pc.setLocalDescription(await pc.createOffer())
+        logger.info(f"Renegotiating with {user_id}")
+        await self.on_signal(connection.room_id, user_id, {"type": "offer", "sdp": pc.localDescription.sdp})
 
-        if not room_media:
+    async def handle_answer(self, user_id: str, sdp: str) -> None:
+        connection = self._connections.get(user_id)
+        if not connection or connection.peer_connection.signalingState != "have-local-offer":
             return
+        await connection.peer_connection.setRemoteDescription(RTCSessionDescription(sdp=sdp, type="answer"))
+        if connection.renegotiation_pending:
+            await self.renegotiate(user_id)
 
-        tracks_added = 0
-        for kind in ["video", "audio"]:
-            track = getattr(room_media, f"{kind}_track", None)
-            if track:
-                relayed_track = self._relay.subscribe(track)
-                pc.addTrack(relayed_track)
-                tracks_added += 1
+    def _setup_sharer_tracks(self, pc: RTCPeerConnection, room_id: str, user_id: str) -> None:
+        @pc.on("track")
+        def on_track(track):
+            room_media = self._media(room_id)
+            if room_media.sharer_id != user_id:
+                return
+            # viewers get the encoded packets as they arrived whenever their codec matches, see passthrough.py
+            source = open_source(pc, track)
+            if track.kind == "video":
+                mid = next((t.mid for t in pc.getTransceivers() if t.receiver.track is track), None)
+                connection = self._connections.get(user_id)
+                rid, bitrate = connection.layers.get(mid, (mid or "video", None)) if connection else ("video", None)
+                source.decoded = TimelineTrack(source.decoded, room_media.origin)
+                if source.encoded is not None:
+                    source.encoded = TimelineTrack(source.encoded, room_media.origin)
+                room_media.add_video_layer(VideoLayer(rid, bitrate, source))
+            elif track.kind == "audio":
+                room_media.set_audio(source)
+            else:
+                logger.warning(f"Unknown track kind: {track.kind}")
 
-        if tracks_added == 0:
-            pass
+    def _add_viewer_track(self, connection: UserConnection, room_media: RoomMedia, kind: str) -> None:
+        pc = connection.peer_connection
+        if kind == "video":
+            track = connection.selector = LayerSelectorTrack(
+                self._relay, room_media.video_layers, room_media.video_published, pc
+            )
+        else:
+            track = ForwardingTrack(self._relay, lambda: room_media.audio, room_media.audio_published, pc, kind=kind)
+        track.sender = pc.addTrack(track)
 
     async def handle_ice_candidate(self, user_id: str, candidate_dict: dict) -> None:
         candidate_str = candidate_dict.get("candidate")
 
+        # an empty candidate marks the end of gathering, which aiortc does not need
         if not candidate_str:
             return
 
         connection = self._connections.get(user_id)
 
-        if not connection:
-            return
+        if not connection or connection.state is NegotiationState.NEGOTIATING:
+            self._candidates.add(user_id, candidate_dict)
+        elif connection.state is NegotiationState.ESTABLISHED:
+            await self._apply_ice_candidates(connection, [candidate_dict])
+        else:
+            ice_candidates.inc(outcome="dropped", reason="closed")
 
-        try:
-            await self._add_ice_candidate(connection.peer_connection, candidate_dict)
-        except Exception:
-            connection.pending_ice_candidates.append(candidate_dict)
+    async def _apply_ice_candidates(self, connection: UserConnection, candidates: List[dict]) -> None:
+        if not candidates:
+            return
+        pc = connection.peer_connection
+        if pc.iceConnectionState in ("connected", "completed"):
+            # ICE already found a working pair, so this cannot have helped; a high rate means slow trickling
+            ice_candidates.inc(len(candidates), outcome="late")
+        results = await asyncio.gather(
+            *(self._add_ice_candidate(pc, candidate) for candidate in candidates), return_exceptions=True
+        )
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        if failed:
+            logger.debug(f"{failed} of {len(candidates)} ICE candidates from {connection.user_id} were rejected")
+            ice_candidates.inc(failed, outcome="dropped", reason="invalid")
+        ice_candidates.inc(len(candidates) - failed, outcome="applied")
 
     async def _add_ice_candidate(self, pc: RTCPeerConnection, candidate_dict: dict) -> None:
         candidate_str = candidate_dict.get("candidate", "")
@@ -151,38 +341,39 @@ class SFUManager:
 
         await pc.addIceCandidate(candidate)
 
-    async def _process_pending_ice_candidates(self, user_id: str) -> None:
-        connection = self._connections.get(user_id)
-        if not connection or not connection.pending_ice_candidates:
-            return
-
-        candidates = connection.pending_ice_candidates
-        connection.pending_ice_candidates = []
-
-        for candidate_dict in candidates:
-            try:
-                await self._add_ice_candidate(connection.peer_connection, candidate_dict)
-            except Exception:
-                pass
-
     async def cleanup_user(self, room_id: str, user_id: str) -> None:
+        self._candidates.discard(user_id)
+        await self._close_connection(room_id, user_id)
+
+    async def _close_connection(self, room_id: str, user_id: str) -> None:
         connection = self._connections.pop(user_id, None)
         if connection:
+            connection.state = NegotiationState.CLOSED
             try:
                 await connection.peer_connection.close()
             except Exception:
                 pass
 
+        room_media = self._room_media.get(room_id)
+        if room_media and room_media.sharer_id == user_id:
+            # the sharer's tracks end with its peer connection, and viewers wait for the next sharer
+            for source in room_media.clear():
+                source.requester.close()
+
+        voice = self._voice.get(room_id)
+        if voice is not None and voice_user(user_id) is not None:
+            source = voice.remove(voice_user(user_id))
+            if source is not None:
+                source.requester.close()
+
         if room_id in self._rooms:
             self._rooms[room_id].discard(user_id)
             if not self._rooms[room_id]:
                 del self._rooms[room_id]
-
-        room_media = self._room_media.get(room_id)
-        if room_media and room_media.sharer_id == user_id:
-            del self._room_media[room_id]
-
-            # notify remaining viewers about sharer leaving
+                self._room_media.pop(room_id, None)
+        if voice is not None and voice.empty:
+            del self._voice[room_id]
+            await voice.close()
 
     async def cleanup_room(self, room_id: str) -> None:
         if room_id not in self._rooms:
@@ -193,6 +384,42 @@ class SFUManager:
         for user_id in user_ids:
             await self.cleanup_user(room_id, user_id)
 
+    async def close(self) -> None:
+        for room_id in list(self._rooms):
+            await self.cleanup_room(room_id)
+
+    async def get_peer_stats(self) -> List[dict]:
+        """One row per user, direction and media kind, summed over the streams (such as simulcast layers)."""
+        now = time.monotonic()
+        samples: Dict[tuple, tuple] = {}
+        rows: Dict[tuple, dict] = {}
+        for user_id, connection in list(self._connections.items()):
+            for stats in (await connection.peer_connection.getStats()).values():
+                if isinstance(stats, (RTCOutboundRtpStreamStats, RTCRemoteInboundRtpStreamStats)):
+                    direction = "out"
+                elif isinstance(stats, (RTCInboundRtpStreamStats, RTCRemoteOutboundRtpStreamStats)):
+                    direction = "in"
+                else:
+                    continue
+                key = (connection.room_id, user_id, direction, stats.kind)
+                row = rows.setdefault(
+                    key, {"room": key[0], "user": user_id, "direction": direction, "kind": stats.kind, "bitrate": 0}
+                )
+                if isinstance(stats, (RTCOutboundRtpStreamStats, RTCRemoteOutboundRtpStreamStats)):
+                    # inbound byte counts only reach us through the client's sender reports
+                    sample_key = (user_id, stats.ssrc, direction)
+                    samples[sample_key] = (stats.bytesSent, now)
+                    previous = self._byte_samples.get(sample_key)
+                    if previous is not None and now > previous[1] and stats.bytesSent >= previous[0]:
+                        row["bitrate"] += (stats.bytesSent - previous[0]) * 8 / (now - previous[1])
+                else:
+                    row["packets_lost"] = row.get("packets_lost", 0) + stats.packetsLost
+                    if isinstance(stats, RTCRemoteInboundRtpStreamStats):
+                        row["fraction_lost"] = max(row.get("fraction_lost", 0.0), stats.fractionLost / 256)
+                        row["round_trip"] = stats.roundTripTime
+        self._byte_samples = samples
+        return list(rows.values())
+
     def get_room_info(self, room_id: str) -> Optional[Dict]:
         if room_id not in self._rooms:
             return None
@@ -204,10 +431,12 @@ class SFUManager:
             "room_id": room_id,
             "user_count": len(users),
             "users": users,
-            "has_sharer": room_media is not None,
+            "has_sharer": room_media is not None and room_media.sharer_id is not None,
             "sharer_id": room_media.sharer_id if room_media else None,
             "has_video": room_media.video_track is not None if room_media else False,
+            "video_layers": [layer.rid for layer in room_media.video_layers] if room_media else [],
             "has_audio": room_media.audio_track is not None if room_media else False,
+            "speakers": list(self._voice[room_id].speakers.ranking) if room_id in self._voice else [],
         }
 
     def get_user_info(self, user_id: str) -> Optional[Dict]:
@@ -220,10 +449,22 @@ class SFUManager:
             "user_id": user_id,
             "room_id": connection.room_id,
             "role": connection.role.value,
+            "negotiation_state": connection.state.value,
             "connection_state": pc.connectionState,
             "ice_connection_state": pc.iceConnectionState,
             "ice_gathering_state": pc.iceGatheringState,
         }
 
 
+def parse_layers(layers: Optional[list]) -> Dict[str, tuple]:
+    """Layer descriptions sent with a publisher's offer: [{"mid": "0", "rid": "h", "bitrate": 2500000}, ...]."""
+    parsed = {}
+    for layer in layers or []:
+        if not isinstance(layer, dict) or not isinstance(layer.get("mid"), str):
+            continue
+        bitrate = layer.get("bitrate")
+        parsed[layer["mid"]] = (str(layer.get("rid") or layer["mid"]), bitrate if isinstance(bitrate, int) else None)
+    return parsed
+
+
 sfu = SFUManager()
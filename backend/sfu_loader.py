@@ -0,0 +1,147 @@
+import asyncio
+import importlib
+import logging
+import os
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from metrics import registry
+
+logger = logging.getLogger("sfu_loader")
+
+# set to 1 to load the media stack in the background once the server is up, so the first share does not wait for
+# it; off by default, since the load competes with the first connections for the CPU and many rooms never need it
+SFU_WARMUP = os.getenv("SFU_WARMUP", "0") == "1"
+
+SignalHandler = Callable[[str, str, dict], Awaitable[None]]
+
+# a user's call audio has a peer connection of its own, keyed by the user id with this suffix
+VOICE_PEER_SUFFIX = ":voice"
+
+
+def voice_peer(user_id: str) -> str:
+    return f"{user_id}{VOICE_PEER_SUFFIX}"
+
+
+def voice_user(peer_id: str) -> Optional[str]:
+    """The user a voice peer id belongs to, or None for the user's own (screen share) connection."""
+    return peer_id[: -len(VOICE_PEER_SUFFIX)] if peer_id.endswith(VOICE_PEER_SUFFIX) else None
+
+
+# per peer connection, labelled by room, user, direction ("in" from the client, "out" to it) and kind
+PEER_GAUGES = {
+    "bitrate": registry.gauge("sfu_peer_bitrate_bps", "Media bitrate since the previous scrape"),
+    "packets_lost": registry.gauge("sfu_peer_packets_lost", "Packets lost, cumulative as last reported by RTCP"),
+    "fraction_lost": registry.gauge("sfu_peer_fraction_lost", "Share of packets lost in the last RTCP interval"),
+    "round_trip": registry.gauge("sfu_peer_round_trip_seconds", "Round trip time from RTCP receiver reports"),
+}
+
+sfu_load_seconds = registry.gauge("sfu_load_seconds", "Time taken to import and start the media stack")
+
+
+def record_peer_stats(rows: List[dict]) -> None:
+    for key, gauge in PEER_GAUGES.items():
+        samples = []
+        for row in rows:
+            if row.get(key) is not None:
+                labels = {"room": row["room"], "user": row["user"], "direction": row["direction"], "kind": row["kind"]}
+                samples.append((labels, row[key]))
+        gauge.replace(samples)
+
+
+class LazySFU:
+    """Stands in for the SFUManager, or the SFUPool with ``workers``, loading it on first use.
+
+    Importing sfu pulls in aiortc, av and their crypto and codec libraries, which costs more than the rest of
+    the server put together, and rooms that only chat and draw never need it. Signals that need media load it;
+    teardown and stats calls made before anything was loaded have nothing to act on and return straight away.
+    """
+
+    def __init__(self, workers: int = 0):
+        self._workers = workers
+        self._sfu = None
+        self._loading: Optional[asyncio.Task] = None
+        self.on_signal: Optional[SignalHandler] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._sfu is not None
+
+    def warm_up(self) -> None:
+        """Start loading in the background, if nothing has yet."""
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._load())
+
+    async def load(self):
+        self.warm_up()
+        # shielded: a handshake that gives up waiting must not cancel the load for everyone else
+        return await asyncio.shield(self._loading)
+
+    async def _load(self):
+        started = time.perf_counter()
+        try:
+            # the import runs in a thread, so signaling keeps running while aiortc and av initialise
+            if self._workers:
+                sfu = (await asyncio.to_thread(importlib.import_module, "sfu_pool")).SFUPool(self._workers)
+                sfu.on_signal = self._signal
+                await sfu.start()
+            else:
+                sfu = (await asyncio.to_thread(importlib.import_module, "sfu")).sfu
+                sfu.on_signal = self._signal
+        except Exception:
+            # the next signal tries again
+            self._loading = None
+            raise
+        self._sfu = sfu
+        sfu_load_seconds.set(time.perf_counter() - started)
+        logger.info(f"Loaded the media stack in {time.perf_counter() - started:.2f}s")
+        return sfu
+
+    async def _signal(self, room_id: str, peer_id: str, data: dict) -> None:
+        if self.on_signal is not None:
+            await self.on_signal(room_id, peer_id, data)
+
+    async def _loaded(self):
+        # a load under way may be about to place the very user being asked about
+        if self._loading is None:
+            return None
+        try:
+            return await asyncio.shield(self._loading)
+        except Exception:
+            return None  # a load that failed left nothing behind
+
+    async def handle_offer(self, room_id: str, user_id: str, sdp: str, is_sharer: bool, layers: list | None = None):
+        return await (await self.load()).handle_offer(room_id, user_id, sdp, is_sharer, layers)
+
+    async def handle_answer(self, user_id: str, sdp: str) -> None:
+        await (await self.load()).handle_answer(user_id, sdp)
+
+    async def handle_ice_candidate(self, user_id: str, candidate_dict: dict) -> None:
+        # may come before the offer; the SFU buffers it until then
+        await (await self.load()).handle_ice_candidate(user_id, candidate_dict)
+
+    async def renegotiate(self, user_id: str) -> None:
+        sfu = await self._loaded()
+        if sfu is not None:
+            await sfu.renegotiate(user_id)
+
+    async def set_voice_state(self, room_id: str, user_id: str, muted: bool, deafened: bool) -> None:
+        sfu = await self._loaded()
+        if sfu is not None:
+            await sfu.set_voice_state(room_id, user_id, muted, deafened)
+
+    async def cleanup_user(self, room_id: str, user_id: str) -> None:
+        sfu = await self._loaded()
+        if sfu is not None:
+            await sfu.cleanup_user(room_id, user_id)
+
+    async def get_peer_stats(self) -> List[dict]:
+        return await self._sfu.get_peer_stats() if self._sfu is not None else []
+
+    def get_worker_loads(self) -> List[int]:
+        return self._sfu.get_worker_loads() if self._workers and self._sfu is not None else []
+
+    async def close(self) -> None:
+        sfu = await self._loaded()
+        if sfu is not None:
+            await sfu.close()
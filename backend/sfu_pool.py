@@ -0,0 +1,299 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from typing import TYPE_CHECKING
+
+from encoding import dumps, loads
+from ice import CandidateBuffer
+from sfu_loader import SignalHandler
+
+if TYPE_CHECKING:
+    from aiortc import RTCSessionDescription
+
+logger = logging.getLogger("sfu_pool")
+
+# 0 keeps the SFU on the signaling loop; N > 0 hosts SFU rooms in N worker processes
+SFU_WORKERS = int(os.getenv("SFU_WORKERS", "0"))
+WORKER_START_TIMEOUT = 15.0
+# SDP offers and answers are far below this, but asyncio's default 64 KiB line limit is close enough to matter
+IPC_LINE_LIMIT = 1 << 20
+
+
+class SFUWorkerError(Exception):
+    pass
+
+
+class SFUWorker:
+    """Parent-side handle on one SFU process: newline-delimited JSON requests over a unix socket.
+
+    Lines without an id are events the worker raises on its own, such as a renegotiation offer for a user.
+    """
+
+    def __init__(self, index: int, path: str, on_signal: SignalHandler | None = None):
+        self.index = index
+        self.path = path
+        self.on_signal = on_signal
+        self.process: multiprocessing.Process | None = None
+        # users with a peer connection on this worker, the placement load
+        self.users: set[str] = set()
+        self.alive = False
+        self._ids = itertools.count()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task | None = None
+        # signals being delivered, held so they are not collected mid-flight
+        self._signal_tasks: set[asyncio.Task] = set()
+
+    @property
+    def load(self) -> int:
+        return len(self.users)
+
+    async def start(self) -> None:
+        self.process = multiprocessing.get_context("spawn").Process(
+            target=run_worker, args=(self.path,), name=f"sfu-worker-{self.index}", daemon=True
+        )
+        self.process.start()
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=IPC_LINE_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline or not self.process.is_alive():
+                    raise SFUWorkerError(f"SFU worker {self.index} did not come up")
+                await asyncio.sleep(0.05)
+        self.alive = True
+        self._reader_task = asyncio.create_task(self._read_replies(reader))
+
+    async def close(self) -> None:
+        self.alive = False
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+        for task in list(self._signal_tasks):
+            task.cancel()
+        await asyncio.gather(*self._signal_tasks, return_exceptions=True)
+        if self._writer is not None:
+            self._writer.close()
+        if self.process is not None:
+            self.process.terminate()
+            await asyncio.to_thread(self.process.join, 5)
+
+    async def call(self, op: str, **args):
+        if not self.alive:
+            raise SFUWorkerError(f"SFU worker {self.index} is not running")
+        request_id = next(self._ids)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        self._writer.write(dumps({"id": request_id, "op": op, **args}).encode() + b"\n")
+        await self._writer.drain()
+        return await future
+
+    def _signal_done(self, task: asyncio.Task) -> None:
+        self._signal_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"SFU worker {self.index} signal delivery failed", exc_info=task.exception())
+
+    async def _read_replies(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while line := await reader.readline():
+                reply = loads(line)
+                if reply.get("event") == "signal":
+                    if self.on_signal is not None:
+                        task = asyncio.create_task(self.on_signal(reply["room"], reply["user"], reply["data"]))
+                        self._signal_tasks.add(task)
+                        task.add_done_callback(self._signal_done)
+                    continue
+                future = self._pending.pop(reply["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in reply:
+                    future.set_exception(SFUWorkerError(reply["error"]))
+                else:
+                    future.set_result(reply.get("result"))
+        finally:
+            self.alive = False
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(SFUWorkerError(f"SFU worker {self.index} exited"))
+            self._pending.clear()
+
+
+class SFUPool:
+    """Same interface as SFUManager, with each room's peer connections hosted by one worker process.
+
+    A room is placed on the worker with the fewest peer connections when its first user arrives and stays
+    there until it empties, since the relayed tracks of a room can only be shared within one process.
+    """
+
+    def __init__(self, size: int):
+        self._socket_dir = tempfile.mkdtemp(prefix="purestream-sfu-")
+        self._workers = [
+            SFUWorker(i, os.path.join(self._socket_dir, f"sfu-{i}.sock"), self._signal) for i in range(size)
+        ]
+        self._rooms: dict[str, SFUWorker] = {}
+        self._users: dict[str, tuple[str, SFUWorker]] = {}
+        # candidates that arrive before the user's offer has placed it on a worker
+        self._candidates = CandidateBuffer()
+        self.on_signal: SignalHandler | None = None
+
+    async def _signal(self, room_id: str, user_id: str, data: dict) -> None:
+        if self.on_signal is not None:
+            await self.on_signal(room_id, user_id, data)
+
+    async def start(self) -> None:
+        await asyncio.gather(*(worker.start() for worker in self._workers))
+        logger.info(f"Started {len(self._workers)} SFU workers")
+
+    async def close(self) -> None:
+        await asyncio.gather(*(worker.close() for worker in self._workers), return_exceptions=True)
+        shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+    def _place(self, room_id: str) -> SFUWorker:
+        worker = self._rooms.get(room_id)
+        if worker is None or not worker.alive:
+            candidates = [w for w in self._workers if w.alive]
+            if not candidates:
+                raise SFUWorkerError("No SFU worker is running")
+            worker = self._rooms[room_id] = min(candidates, key=lambda w: w.load)
+        return worker
+
+    def _forget(self, room_id: str, user_id: str) -> None:
+        entry = self._users.get(user_id)
+        if entry is None or entry[0] != room_id:
+            return
+        del self._users[user_id]
+        worker = entry[1]
+        worker.users.discard(user_id)
+        if not any(room == room_id for room, _ in self._users.values()):
+            self._rooms.pop(room_id, None)
+
+    async def handle_offer(
+        self, room_id: str, user_id: str, sdp: str, is_sharer: bool, layers: list | None = None
+    ) -> "RTCSessionDescription":
+        # only the workers need the rest of aiortc
+        from aiortc import RTCSessionDescription
+
+        worker = self._place(room_id)
+        previous = self._users.get(user_id)
+        if previous is not None and (previous[0] != room_id or previous[1] is not worker):
+            await self.cleanup_user(previous[0], user_id)
+        self._users[user_id] = (room_id, worker)
+        worker.users.add(user_id)
+        result = await worker.call("offer", room=room_id, user=user_id, sdp=sdp, is_sharer=is_sharer, layers=layers)
+        for candidate in self._candidates.take(user_id):
+            await worker.call("candidate", user=user_id, candidate=candidate)
+        return RTCSessionDescription(sdp=result["sdp"], type="answer")
+
+    async def handle_ice_candidate(self, user_id: str, candidate_dict: dict) -> None:
+        entry = self._users.get(user_id)
+        if entry is None:
+            self._candidates.add(user_id, candidate_dict)
+        elif entry[1].alive:
+            await entry[1].call("candidate", user=user_id, candidate=candidate_dict)
+
+    async def renegotiate(self, user_id: str) -> None:
+        entry = self._users.get(user_id)
+        if entry is None or not entry[1].alive:
+            return
+        await entry[1].call("renegotiate", user=user_id)
+
+    async def handle_answer(self, user_id: str, sdp: str) -> None:
+        entry = self._users.get(user_id)
+        if entry is None or not entry[1].alive:
+            return
+        await entry[1].call("answer", user=user_id, sdp=sdp)
+
+    async def set_voice_state(self, room_id: str, user_id: str, muted: bool, deafened: bool) -> None:
+        worker = self._rooms.get(room_id)
+        if worker is not None and worker.alive:
+            await worker.call("voice_state", room=room_id, user=user_id, muted=muted, deafened=deafened)
+
+    async def cleanup_user(self, room_id: str, user_id: str) -> None:
+        self._candidates.discard(user_id)
+        entry = self._users.get(user_id)
+        self._forget(room_id, user_id)
+        if entry is not None and entry[1].alive:
+            await entry[1].call("cleanup_user", room=room_id, user=user_id)
+
+    async def cleanup_room(self, room_id: str) -> None:
+        worker = self._rooms.pop(room_id, None)
+        for user_id in [user for user, (room, _) in self._users.items() if room == room_id]:
+            self._forget(room_id, user_id)
+        if worker is not None and worker.alive:
+            await worker.call("cleanup_room", room=room_id)
+
+    def get_worker_loads(self) -> list[int]:
+        return [worker.load for worker in self._workers]
+
+    async def get_peer_stats(self) -> list[dict]:
+        results = await asyncio.gather(
+            *(worker.call("stats") for worker in self._workers if worker.alive), return_exceptions=True
+        )
+        return [row for result in results if isinstance(result, list) for row in result]
+
+
+def run_worker(path: str) -> None:
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve_worker(path))
+
+
+async def _serve_worker(path: str) -> None:
+    from sfu import SFUManager
+
+    manager = SFUManager()
+    stopped = asyncio.Event()
+
+    async def handle(request: dict):
+        op = request["op"]
+        if op == "offer":
+            answer = await manager.handle_offer(
+                request["room"], request["user"], request["sdp"], request["is_sharer"], request.get("layers")
+            )
+            return {"sdp": answer.sdp}
+        if op == "candidate":
+            return await manager.handle_ice_candidate(request["user"], request["candidate"])
+        if op == "renegotiate":
+            return await manager.renegotiate(request["user"])
+        if op == "answer":
+            return await manager.handle_answer(request["user"], request["sdp"])
+        if op == "voice_state":
+            room, user = request["room"], request["user"]
+            return await manager.set_voice_state(room, user, request["muted"], request["deafened"])
+        if op == "cleanup_user":
+            return await manager.cleanup_user(request["room"], request["user"])
+        if op == "cleanup_room":
+            return await manager.cleanup_room(request["room"])
+        if op == "stats":
+            return await manager.get_peer_stats()
+        raise ValueError(f"Unknown SFU request: {op}")
+
+    async def respond(request: dict, writer: asyncio.StreamWriter) -> None:
+        try:
+            reply = {"id": request["id"], "result": await handle(request)}
+        except Exception as e:
+            reply = {"id": request["id"], "error": str(e) or type(e).__name__}
+        writer.write(dumps(reply).encode() + b"\n")
+
+    async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        async def signal(room_id: str, user_id: str, data: dict) -> None:
+            writer.write(dumps({"event": "signal", "room": room_id, "user": user_id, "data": data}).encode() + b"\n")
+
+        manager.on_signal = signal
+        # requests run concurrently so one slow handshake does not hold up candidates for other users
+        tasks: set[asyncio.Task] = set()
+        while line := await reader.readline():
+            task = asyncio.create_task(respond(loads(line), writer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # the signaling process went away, so nobody is left to serve
+        await manager.close()
+        stopped.set()
+
+    server = await asyncio.start_unix_server(serve, path, limit=IPC_LINE_LIMIT)
+    async with server:
+        await stopped.wait()
@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+
+from aiortc import MediaStreamTrack, RTCPeerConnection
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
+from aiortc.stats import RTCOutboundRtpStreamStats, RTCRemoteInboundRtpStreamStats
+from passthrough import MediaSource, forward_keyframe_requests, viewer_codec
+
+logger = logging.getLogger("simulcast")
+
+ADAPT_INTERVAL = 1.0
+MIN_ESTIMATE = 150_000
+MAX_ESTIMATE = 20_000_000
+# start optimistic: most viewers sustain the top layer, and the first lossy report moves a weak one down
+INITIAL_ESTIMATE = 10_000_000
+# loss-based control in the style of GCC: back off above 10% loss, probe upward below 2%
+HIGH_LOSS = 0.10
+LOW_LOSS = 0.02
+INCREASE_FACTOR = 1.08
+# moving up a layer needs this much spare estimate, so a borderline viewer does not flap between two layers
+UPGRADE_HEADROOM = 1.2
+
+
+@dataclass
+class VideoLayer:
+    rid: str
+    bitrate: int | None
+    source: MediaSource
+
+
+class TimelineTrack(MediaStreamTrack):
+    """Rebases a layer's timestamps onto a timeline shared by every layer of the room.
+
+    Each layer arrives on its own RTP stream with a random timestamp origin. Aligning them at the source,
+    before the relay, lets a viewer move between layers without a jump in the timestamps it receives.
+    """
+
+    def __init__(self, source: MediaStreamTrack, origin: float):
+        super().__init__()
+        self.kind = source.kind
+        self._source = source
+        self._origin = origin
+        self._offset: int | None = None
+
+    async def recv(self):
+        frame = await self._source.recv()
+        if self._offset is None:
+            elapsed = time.monotonic() - self._origin
+            self._offset = round(elapsed / frame.time_base) - frame.pts
+        frame.pts += self._offset
+        return frame
+
+    def stop(self) -> None:
+        super().stop()
+        self._source.stop()
+
+
+class BandwidthEstimator:
+    """Send-side estimate for one viewer from RTCP receiver reports: what we sent and how much was lost."""
+
+    def __init__(self, initial: int = INITIAL_ESTIMATE):
+        self.estimate = initial
+        self._last_bytes: int | None = None
+        self._last_time: float | None = None
+
+    def update(self, bytes_sent: int, fraction_lost: float, now: float) -> int:
+        if self._last_time is not None and now > self._last_time:
+            sent_rate = (bytes_sent - self._last_bytes) * 8 / (now - self._last_time)
+            if fraction_lost > HIGH_LOSS:
+                self.estimate = int(min(self.estimate, sent_rate) * (1 - fraction_lost / 2))
+            elif fraction_lost < LOW_LOSS:
+                self.estimate = int(self.estimate * INCREASE_FACTOR)
+            self.estimate = max(MIN_ESTIMATE, min(MAX_ESTIMATE, self.estimate))
+        self._last_bytes = bytes_sent
+        self._last_time = now
+        return self.estimate
+
+
+def choose_layer(layers: list[VideoLayer], estimate: int, current: VideoLayer | None = None) -> VideoLayer:
+    """The best layer the estimate sustains; layers are ordered best first and unknown bitrates always fit."""
+    current_rank = next((rank for rank, layer in enumerate(layers) if layer is current), len(layers))
+    for rank, layer in enumerate(layers):
+        if layer.bitrate is None:
+            return layer
+        needed = layer.bitrate * UPGRADE_HEADROOM if rank < current_rank else layer.bitrate
+        if needed <= estimate:
+            return layer
+    return layers[-1]
+
+
+class LayerSelectorTrack(MediaStreamTrack):
+    """Per-viewer video track that forwards one of the room's layers, picked from the viewer's estimate.
+
+    A switch subscribes to the new layer alongside the current one, keeps forwarding the current layer, and
+    commits on the first frame of the new layer that is a switch point: a keyframe for encoded packets, any
+    frame for decoded ones. The very first layer starts from its cached GOP instead, as there is no earlier
+    timeline for replayed frames to run behind.
+
+    The track lives as long as the viewer's connection. When the sharer leaves it goes quiet until
+    ``published`` is set again, then carries on with the new sharer's layers on the same sender.
+    """
+
+    kind = "video"
+
+    def __init__(
+        self,
+        relay: MediaRelay,
+        layers: list[VideoLayer],
+        published: asyncio.Event,
+        pc: RTCPeerConnection | None = None,
+    ):
+        super().__init__()
+        self._relay = relay
+        # shared with RoomMedia, so layers published later become selectable without touching viewers
+        self._layers = layers
+        self._published = published
+        self._pc = pc
+        self.sender = None
+        self.codec: str | None = None
+        self.estimator = BandwidthEstimator()
+        self.layer: VideoLayer | None = None
+        self._source: MediaStreamTrack | None = None
+        self._synced = False
+        self._replay: deque = deque()
+        self._pending_layer: VideoLayer | None = None
+        self._pending: MediaStreamTrack | None = None
+        self._current_recv: asyncio.Future | None = None
+        self._pending_recv: asyncio.Future | None = None
+        self._adapt_task: asyncio.Task | None = None
+
+    def _subscribe(self, layer: VideoLayer) -> MediaStreamTrack:
+        return self._relay.subscribe(layer.source.track_for(self.codec))
+
+    def _request_keyframe(self) -> None:
+        layer = self._pending_layer or self.layer
+        if layer is not None:
+            layer.source.request_keyframe()
+
+    def select(self, layer: VideoLayer) -> None:
+        if layer is self._pending_layer or (layer is self.layer and self._pending is None):
+            return
+        self._drop_pending()
+        if layer is self.layer:
+            return
+        if self.layer is None:
+            self.layer, self._source = layer, self._subscribe(layer)
+        else:
+            self._pending_layer, self._pending = layer, self._subscribe(layer)
+            layer.source.request_keyframe()
+            logger.info(f"Switching viewer from layer {self.layer.rid} to {layer.rid}")
+
+    def _drop_pending(self) -> None:
+        if self._pending_recv is not None:
+            self._pending_recv.cancel()
+        if self._pending is not None:
+            self._pending.stop()
+        self._pending_layer = self._pending = self._pending_recv = None
+
+    def _drop_source(self) -> None:
+        self._drop_pending()
+        if self._current_recv is not None:
+            self._current_recv.cancel()
+        if self._source is not None:
+            self._source.stop()
+        self.layer = self._source = self._current_recv = None
+        self._synced = False
+
+    async def recv(self):
+        if self._replay:
+            return self._replay.popleft()
+        if self._adapt_task is None:
+            self._adapt_task = asyncio.create_task(self._adapt())
+            self.codec = viewer_codec(self._pc, self.sender)
+            if self.sender is not None:
+                forward_keyframe_requests(self.sender, self._request_keyframe)
+
+        while True:
+            if self._source is None:
+                await self._published.wait()
+                self.select(choose_layer(self._layers, self.estimator.estimate))
+            if self._current_recv is None:
+                self._current_recv = asyncio.ensure_future(self._source.recv())
+            if self._pending is not None and self._pending_recv is None:
+                self._pending_recv = asyncio.ensure_future(self._pending.recv())
+            waiting = {self._current_recv} if self._pending_recv is None else {self._current_recv, self._pending_recv}
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if self._pending_recv is not None and self._pending_recv.done():
+                try:
+                    frame = self._pending_recv.result()
+                except MediaStreamError:
+                    self._drop_pending()
+                    continue
+                self._pending_recv = None
+                if getattr(frame, "is_keyframe", True):
+                    self._commit_pending()
+                    return frame
+
+            if self._current_recv.done():
+                try:
+                    frame = self._current_recv.result()
+                except MediaStreamError:
+                    # the sharer stopped; stay attached to the viewer and wait for whoever shares next
+                    self._drop_source()
+                    continue
+                self._current_recv = None
+                if self._synced:
+                    return frame
+                # an encoded stream is undecodable for the viewer before its first keyframe
+                frames = self.layer.source.catch_up(frame)
+                if frames is None:
+                    self.layer.source.request_keyframe()
+                    continue
+                self._synced = True
+                self._replay.extend(frames[1:])
+                return frames[0]
+
+    def _commit_pending(self) -> None:
+        self._current_recv.cancel()
+        self._source.stop()
+        self.layer, self._source = self._pending_layer, self._pending
+        self._pending_layer = self._pending = self._current_recv = None
+        self._synced = True
+
+    def stop(self) -> None:
+        super().stop()
+        if self._adapt_task is not None:
+            self._adapt_task.cancel()
+        self._drop_source()
+
+    async def _adapt(self) -> None:
+        while True:
+            await asyncio.sleep(ADAPT_INTERVAL)
+            if self.sender is None or len(self._layers) < 2:
+                continue
+            bytes_sent, fraction_lost = 0, 0.0
+            for stats in (await self.sender.getStats()).values():
+                if isinstance(stats, RTCOutboundRtpStreamStats):
+                    bytes_sent = stats.bytesSent
+                elif isinstance(stats, RTCRemoteInboundRtpStreamStats):
+                    # RTCP carries fraction lost as an 8-bit fixed point value
+                    fraction_lost = stats.fractionLost / 256
+            estimate = self.estimator.update(bytes_sent, fraction_lost, time.monotonic())
+            self.select(choose_layer(self._layers, estimate, self._pending_layer or self.layer))
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCRtpReceiver, RTCRtpSender
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
+from metrics import registry
+from passthrough import MediaSource, viewer_codec
+
+logger = logging.getLogger("speakers")
+
+# active speakers forwarded to each participant in a call, whatever its size
+VOICE_SPEAKERS = int(os.getenv("VOICE_SPEAKERS", "3"))
+SPEAKER_INTERVAL = int(os.getenv("VOICE_SPEAKER_INTERVAL_MS", "300")) / 1000
+# audio levels are -dBov, from 0 (loudest) to 127 (silence); anything quieter than this is background noise
+SILENCE_LEVEL = 60
+# how much of a speaker's score carries over into the next interval, so a pause for breath does not cost a slot
+SCORE_DECAY = 0.6
+# below this a speaker has been quiet long enough to stop being forwarded
+MIN_SCORE = 1.0
+# a challenger has to be this much louder than the quietest current speaker to take its place
+SWITCH_MARGIN = 1.5
+# senders without the audio level extension: Opus packs silence into a few bytes and speech into far more
+SILENT_PAYLOAD_BYTES = 20
+SPEECH_LEVEL = 30
+# frames a slot holds for a sender that fell behind; older ones are dropped, as late audio is useless
+SLOT_QUEUE_FRAMES = 10
+
+speaker_changes = registry.counter("voice_speaker_changes_total", "Changes to a call's set of active speakers")
+
+
+def watch_audio_levels(receiver: RTCRtpReceiver, report: Callable[[int], None]) -> None:
+    """Reports the audio level of every packet ``receiver`` gets, without decoding any of them.
+
+    Browsers send the level in the ssrc-audio-level header extension (RFC 6464). Packets without it are judged
+    by their payload size instead.
+    """
+    handle_rtp = getattr(receiver, "_handle_rtp_packet", None)
+    if handle_rtp is None:
+        # private to aiortc, so it may move in a release; the user then just never ranks as a speaker
+        logger.warning("No audio levels from this receiver, its sender will not be forwarded as a speaker")
+        return
+
+    async def handle(packet, arrival_time_ms: int) -> None:
+        level = packet.extensions.audio_level
+        if level is not None:
+            report(level[1])
+        else:
+            report(SPEECH_LEVEL if len(packet.payload) > SILENT_PAYLOAD_BYTES else 127)
+        await handle_rtp(packet, arrival_time_ms)
+
+    receiver._handle_rtp_packet = handle
+
+
+@dataclass
+class _Level:
+    loudness: float = 0.0
+    packets: int = 0
+    score: float = 0.0
+
+
+class ActiveSpeakers:
+    """Ranks a call's participants by how loudly they have been speaking recently.
+
+    ``report`` only adds up levels; ``update`` turns each interval's average into a decaying score and picks
+    the ``count`` loudest. Current speakers are kept until a challenger clearly beats them, so two people
+    talking over each other do not swap places every interval.
+    """
+
+    def __init__(self, count: int, margin: float = SWITCH_MARGIN):
+        self._count = count
+        self._margin = margin
+        self._levels: dict[str, _Level] = {}
+        self._muted: set[str] = set()
+        # loudest first
+        self.ranking: list[str] = []
+
+    def report(self, user_id: str, level: int) -> None:
+        entry = self._levels.get(user_id)
+        if entry is None:
+            entry = self._levels[user_id] = _Level()
+        entry.loudness += max(0, SILENCE_LEVEL - level)
+        entry.packets += 1
+
+    def set_muted(self, user_id: str, muted: bool) -> None:
+        if muted:
+            self._muted.add(user_id)
+        else:
+            self._muted.discard(user_id)
+
+    def remove(self, user_id: str) -> None:
+        self._levels.pop(user_id, None)
+        self._muted.discard(user_id)
+
+    def update(self) -> bool:
+        """Scores the interval since the last call and re-ranks; True if the set of speakers changed."""
+        for entry in self._levels.values():
+            average = entry.loudness / entry.packets if entry.packets else 0.0
+            entry.score = entry.score * SCORE_DECAY + average * (1 - SCORE_DECAY)
+            entry.loudness = 0.0
+            entry.packets = 0
+        scores = {
+            user_id: entry.score
+            for user_id, entry in self._levels.items()
+            if user_id not in self._muted and entry.score >= MIN_SCORE
+        }
+        kept = [user_id for user_id in self.ranking if user_id in scores]
+        for user_id in sorted(scores.keys() - set(kept), key=scores.get, reverse=True):
+            if len(kept) < self._count:
+                kept.append(user_id)
+                continue
+            weakest = min(kept, key=scores.get)
+            if scores[user_id] > scores[weakest] * self._margin:
+                kept[kept.index(weakest)] = user_id
+        ranking = sorted(kept, key=scores.get, reverse=True)
+        changed = set(ranking) != set(self.ranking)
+        self.ranking = ranking
+        return changed
+
+
+class SpeakerSlotTrack(MediaStreamTrack):
+    """One of a participant's incoming voices, carrying whichever speaker the call assigns to it.
+
+    Speakers' timestamps share the call's timeline (see TimelineTrack), so a slot moves from one speaker to
+    the next without the participant's jitter buffer noticing. An unassigned slot sends nothing.
+    """
+
+    kind = "audio"
+
+    def __init__(self, relay: MediaRelay, pc: RTCPeerConnection | None):
+        super().__init__()
+        self.sender: RTCRtpSender | None = None
+        self.speaker: str | None = None
+        self._relay = relay
+        self._pc = pc
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pump: asyncio.Task | None = None
+
+    def assign(self, speaker: str | None, source: MediaSource | None) -> None:
+        if speaker == self.speaker:
+            return
+        self.speaker = speaker
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+        if source is not None and self.readyState == "live":
+            self._pump = asyncio.ensure_future(self._forward(source))
+
+    async def _forward(self, source: MediaSource) -> None:
+        track = self._relay.subscribe(source.track_for(viewer_codec(self._pc, self.sender)))
+        try:
+            while True:
+                frame = await track.recv()
+                if self._queue.qsize() >= SLOT_QUEUE_FRAMES:
+                    self._queue.get_nowait()
+                self._queue.put_nowait(frame)
+        except MediaStreamError:
+            pass
+        finally:
+            track.stop()
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        frame = await self._queue.get()
+        if frame is None:
+            raise MediaStreamError
+        return frame
+
+    def stop(self) -> None:
+        super().stop()
+        self.assign(None, None)
+        self._queue.put_nowait(None)
+
+
+class VoiceRoom:
+    """A room's call: the voice each participant publishes, who is speaking, and the slots each one listens on.
+
+    Every participant hears the loudest speakers other than itself, as many as it has slots. A speaker keeps
+    its slot while it stays among them; deafened participants get nothing at all.
+    """
+
+    def __init__(self, speakers: int = VOICE_SPEAKERS, interval: float = SPEAKER_INTERVAL):
+        # one more than each participant hears, since a participant never hears itself
+        self.speakers = ActiveSpeakers(speakers + 1)
+        self.sources: dict[str, MediaSource] = {}
+        self.listeners: dict[str, list[SpeakerSlotTrack]] = {}
+        self.deafened: set[str] = set()
+        # kept for the room's lifetime, so every voice lands on one timeline
+        self.origin = time.monotonic()
+        self._interval = interval
+        self._task: asyncio.Task | None = None
+
+    @property
+    def empty(self) -> bool:
+        return not self.sources and not self.listeners
+
+    def listen(self, user_id: str, slots: list[SpeakerSlotTrack]) -> None:
+        self.listeners[user_id] = slots
+        self._assign(user_id, slots)
+        self._start()
+
+    def publish(self, user_id: str, source: MediaSource) -> None:
+        self.sources[user_id] = source
+        self._start()
+
+    def report(self, user_id: str, level: int) -> None:
+        self.speakers.report(user_id, level)
+
+    def set_state(self, user_id: str, muted: bool, deafened: bool) -> None:
+        self.speakers.set_muted(user_id, muted)
+        if deafened:
+            self.deafened.add(user_id)
+        else:
+            self.deafened.discard(user_id)
+        slots = self.listeners.get(user_id)
+        if slots is not None:
+            self._assign(user_id, slots)
+
+    def remove(self, user_id: str) -> MediaSource | None:
+        for slot in self.listeners.pop(user_id, []):
+            slot.stop()
+        self.speakers.remove(user_id)
+        self.deafened.discard(user_id)
+        source = self.sources.pop(user_id, None)
+        if source is not None:
+            for listener, slots in self.listeners.items():
+                if any(slot.speaker == user_id for slot in slots):
+                    self._assign(listener, slots)
+        return source
+
+    def update(self) -> None:
+        if self.speakers.update():
+            speaker_changes.inc()
+            for user_id, slots in self.listeners.items():
+                self._assign(user_id, slots)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for user_id in list(self.listeners):
+            self.remove(user_id)
+        self.sources.clear()
+
+    def _assign(self, user_id: str, slots: list[SpeakerSlotTrack]) -> None:
+        if user_id in self.deafened:
+            wanted = []
+        else:
+            ranking = [speaker for speaker in self.speakers.ranking if speaker != user_id and speaker in self.sources]
+            wanted = ranking[: len(slots)]
+        free = []
+        for slot in slots:
+            if slot.speaker in wanted:
+                wanted.remove(slot.speaker)
+            else:
+                free.append(slot)
+        for slot in free:
+            speaker = wanted.pop(0) if wanted else None
+            slot.assign(speaker, self.sources.get(speaker) if speaker else None)
+
+    def _start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            self.update()
@@ -0,0 +1,200 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+from metrics import registry
+
+try:
+    import brotli
+except ImportError:  # optional: without it only the build's own .br files are served
+    brotli = None
+
+logger = logging.getLogger("static_assets")
+
+# Vite fingerprints what it emits under assets/ (name-<hash>.ext), so those never change under the same URL
+HASHED_ASSET = re.compile(r"^assets/.+-[A-Za-z0-9_-]{8}\.[a-z0-9]+$")
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# everything else, index.html above all, is revalidated on every use; the ETag makes that a bodiless 304
+REVALIDATE_CACHE = "no-cache"
+# smaller bodies fit in a packet or two either way
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+# preferred first among encodings the client weighs equally
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+static_responses = registry.counter("static_responses_total", "Static asset responses, by status and encoding")
+
+
+@dataclass(frozen=True, slots=True)
+class Representation:
+    body: bytes
+    headers: list[tuple[bytes, bytes]]
+    # a 304 carries the validators and caching headers but no body or body headers
+    not_modified_headers: list[tuple[bytes, bytes]]
+    etag: bytes
+
+
+class Asset:
+    """One file of the bundle in memory, with a compressed variant per encoding that is worth sending."""
+
+    def __init__(self, path: Path, relpath: str, body: bytes):
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        cache = IMMUTABLE_CACHE if HASHED_ASSET.match(relpath) else REVALIDATE_CACHE
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        self._base = [(b"content-type", content_type.encode()), (b"cache-control", cache.encode())]
+        self.identity = self._representation(body, f'"{digest}"', None)
+        self.variants: dict[str, Representation] = {}
+        if len(body) < MIN_COMPRESS_SIZE or not content_type.startswith(COMPRESSIBLE_TYPES):
+            return
+        for encoding, suffix in ENCODINGS:
+            compressed = _read_variant(path, suffix)
+            if compressed is None:
+                compressed = _compress(encoding, body)
+            if compressed is not None and len(compressed) < len(body):
+                # each encoding is its own representation, so each gets its own strong ETag
+                self.variants[encoding] = self._representation(compressed, f'"{digest}-{encoding}"', encoding)
+
+    def _representation(self, body: bytes, etag: str, encoding: str | None) -> Representation:
+        headers = [*self._base, (b"etag", etag.encode()), (b"vary", b"accept-encoding")]
+        if encoding is not None:
+            headers.append((b"content-encoding", encoding.encode()))
+        return Representation(body, [*headers, (b"content-length", str(len(body)).encode())], headers, etag.encode())
+
+    def negotiate(self, accept_encoding: str) -> tuple[str | None, Representation]:
+        if self.variants and accept_encoding:
+            accepted = _accepted_encodings(accept_encoding)
+            # the client's preference first, ours (ENCODINGS order) between equals
+            best = max(self.variants, key=lambda encoding: _quality(accepted, encoding))
+            quality = _quality(accepted, best)
+            # identity only competes when the client names it; it is the fallback either way, even if refused
+            if quality > 0 and quality >= accepted.get("identity", 0.0):
+                return best, self.variants[best]
+        return None, self.identity
+
+
+def _read_variant(path: Path, suffix: str) -> bytes | None:
+    prebuilt = path.with_name(path.name + suffix)
+    return prebuilt.read_bytes() if prebuilt.is_file() else None
+
+
+def _compress(encoding: str, body: bytes) -> bytes | None:
+    if encoding == "gzip":
+        # mtime=0 keeps the output, and so the ETag's meaning, the same across restarts
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(body)
+    return None
+
+
+def _accepted_encodings(header: str) -> dict[str, float]:
+    """Each coding named in an Accept-Encoding header with its q-value; "*" stands for any coding not named."""
+    accepted = {}
+    for part in header.split(","):
+        name, *params = part.split(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def _quality(accepted: dict[str, float], encoding: str) -> float:
+    return accepted.get(encoding, accepted.get("*", 0.0))
+
+
+def _etag_matches(if_none_match: str, representation: Representation) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    etag = representation.etag.decode()
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+class StaticBundle:
+    """ASGI app serving the built frontend from memory, in place of StaticFiles(html=True).
+
+    The whole bundle is read, and compressed where the build did not already do it, once at startup, with
+    each response's headers prepared up front; a request is a dict lookup and one send of the body. Clients
+    get the smallest encoding they accept, and revalidations that match the ETag get a bodiless 304.
+    """
+
+    def __init__(self, directory: str | Path):
+        root = Path(directory)
+        self._assets: dict[str, Asset] = {}
+        size = 0
+        for path in sorted(root.rglob("*")):
+            if not path.is_file() or (path.suffix in (".br", ".gz") and path.with_suffix("").is_file()):
+                continue  # directories, and the build's compressed variants, which belong to their originals
+            relpath = path.relative_to(root).as_posix()
+            body = path.read_bytes()
+            size += len(body)
+            self._assets[relpath] = Asset(path, relpath, body)
+        self._not_found = self._assets.get("404.html")
+        logger.info(f"Loaded {len(self._assets)} static files ({size} bytes) from {root}")
+
+    def lookup(self, path: str) -> Asset | None:
+        path = path.lstrip("/")
+        if path == "" or path.endswith("/"):
+            return self._assets.get(path + "index.html")
+        return self._assets.get(path)
+
+    def is_directory(self, path: str) -> bool:
+        """Whether ``path`` names a directory with an index.html, to be redirected to its trailing-slash URL."""
+        path = path.strip("/")
+        return bool(path) and path + "/index.html" in self._assets
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return
+        if scope["method"] not in ("GET", "HEAD"):
+            await self._respond(send, 405, [(b"allow", b"GET, HEAD")], b"Method Not Allowed", "none")
+            return
+
+        status = 200
+        # mounted below the root, the request path still carries the mount's prefix
+        path = scope["path"].removeprefix(scope.get("root_path", ""))
+        asset = self.lookup(path)
+        if asset is None and self.is_directory(path):
+            # as StaticFiles(html=True) does, so relative URLs in the page resolve inside the directory
+            location = scope["path"] + "/"
+            if scope.get("query_string"):
+                location += "?" + scope["query_string"].decode("latin-1")
+            await self._respond(send, 307, [(b"location", location.encode("latin-1"))], b"", "none")
+            return
+        if asset is None:
+            if self._not_found is None:
+                await self._respond(send, 404, [(b"content-type", b"text/plain")], b"Not Found", "none")
+                return
+            status, asset = 404, self._not_found
+
+        accept_encoding = if_none_match = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+            elif name == b"if-none-match":
+                if_none_match = value.decode("latin-1")
+        encoding, representation = asset.negotiate(accept_encoding)
+
+        if status == 200 and if_none_match and _etag_matches(if_none_match, representation):
+            await self._respond(send, 304, representation.not_modified_headers, b"", encoding or "identity")
+            return
+        body = b"" if scope["method"] == "HEAD" else representation.body
+        await self._respond(send, status, representation.headers, body, encoding or "identity")
+
+    async def _respond(self, send, status: int, headers: list, body: bytes, encoding: str) -> None:
+        static_responses.inc(status=str(status), encoding=encoding)
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
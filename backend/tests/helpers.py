@@ -0,0 +1,11 @@
+import asyncio
+
+
+async def until(condition, timeout: float = 5.0) -> None:
+    """Waits for ``condition`` to hold, for work that other tasks, such as a SendQueue writer, finish later."""
+
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.005)
+
+    await asyncio.wait_for(poll(), timeout)
@@ -0,0 +1,195 @@
+import asyncio
+
+import pytest
+from backplane import Backplane, InProcessBackplane, RedisBackplane, encode_command, read_reply
+
+from tests.helpers import until
+
+
+class FakeRedis:
+    """Just enough of Redis pub/sub over RESP to exercise RedisBackplane without a server."""
+
+    def __init__(self):
+        self.subscribers: dict[bytes, set[asyncio.StreamWriter]] = {}
+        self.server: asyncio.AbstractServer | None = None
+        self.connections: set[asyncio.StreamWriter] = set()
+        self.published = 0
+        # PUBLISH replies are withheld while set, leaving the publisher waiting on them
+        self.hold_replies = False
+        # this many replies, to any command, come back as garbage that cannot be parsed
+        self.malformed_replies = 0
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+
+    def drop_connections(self):
+        for writer in self.connections:
+            writer.transport.abort()
+
+    @staticmethod
+    def _confirmation(kind: bytes, channel: bytes) -> bytes:
+        return b"*3\r\n" + encode_command(kind, channel)[4:] + b":1\r\n"
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer)
+        try:
+            while True:
+                command, *args = await read_reply(reader)
+                command = command.upper()
+                if self.malformed_replies:
+                    self.malformed_replies -= 1
+                    writer.write(b"$garbage\r\n")
+                elif command == b"AUTH":
+                    writer.write(b"+OK\r\n")
+                elif command == b"PUBLISH":
+                    channel, data = args
+                    receivers = self.subscribers.get(channel, set())
+                    for subscriber in receivers:
+                        subscriber.write(encode_command("message", channel, data))
+                    self.published += 1
+                    if not self.hold_replies:
+                        writer.write(b":%d\r\n" % len(receivers))
+                elif command == b"SUBSCRIBE":
+                    self.subscribers.setdefault(args[0], set()).add(writer)
+                    writer.write(self._confirmation(b"subscribe", args[0]))
+                elif command == b"UNSUBSCRIBE":
+                    self.subscribers.get(args[0], set()).discard(writer)
+                    writer.write(self._confirmation(b"unsubscribe", args[0]))
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            for receivers in self.subscribers.values():
+                receivers.discard(writer)
+            writer.close()
+
+
+def test_incomplete_backplane_cannot_be_created():
+    class PublishOnly(Backplane):
+        async def publish(self, channel, data):
+            pass
+
+    with pytest.raises(TypeError):
+        PublishOnly()
+
+
+@pytest.mark.asyncio
+async def test_in_process_backplane_delivers_to_subscriber():
+    backplane = InProcessBackplane()
+    received = []
+
+    async def handler(data):
+        received.append(data)
+
+    await backplane.subscribe("a", handler)
+    await backplane.publish("a", b"one")
+    await backplane.publish("b", b"nobody listens")
+    await backplane.unsubscribe("a")
+    await backplane.publish("a", b"two")
+
+    assert received == [b"one"]
+
+
+@pytest.mark.asyncio
+async def test_redis_backplane_pipelines_publishes_in_order():
+    redis = FakeRedis()
+    port = await redis.start()
+    publisher = RedisBackplane(f"redis://127.0.0.1:{port}")
+    subscriber = RedisBackplane(f"redis://127.0.0.1:{port}")
+    await publisher.start()
+    await subscriber.start()
+
+    received = []
+    done = asyncio.Event()
+
+    async def handler(data):
+        received.append(data)
+        if len(received) == 50:
+            done.set()
+
+    await subscriber.subscribe("purestream:worker:b", handler)
+    await asyncio.sleep(0.05)
+
+    await asyncio.gather(*(publisher.publish("purestream:worker:b", b"msg-%d" % i) for i in range(50)))
+    await asyncio.wait_for(done.wait(), timeout=1)
+    assert received == [b"msg-%d" % i for i in range(50)]
+
+    await subscriber.close()
+    await publisher.close()
+    await redis.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_backplane_reconnects_and_resubscribes_after_losing_the_server():
+    redis = FakeRedis()
+    port = await redis.start()
+    backplane = RedisBackplane(f"redis://127.0.0.1:{port}", reconnect_delays=(0.01,))
+    resets = []
+
+    async def on_reset():
+        resets.append(True)
+
+    backplane.on_reset = on_reset
+    await backplane.start()
+
+    received = []
+
+    async def handler(data):
+        received.append(data)
+
+    await backplane.subscribe("purestream:worker:a", handler)
+    await until(lambda: redis.subscribers.get(b"purestream:worker:a"))
+
+    redis.hold_replies = True
+    in_flight = asyncio.create_task(backplane.publish("purestream:worker:a", b"lost"))
+    await until(lambda: redis.published == 1)
+    redis.drop_connections()
+
+    # the publish waiting on the dropped connection fails instead of hanging
+    with pytest.raises(ConnectionError):
+        await asyncio.wait_for(in_flight, timeout=1)
+    await until(lambda: resets)
+
+    redis.hold_replies = False
+    # the subscription is restored on the new connection
+    await until(lambda: redis.subscribers.get(b"purestream:worker:a"))
+    await backplane.publish("purestream:worker:a", b"after")
+    await until(lambda: b"after" in received)
+
+    await backplane.close()
+    await redis.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_backplane_reconnects_after_malformed_replies():
+    redis = FakeRedis()
+    port = await redis.start()
+    backplane = RedisBackplane(f"redis://:secret@127.0.0.1:{port}", reconnect_delays=(0.01,))
+    await backplane.start()
+    received = []
+
+    async def handler(data):
+        received.append(data)
+
+    await backplane.subscribe("purestream:worker:a", handler)
+    await until(lambda: redis.subscribers.get(b"purestream:worker:a"))
+
+    # the first garbles a publish reply and ends the connection; the second garbles AUTH on the way back
+    redis.malformed_replies = 2
+    with pytest.raises(ConnectionError):
+        await asyncio.wait_for(backplane.publish("purestream:worker:a", b"lost"), timeout=1)
+
+    await until(lambda: redis.subscribers.get(b"purestream:worker:a") and backplane._pub_writer is not None)
+    await backplane.publish("purestream:worker:a", b"after")
+    await until(lambda: b"after" in received)
+    assert redis.malformed_replies == 0
+
+    await backplane.close()
+    await redis.close()
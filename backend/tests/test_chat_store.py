@@ -0,0 +1,55 @@
+from unittest.mock import AsyncMock
+
+import pytest
+from chat_store import ChatEntry, ChatLog, ChatRing, chat_writes
+from connection_manager import ConnectionManager
+from encoding import loads
+from message_types import chat_message
+
+
+def entry(text: str) -> ChatEntry:
+    return ChatEntry.encode(chat_message("user", "Alice", text, 0))
+
+
+def texts(frame) -> list[str]:
+    return [message["text"] for message in loads(frame.text)["messages"]]
+
+
+def test_ring_pages_back_from_the_newest_entry():
+    ring = ChatRing(capacity=3)
+    entries = [entry(str(i)) for i in range(5)]
+    for item in entries:
+        ring.append(item)
+
+    assert [item.message["text"] for item in ring] == ["2", "3", "4"]
+    assert ring.page(None, 2) == (entries[3:], True)
+    assert ring.page(entries[3].id, 2) == (entries[2:3], False)
+
+
+@pytest.mark.asyncio
+async def test_history_is_paged_and_outlives_the_room_with_a_chat_log(tmp_path):
+    log = ChatLog(str(tmp_path / "chat.db"), flush_interval=60)
+    manager = ConnectionManager(chat_log=log, chat_history_size=3)
+    await manager.join_room("room", "alice", AsyncMock(), "Alice")
+    assert await manager.get_chat_page("room") is None
+
+    for i in range(6):
+        frame = await manager.add_chat_message("room", chat_message("alice", "Alice", str(i), 0))
+    assert loads(frame.text)["text"] == "5"
+
+    latest = await manager.get_chat_page("room", limit=2)
+    assert texts(latest) == ["4", "5"]
+    assert loads(latest.text)["hasMore"] is True
+
+    # past the ring's three messages the page continues from the log, which has the queued writes by then
+    written_before = chat_writes.value(outcome="written")
+    older = await manager.get_chat_page("room", before=loads(latest.text)["messages"][0]["id"], limit=4)
+    assert texts(older) == ["0", "1", "2", "3"]
+    assert loads(older.text)["hasMore"] is False
+    assert chat_writes.value(outcome="written") - written_before == 6
+
+    await manager.leave_room("room", "alice")
+    await manager.join_room("room", "bob", AsyncMock(), "Bob")
+    assert texts(await manager.get_chat_page("room", limit=2)) == ["4", "5"]
+    assert [item.message["text"] for item in manager._rooms["room"].chat] == ["4", "5"]
+    await manager.close()
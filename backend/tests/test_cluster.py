@@ -0,0 +1,101 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+from backplane import InProcessBackplane
+from cluster import Cluster, HashRing
+from fastapi import WebSocketDisconnect
+
+
+def test_hash_ring_moves_few_rooms_when_a_worker_joins():
+    rooms = [f"room-{i}" for i in range(1000)]
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b", "c", "d"])
+
+    moved = [room for room in rooms if before.node_for(room) != after.node_for(room)]
+    assert all(after.node_for(room) == "d" for room in moved)
+    assert 150 < len(moved) < 350
+    assert {before.node_for(room) for room in rooms} == {"a", "b", "c"}
+
+
+@pytest.mark.asyncio
+async def test_proxied_session_is_served_by_room_owner():
+    backplane = InProcessBackplane()
+    workers = ["a", "b"]
+    owner, proxy = Cluster("a", workers, backplane), Cluster("b", workers, backplane)
+    room_id = next(f"room-{i}" for i in range(100) if owner.owns(f"room-{i}"))
+    served = []
+
+    async def runner(websocket, room, user, binary, receive):
+        served.append((room, user, binary))
+        try:
+            while True:
+                message = await receive()
+                await websocket.send_text(f"echo:{message['text']}")
+        except WebSocketDisconnect:
+            await websocket.close(code=1000)
+            served.append("closed")
+
+    await owner.start(runner)
+    await proxy.start(runner)
+
+    client = AsyncMock()
+    inbound: asyncio.Queue = asyncio.Queue()
+
+    async def receive():
+        message = await inbound.get()
+        if message is None:
+            raise WebSocketDisconnect(1000)
+        return message
+
+    session = asyncio.create_task(proxy.proxy(client, room_id, "alice", False, receive))
+    await inbound.put({"type": "websocket.receive", "text": "hi"})
+    await asyncio.sleep(0.01)
+
+    assert served == [(room_id, "alice", False)]
+    client.send_text.assert_awaited_once_with("echo:hi")
+
+    await inbound.put(None)
+    await session
+    await asyncio.sleep(0.01)
+    assert served[-1] == "closed"
+
+    await proxy.close()
+    await owner.close()
+
+
+@pytest.mark.asyncio
+async def test_backplane_reset_ends_sessions_on_both_sides_uncleanly():
+    backplane = InProcessBackplane()
+    workers = ["a", "b"]
+    owner, proxy = Cluster("a", workers, backplane), Cluster("b", workers, backplane)
+    room_id = next(f"room-{i}" for i in range(100) if owner.owns(f"room-{i}"))
+    ended = []
+
+    async def runner(websocket, room, user, binary, receive):
+        try:
+            while True:
+                await receive()
+        except WebSocketDisconnect as e:
+            ended.append(e.code)
+
+    await owner.start(runner)
+    await proxy.start(runner)
+
+    client = AsyncMock()
+    inbound: asyncio.Queue = asyncio.Queue()
+    session = asyncio.create_task(proxy.proxy(client, room_id, "alice", False, inbound.get))
+    await asyncio.sleep(0.01)
+
+    await owner._on_backplane_reset()
+    await proxy._on_backplane_reset()
+    await asyncio.sleep(0.01)
+
+    # the owner parks the session rather than ending it, and the client reconnects to resume it
+    assert ended == [1011]
+    client.close.assert_awaited_once_with(code=1011, reason="backplane reset")
+
+    session.cancel()
+    await asyncio.gather(session, return_exceptions=True)
+    await proxy.close()
+    await owner.close()
@@ -1,7 +1,12 @@
-from unittest.mock import AsyncMock
+import asyncio
+import json
+from unittest.mock import AsyncMock, patch
 
 import pytest
 from connection_manager import ConnectionManager
+from message_types import chat_message, session_message
+
+from tests.helpers import until
 
 
 @pytest.fixture
@@ -88,8 +93,163 @@ async def test_cleanup_stale_connections(manager):
     async with manager._lock:
         manager._rooms[room_id].users[user_id].last_heartbeat = time.time() - 40
 
-    removed = await manager.cleanup_stale_connections()
+    # expiry is scheduled from the heartbeat at join; let that deadline pass too
+    with patch("connection_manager.time.time", return_value=time.time() + 40):
+        removed = await manager.cleanup_stale_connections()
     assert len(removed) == 1
     assert removed[0][0] == room_id
     assert removed[0][1] == user_id
     assert not manager.room_exists(room_id)
+    ws.close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_reschedules_expiry(manager):
+    import time
+
+    ws = AsyncMock()
+    await manager.join_room("test_room", "user_1", ws, "Alice")
+
+    later = time.time() + 40
+    with patch("connection_manager.time.time", return_value=later):
+        await manager.update_heartbeat("test_room", "user_1")
+        assert await manager.cleanup_stale_connections() == []
+
+    # the live connection was pushed back with a fresh deadline rather than dropped
+    assert manager.room_exists("test_room")
+    assert len(manager._expiry) == 1
+    assert manager._expiry[0][0] == later + 30
+    ws.close.assert_not_awaited()
+
+    await manager.leave_room("test_room", "user_1")
+
+
+@pytest.mark.asyncio
+async def test_slow_send_does_not_block_other_rooms(manager):
+    release = asyncio.Event()
+
+    async def stalled_send(_):
+        await release.wait()
+
+    slow_ws = AsyncMock()
+    slow_ws.send_text.side_effect = stalled_send
+    fast_ws = AsyncMock()
+
+    await manager.join_room("room_a", "slow", slow_ws, "Slow")
+    await manager.join_room("room_b", "fast", fast_ws, "Fast")
+
+    await asyncio.wait_for(manager.broadcast("room_a", {"type": "chat"}), timeout=1)
+    await until(lambda: slow_ws.send_text.await_count)
+    slow_ws.send_text.assert_awaited_once()
+
+    # room A's lock is free while its send is pending, and room B is unaffected
+    assert await manager.get_username("room_a", "slow") == "Slow"
+    await asyncio.wait_for(manager.broadcast("room_b", {"type": "chat"}), timeout=1)
+    await until(lambda: fast_ws.send_text.await_count)
+    fast_ws.send_text.assert_awaited_once()
+
+    release.set()
+    await manager.leave_room("room_a", "slow")
+    await manager.leave_room("room_b", "fast")
+
+
+@pytest.mark.asyncio
+async def test_user_list_frame_is_cached_until_roster_changes(manager):
+    ws = AsyncMock()
+    await manager.join_room("test_room", "user_1", ws, "Alice")
+
+    frame = await manager.get_user_list_frame("test_room")
+    assert await manager.get_user_list_frame("test_room") is frame
+
+    # a no-op update keeps the cached frame, a real change invalidates it
+    await manager.update_call_state("test_room", "user_1", False)
+    assert await manager.get_user_list_frame("test_room") is frame
+    await manager.update_call_state("test_room", "user_1", True)
+    refreshed = await manager.get_user_list_frame("test_room")
+    assert refreshed is not frame
+    assert '"inCall":true' in refreshed.text
+
+    await manager.leave_room("test_room", "user_1")
+
+
+@pytest.mark.asyncio
+async def test_whiteboard_ops_are_compacted_into_snapshot(manager):
+    room_id = "test_room"
+    await manager.join_room(room_id, "user_1", AsyncMock(), "Alice")
+    assert await manager.get_whiteboard_frame(room_id) is None
+
+    await manager.set_whiteboard_owner(room_id, "user_1")
+    await manager.apply_whiteboard_update(room_id, {"type": "path", "obj": {"id": "a", "left": 1}})
+    await manager.apply_whiteboard_update(room_id, {"type": "add", "obj": {"id": "b", "text": "hi"}})
+    await manager.apply_whiteboard_update(room_id, {"type": "modify", "obj": {"id": "a", "left": 5}})
+    await manager.apply_whiteboard_update(room_id, {"type": "add", "obj": {"id": "c"}})
+    await manager.apply_whiteboard_update(room_id, {"type": "delete", "ids": ["b"]})
+    assert not await manager.apply_whiteboard_update(room_id, {"type": "bogus"})
+
+    snapshot = json.loads((await manager.get_whiteboard_frame(room_id)).text)
+    assert snapshot["type"] == "whiteboard-snapshot"
+    assert snapshot["sender"] == "user_1"
+    assert snapshot["objects"] == [{"id": "a", "left": 5}, {"id": "c"}]
+
+    await manager.apply_whiteboard_update(room_id, {"type": "clear"})
+    snapshot = json.loads((await manager.get_whiteboard_frame(room_id)).text)
+    assert snapshot["objects"] == []
+
+    await manager.set_whiteboard_owner(room_id, None)
+    assert await manager.get_whiteboard_frame(room_id) is None
+
+
+@pytest.mark.asyncio
+async def test_whiteboard_ends_when_its_owner_leaves(manager):
+    await manager.join_room("room", "owner", AsyncMock(), "Alice")
+    await manager.join_room("room", "viewer", AsyncMock(), "Bob")
+    await manager.set_whiteboard_owner("room", "owner")
+    await manager.apply_whiteboard_update("room", {"type": "add", "obj": {"id": "a"}})
+    assert await manager.get_whiteboard_frame("room") is not None
+
+    await manager.leave_room("room", "owner")
+    # a joiner would otherwise be handed a board nobody may edit or clear
+    assert await manager.get_whiteboard_frame("room") is None
+    await manager.join_room("room", "late", AsyncMock(), "Carol")
+    assert await manager.get_whiteboard_frame("room") is None
+
+
+@pytest.mark.asyncio
+async def test_dropped_user_is_parked_and_resumed_on_a_new_socket():
+    manager = ConnectionManager(replay_size=16, resume_grace=60)
+    old_ws = AsyncMock()
+    user = await manager.join_room("room", "alice", old_ws, "Alice")
+    await manager.send_to_user("room", "alice", session_message(user.token, False))
+    await until(lambda: old_ws.send_text.await_count == 1)
+
+    old_ws.send_text.side_effect = ConnectionError
+    await manager.broadcast("room", chat_message("bob", "Bob", "missed", 0))
+    await until(lambda: old_ws.send_text.await_count == 2)
+    assert await manager.park("room", "alice", user, old_ws) is not None
+
+    assert await manager.resume("room", "alice", "wrong", AsyncMock(), 0) is None
+    new_ws = AsyncMock()
+    assert await manager.resume("room", "alice", user.token, new_ws, 0) is user
+    await until(lambda: new_ws.send_text.await_count == 2)
+    sent = [json.loads(c.args[0]) for c in new_ws.send_text.await_args_list]
+    assert [(m["type"], m.get("resumed"), m.get("text")) for m in sent] == [
+        ("session", True, None),
+        ("chat", None, "missed"),
+    ]
+    assert user.ws is new_ws and user.parked_at is None
+
+    # the old socket's session ending must not take the resumed user out of the room
+    assert await manager.park("room", "alice", user, old_ws) is None
+    await manager.join_room("room", "alice", AsyncMock(), "Alice")
+    assert await manager.leave_room("room", "alice", user) is None
+    assert manager.room_exists("room")
+
+
+@pytest.mark.asyncio
+async def test_resume_is_refused_after_the_grace_period():
+    manager = ConnectionManager(replay_size=16, resume_grace=0.01)
+    ws = AsyncMock()
+    user = await manager.join_room("room", "alice", ws, "Alice")
+    await manager.park("room", "alice", user, ws)
+    await asyncio.sleep(0.02)
+    assert await manager.resume("room", "alice", user.token, AsyncMock(), 0) is None
@@ -0,0 +1,40 @@
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+from connection_manager import ConnectionManager
+from cursors import CursorAggregator
+
+from tests.helpers import until
+
+
+@pytest.mark.asyncio
+async def test_cursor_updates_are_batched_per_tick():
+    manager = ConnectionManager()
+    aggregator = CursorAggregator(manager, tick_rate=50)
+    ws = AsyncMock()
+    await manager.join_room("room", "viewer", ws, "Viewer")
+
+    for i in range(10):
+        aggregator.update("room", "alice", "Alice", {"x": i, "y": i})
+    aggregator.update("room", "bob", "Bob", {"x": 5, "y": 5})
+
+    await until(lambda: ws.send_text.await_count >= 1)
+    [call] = ws.send_text.await_args_list
+    message = json.loads(call.args[0])
+    assert message["type"] == "whiteboard-cursors"
+    assert message["cursors"] == [
+        {"sender": "alice", "username": "Alice", "data": {"x": 9, "y": 9}},
+        {"sender": "bob", "username": "Bob", "data": {"x": 5, "y": 5}},
+    ]
+
+    await aggregator.close()
+
+
+@pytest.mark.asyncio
+async def test_ticker_stops_when_idle():
+    manager = ConnectionManager()
+    aggregator = CursorAggregator(manager, tick_rate=100)
+
+    aggregator.update("room", "alice", "Alice", {"x": 1, "y": 1})
+    await until(lambda: aggregator._task is None)
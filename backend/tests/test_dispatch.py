@@ -0,0 +1,41 @@
+from unittest.mock import AsyncMock
+
+import pytest
+from dispatch import Dispatcher, Session, handler_seconds, messages_rejected
+
+
+@pytest.fixture
+def session():
+    return Session(room_id="room", user_id="user_1", user=AsyncMock(), websocket=AsyncMock())
+
+
+@pytest.mark.asyncio
+async def test_routes_to_registered_handler(session):
+    router = Dispatcher()
+    calls = []
+
+    @router.route("test-echo", required=("data",), data=dict)
+    async def handle(session, message):
+        calls.append(message["data"])
+
+    await router.dispatch(session, {"type": "test-echo", "data": {"x": 1}})
+
+    assert calls == [{"x": 1}]
+    assert handler_seconds.count(type="test-echo") == 1
+
+
+@pytest.mark.asyncio
+async def test_invalid_and_unknown_messages_are_rejected(session):
+    router = Dispatcher()
+    handler = AsyncMock()
+    router.route("test-strict", required=("data",), data=dict, target=str)(handler)
+
+    before = messages_rejected.value(type="test-strict")
+    await router.dispatch(session, {"type": "test-strict"})
+    await router.dispatch(session, {"type": "test-strict", "data": "not-a-dict"})
+    await router.dispatch(session, {"type": "test-strict", "data": {}, "target": 5})
+    await router.dispatch(session, {"type": "no-such-type"})
+    await router.dispatch(session, ["not", "a", "message"])
+
+    handler.assert_not_awaited()
+    assert messages_rejected.value(type="test-strict") - before == 3
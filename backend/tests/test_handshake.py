@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+from handshake import HandshakeExecutor, handshake_seconds, handshakes
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_bounded_and_followers_run_after_their_handshake():
+    executor = HandshakeExecutor(concurrency=2, deadline=10)
+    release = asyncio.Event()
+    running, order = [], []
+
+    def handshake(key):
+        async def run():
+            running.append(key)
+            await release.wait()
+            order.append(f"answer-{key}")
+
+        return run
+
+    for key in ("a", "b", "c"):
+        executor.submit(key, handshake(key))
+
+    async def candidate():
+        order.append("candidate-c")
+
+    assert executor.follow("c", candidate)
+    assert not executor.follow("nobody", candidate)
+    await asyncio.sleep(0)
+    assert running == ["a", "b"]
+    assert executor.queued == 1
+
+    release.set()
+    while executor.running or executor.queued:
+        await asyncio.sleep(0.01)
+    assert order.index("candidate-c") == order.index("answer-c") + 1
+    assert handshake_seconds.quantile(0.5, stage="running") is not None
+
+
+@pytest.mark.asyncio
+async def test_stale_and_superseded_offers_are_not_run():
+    executor = HandshakeExecutor(concurrency=1, deadline=0.05)
+    release = asyncio.Event()
+    ran, shed = [], []
+
+    def step(log, key):
+        async def run():
+            log.append(key)
+            if key == "slow":
+                await release.wait()
+
+        return run
+
+    shed_before = handshakes.value(outcome="shed")
+    superseded_before = handshakes.value(outcome="superseded")
+    executor.submit("slow", step(ran, "slow"))
+    executor.submit("user", step(ran, "user-first"), step(shed, "user-first"))
+    executor.submit("user", step(ran, "user-second"), step(shed, "user-second"))
+    executor.submit("late", step(ran, "late"), step(shed, "late"))
+
+    await asyncio.sleep(0.1)
+    release.set()
+    while executor.running or executor.queued:
+        await asyncio.sleep(0.01)
+
+    assert ran == ["slow"]
+    assert shed == ["user-second", "late"]
+    assert handshakes.value(outcome="shed") - shed_before == 2
+    assert handshakes.value(outcome="superseded") - superseded_before == 1
+    await executor.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_and_shed_handshakes_refuse_and_count_their_followers():
+    executor = HandshakeExecutor(concurrency=1, deadline=0.05)
+    release = asyncio.Event()
+    refused, candidates = [], []
+    failed_before = handshakes.value(outcome="follower_failed")
+    shed_before = handshakes.value(outcome="follower_shed")
+
+    async def broken():
+        await release.wait()
+        raise RuntimeError("bad offer")
+
+    def refuse(key):
+        async def shed():
+            refused.append(key)
+
+        return shed
+
+    async def candidate():
+        candidates.append(True)
+
+    executor.submit("broken", broken, refuse("broken"))
+    executor.submit("late", broken, refuse("late"))
+    await asyncio.sleep(0)
+    for key in ("broken", "broken", "late"):
+        assert executor.follow(key, candidate)
+
+    await asyncio.sleep(0.1)
+    release.set()
+    while executor.running or executor.queued:
+        await asyncio.sleep(0.01)
+
+    # both clients are told to retry, and their candidates are dropped rather than sent to nothing
+    assert sorted(refused) == ["broken", "late"]
+    assert candidates == []
+    assert handshakes.value(outcome="follower_failed") - failed_before == 2
+    assert handshakes.value(outcome="follower_shed") - shed_before == 1
+    await executor.close()
@@ -0,0 +1,34 @@
+import time
+
+from ice import CandidateBuffer, ice_candidates
+
+CANDIDATE = {"candidate": "candidate:1 1 UDP 2122252543 192.168.1.2 50000 typ host", "sdpMid": "0"}
+
+
+def test_buffer_is_bounded_per_user_and_taken_once():
+    buffer = CandidateBuffer(max_per_user=2)
+    overflow_before = ice_candidates.value(outcome="dropped", reason="overflow")
+
+    for _ in range(3):
+        buffer.add("user", CANDIDATE)
+    buffer.add("other", CANDIDATE)
+
+    assert buffer.take("user") == [CANDIDATE, CANDIDATE]
+    assert buffer.take("user") == []
+    assert len(buffer) == 1
+    assert ice_candidates.value(outcome="dropped", reason="overflow") - overflow_before == 1
+
+
+def test_candidates_without_an_offer_expire(monkeypatch):
+    buffer = CandidateBuffer(ttl=10)
+    expired_before = ice_candidates.value(outcome="dropped", reason="expired")
+    now = time.monotonic()
+    buffer.add("stale", CANDIDATE)
+    buffer.add("slow", CANDIDATE)
+
+    monkeypatch.setattr("ice.time.monotonic", lambda: now + 11)
+    assert buffer.take("slow") == []
+    buffer.add("fresh", CANDIDATE)
+
+    assert len(buffer) == 1
+    assert ice_candidates.value(outcome="dropped", reason="expired") - expired_before == 2
@@ -0,0 +1,40 @@
+import copy
+
+from loadtest import Scenario, compare, compare_startup, measure_startup, run
+
+
+def test_small_run_reports_deliveries_and_passes_against_itself():
+    scenario = Scenario(clients=6, rooms=2, duration=1.0, chat_rate=2, cursor_hz=20, ping_interval=0.5)
+    result = run(scenario)
+
+    assert result["errors"]["failed_joins"] == 0
+    assert {"join", "chat", "cursor", "ping"} <= set(result["latency"])
+    assert result["throughput"]["delivered_per_second"] > 0
+    assert result["server"]["peak_rss_mb"] > 0
+    assert compare(result, result) == []
+
+
+def test_gate_flags_latency_throughput_and_cpu_regressions():
+    baseline = {
+        "latency": {"chat": {"p50": 0.010, "p99": 0.050}},
+        "throughput": {"delivered_per_second": 1000.0},
+        "server": {"cpu_ms_per_1k_delivered": 100.0},
+        "errors": {"failed_joins": 0},
+    }
+    result = copy.deepcopy(baseline)
+    result["latency"]["chat"]["p99"] = 0.055
+    assert compare(result, baseline) == []
+
+    result["latency"]["chat"]["p99"] = 0.100
+    result["throughput"]["delivered_per_second"] = 500.0
+    result["server"]["cpu_ms_per_1k_delivered"] = 200.0
+    assert len(compare(result, baseline)) == 3
+
+
+def test_startup_is_timed_and_passes_against_itself():
+    result = measure_startup(runs=1)
+
+    startup = result["startup"]
+    assert 0 < startup["ready_p50"] == startup["ready_max"]
+    assert startup["media_import"] > 0
+    assert compare_startup(result, result) == []
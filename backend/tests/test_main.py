@@ -1,6 +1,13 @@
+import time
+from unittest.mock import AsyncMock, patch
+
 import pytest
+from connection_manager import HEARTBEAT_TIMEOUT, manager
+from dispatch import messages_rejected
 from fastapi.testclient import TestClient
-from main import app
+from main import app, expire_stale_connections, sfu
+from sfu_loader import voice_peer
+from starlette.websockets import WebSocketDisconnect
 
 
 @pytest.fixture
@@ -22,6 +29,15 @@ def test_turn_credentials(client):
     assert "iceServers" in response.json()
 
 
+def test_metrics_endpoint(client):
+    client.get("/new-room")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE rooms gauge" in response.text
+    assert "# TYPE sfu_handshake_seconds histogram" in response.text
+
+
 def test_websocket_join(client):
     with client.websocket_connect("/ws/room1/user1") as websocket:
         websocket.send_json({"type": "JOIN", "username": "Alice"})
@@ -45,3 +61,44 @@ def test_websocket_chat(client):
         assert data["type"] == "CHAT"
         assert data["text"] == "Hello world"
         assert data["username"] == "Alice"
+
+
+def test_websocket_binary_ping(client):
+    with client.websocket_connect("/ws/room1/user1", subprotocols=["purestream.bin"]) as websocket:
+        assert websocket.accepted_subprotocol == "purestream.bin"
+
+        websocket.send_bytes(b"\x01")
+
+        assert websocket.receive_bytes() == b"\x02"
+
+
+def test_voice_peer_ids_are_not_accepted_as_user_ids(client):
+    # connecting as "x:voice" would let a client answer for, and replace, x's call audio connection
+    with pytest.raises(WebSocketDisconnect) as closed:
+        with client.websocket_connect(f"/ws/room1/{voice_peer('user1')}"):
+            pass
+    assert closed.value.code == 1008
+
+
+def test_malformed_frames_are_dropped_without_ending_the_session(client):
+    with client.websocket_connect("/ws/room1/user1", subprotocols=["purestream.bin"]) as websocket:
+        rejected = messages_rejected.value(type="malformed")
+        websocket.send_bytes(b"\xff")
+        websocket.send_text("{not json")
+
+        websocket.send_bytes(b"\x01")
+        assert websocket.receive_bytes() == b"\x02"
+        assert messages_rejected.value(type="malformed") - rejected == 2
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_expiry_takes_the_users_call_audio_out_of_the_sfu(monkeypatch):
+    cleanup_user = AsyncMock()
+    monkeypatch.setattr(sfu, "cleanup_user", cleanup_user)
+    await manager.join_room("stale-room", "alice", AsyncMock(), "Alice")
+
+    with patch("connection_manager.time.time", return_value=time.time() + HEARTBEAT_TIMEOUT + 10):
+        await expire_stale_connections()
+
+    assert not manager.room_exists("stale-room")
+    cleanup_user.assert_any_await("stale-room", voice_peer("alice"))
@@ -0,0 +1,40 @@
+import pytest
+from message_types import (
+    MessageType,
+    decode_binary,
+    encode_binary,
+    pong_message,
+    whiteboard_cursors_message,
+)
+
+
+def test_cursor_batch_round_trips_and_is_smaller_than_json():
+    import json
+
+    message = whiteboard_cursors_message(
+        [
+            {"sender": "user-1", "username": "Alice", "data": {"x": 120.5, "y": 64.25}},
+            {"sender": "user-2", "username": "Bob", "data": {"x": -3.0, "y": 900.0}},
+        ]
+    )
+
+    binary = encode_binary(message)
+    assert decode_binary(binary) == message
+    assert len(binary) * 2 < len(json.dumps(message))
+
+
+def test_single_cursor_and_pong_frames():
+    cursor = {"type": MessageType.WHITEBOARD_CURSOR, "data": {"x": 1.5, "y": 2.5}}
+    assert len(encode_binary(cursor)) == 9
+    assert decode_binary(encode_binary(cursor)) == cursor
+    assert decode_binary(encode_binary(pong_message())) == pong_message()
+
+
+def test_messages_without_binary_form():
+    assert encode_binary({"type": MessageType.CHAT, "text": "hi"}) is None
+    assert encode_binary({"type": MessageType.WHITEBOARD_CURSOR, "data": {"x": "nope"}}) is None
+
+    with pytest.raises(ValueError):
+        decode_binary(b"\x7f")
+    with pytest.raises(ValueError):
+        decode_binary(b"\x03\x00")
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+from metrics import Registry, TimedLock
+
+
+def test_render_prometheus_text_format():
+    registry = Registry()
+    registry.counter("requests_total", "Requests, by path").inc(path='/a"b')
+    registry.gauge("depth", "Queue depth").replace([({"queue": "q1"}, 3), ({"queue": "q2"}, 0.5)])
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(2.0)
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{path="/a\\"b"} 1' in lines
+    assert 'depth{queue="q1"} 3' in lines
+    assert 'depth{queue="q2"} 0.5' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "latency_seconds_sum 2.55" in lines
+    assert "latency_seconds_count 3" in lines
+
+
+@pytest.mark.asyncio
+async def test_timed_lock_records_waits():
+    histogram = Registry().histogram("wait_seconds", "Wait", buckets=(0.01, 1.0))
+    lock = TimedLock(histogram, lock="test")
+
+    async def hold():
+        async with lock:
+            await asyncio.sleep(0.05)
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    async with lock:
+        pass
+    await holder
+
+    assert histogram.count(lock="test") == 2
+    assert histogram.quantile(1.0, lock="test") == 1.0
@@ -0,0 +1,158 @@
+import asyncio
+from types import SimpleNamespace
+
+import av
+import pytest
+from aiortc import RTCPeerConnection, VideoStreamTrack
+from aiortc.contrib.media import MediaRelay
+from passthrough import (
+    EncodedFrameTap,
+    EncodedTrack,
+    ForwardingTrack,
+    GopCache,
+    KeyframeRequester,
+    MediaSource,
+    is_keyframe,
+)
+from sfu import SFUManager
+
+VP8 = SimpleNamespace(mimeType="video/VP8", clockRate=90000)
+
+
+def test_keyframe_detection():
+    assert is_keyframe("video/VP8", b"\x10\x02\x00\x9d\x01\x2a")
+    assert not is_keyframe("video/VP8", b"\x11\x02\x00")
+    assert is_keyframe("video/H264", b"\x00\x00\x00\x01\x67\x42" + b"\x00\x00\x01\x65\x88")
+    assert not is_keyframe("video/H264", b"\x00\x00\x00\x01\x41\x9a")
+    assert is_keyframe("audio/opus", b"\x78")
+
+
+@pytest.mark.asyncio
+async def test_tap_forwards_packets_and_decodes_only_on_demand():
+    track = EncodedTrack("video")
+    tap = EncodedFrameTap(track)
+
+    tap.put((VP8, SimpleNamespace(data=b"\x10frame", timestamp=3000)))
+    packet = await track.recv()
+    assert bytes(packet) == b"\x10frame"
+    assert packet.pts == 3000 and packet.is_keyframe
+    assert tap.empty()
+
+    source = MediaSource(kind="video", receiver=None, decoded=object(), encoded=track, codec="video/VP8", tap=tap)
+    assert source.track_for("video/vp8") is track
+    assert source.track_for("video/H264") is source.decoded
+    tap.put((VP8, SimpleNamespace(data=b"\x11delta", timestamp=6000)))
+    assert tap.qsize() == 1
+
+
+def packet(data: bytes, keyframe: bool):
+    p = av.Packet(data)
+    p.is_keyframe = keyframe
+    return p
+
+
+def test_gop_cache_holds_frames_since_keyframe_within_bounds():
+    cache = GopCache(max_frames=3, max_bytes=1024)
+    orphan = packet(b"d0", False)
+    cache.add(orphan)
+    key, d1, d2 = packet(b"k", True), packet(b"d1", False), packet(b"d2", False)
+    for p in (key, d1, d2):
+        cache.add(p)
+
+    assert cache.frames_before(orphan) is None
+    assert cache.frames_before(d2) == [key, d1]
+
+    cache.add(packet(b"d3", False))  # a fourth frame overflows the GOP, which stays uncached until a keyframe
+    assert cache.frames_before(d2) is None
+
+
+@pytest.mark.asyncio
+async def test_keyframe_requests_are_coalesced_per_interval():
+    sent = []
+    requester = KeyframeRequester(lambda: sent.append(1), interval=0.05)
+
+    for _ in range(10):
+        requester.request()
+    assert len(sent) == 1
+    await asyncio.sleep(0.08)
+    assert len(sent) == 2  # one trailing request covers the nine held back
+
+    requester.request()
+    requester.keyframe_received()  # the keyframe arrived before the held back request was due
+    await asyncio.sleep(0.08)
+    assert len(sent) == 2
+
+
+@pytest.mark.asyncio
+async def test_late_viewer_starts_from_cached_gop(monkeypatch):
+    monkeypatch.setattr("passthrough.viewer_codec", lambda pc, sender: "video/VP8")
+    track = EncodedTrack("video")
+    tap = EncodedFrameTap(track)
+    source = MediaSource(kind="video", receiver=None, decoded=object(), encoded=track, codec="video/VP8", tap=tap)
+    relay = MediaRelay()
+    early = relay.subscribe(track)
+
+    for i, data in enumerate([b"\x10key", b"\x11d1", b"\x11d2"]):
+        tap.put((VP8, SimpleNamespace(data=data, timestamp=i * 3000)))
+        await early.recv()
+
+    published = asyncio.Event()
+    published.set()
+    late = ForwardingTrack(relay, lambda: source, published, pc=None, kind="video")
+    late.sender = SimpleNamespace(_handle_rtcp_packet=None)
+    tap.put((VP8, SimpleNamespace(data=b"\x11d3", timestamp=9000)))
+    received = [bytes(await late.recv()) for _ in range(4)]
+    assert received == [b"\x10key", b"\x11d1", b"\x11d2", b"\x11d3"]
+
+    early.stop()
+    late.stop()
+
+
+@pytest.mark.asyncio
+async def test_viewer_receives_sharer_video_without_server_decoding():
+    sfu = SFUManager()
+    sharer, viewer = RTCPeerConnection(), RTCPeerConnection()
+    received = asyncio.Event()
+
+    @viewer.on("track")
+    def on_track(track):
+        async def read():
+            await track.recv()
+            received.set()
+
+        asyncio.ensure_future(read())
+
+    try:
+        sharer.addTrack(VideoStreamTrack())
+        await sharer.setLocalDescription(await sharer.createOffer())
+        await sharer.setRemoteDescription(await sfu.handle_offer("room", "sharer", sharer.localDescription.sdp, True))
+
+        viewer.addTransceiver("video", direction="recvonly")
+        await viewer.setLocalDescription(await viewer.createOffer())
+        await viewer.setRemoteDescription(await sfu.handle_offer("room", "viewer", viewer.localDescription.sdp, False))
+
+        await asyncio.wait_for(received.wait(), timeout=10)
+        [layer] = sfu._room_media["room"].video_layers
+        assert not layer.source.tap.decode
+        rows = await sfu.get_peer_stats()
+        assert {(row["user"], row["direction"], row["kind"]) for row in rows} >= {
+            ("sharer", "in", "video"),
+            ("viewer", "out", "video"),
+        }
+    finally:
+        await viewer.close()
+        await sharer.close()
+        await sfu.close()
+
+
+@pytest.mark.asyncio
+async def test_aiortc_still_has_the_internals_the_sfu_hooks_into():
+    # passthrough and speakers patch these private attributes; an aiortc release without them only falls back
+    # to transcoding and guesswork, so this is what notices
+    pc = RTCPeerConnection()
+    transceiver = pc.addTransceiver("video")
+    for name in ("_RTCRtpReceiver__decoder_queue", "_handle_rtp_packet", "_send_rtcp_pli"):
+        assert hasattr(transceiver.receiver, name), name
+    assert hasattr(transceiver.sender, "_handle_rtcp_packet")
+    assert hasattr(transceiver, "_codecs")
+    await pc.close()
@@ -0,0 +1,82 @@
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+from connection_manager import ConnectionManager
+from roster import RosterScheduler, roster_merged
+
+from tests.helpers import until
+
+
+def sent_messages(ws):
+    return [json.loads(call.args[0]) for call in ws.send_text.await_args_list]
+
+
+@pytest.mark.asyncio
+async def test_changes_within_window_are_merged():
+    manager = ConnectionManager()
+    scheduler = RosterScheduler(manager, window=0.02)
+    ws = AsyncMock()
+    await manager.join_room("room", "user_1", ws, "Alice")
+    for i in range(3):
+        await manager.join_room("room", f"member_{i}", AsyncMock(), f"Member {i}")
+
+    merged_before = roster_merged.value()
+    await manager.join_room("room", "guest", AsyncMock(), "Guest")
+    await scheduler.user_joined("room", "guest")
+    await manager.update_call_state("room", "guest", True)
+    await scheduler.user_updated("room", "guest")
+
+    await until(lambda: ws.send_text.await_count >= 1)
+    assert roster_merged.value() - merged_before == 1
+    [message] = sent_messages(ws)
+    assert message["type"] == "user-joined"
+    assert message["user"]["id"] == "guest"
+    assert message["user"]["inCall"] is True
+    assert message["seq"] == 1
+
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_deltas_carry_consecutive_seq():
+    manager = ConnectionManager()
+    scheduler = RosterScheduler(manager, window=0)
+    ws = AsyncMock()
+    await manager.join_room("room", "user_1", ws, "Alice")
+    for i in range(3):
+        await manager.join_room("room", f"member_{i}", AsyncMock(), f"Member {i}")
+
+    await manager.leave_room("room", "member_0")
+    await scheduler.user_left("room", "member_0")
+    await manager.update_username("room", "member_1", "Renamed")
+    await scheduler.user_updated("room", "member_1")
+    await until(lambda: ws.send_text.await_count >= 2)
+
+    left, updated = sent_messages(ws)
+    assert left == {"type": "user-left", "userId": "member_0", "seq": 1}
+    assert updated["type"] == "user-updated"
+    assert updated["user"]["username"] == "Renamed"
+    assert updated["seq"] == 2
+
+    snapshot = json.loads((await manager.get_user_list_frame("room")).text)
+    assert snapshot["seq"] == 2
+    assert len(snapshot["users"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_batch_covering_most_of_room_sends_snapshot():
+    manager = ConnectionManager()
+    scheduler = RosterScheduler(manager, window=0.02)
+    ws = AsyncMock()
+    await manager.join_room("room", "user_1", ws, "Alice")
+
+    for i in range(5):
+        await manager.join_room("room", f"guest_{i}", AsyncMock(), f"Guest {i}")
+        await scheduler.user_joined("room", f"guest_{i}")
+
+    await until(lambda: ws.send_text.await_count >= 1)
+    [message] = sent_messages(ws)
+    assert message["type"] == "user-list"
+    assert message["seq"] == 1
+    assert len(message["users"]) == 6
@@ -0,0 +1,105 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+from encoding import Frame
+from send_queue import OverflowPolicy, SendQueue
+
+from tests.helpers import until
+
+
+@pytest.mark.asyncio
+async def test_frames_are_sent_in_order():
+    ws = AsyncMock()
+    queue = SendQueue(ws)
+    queue.start()
+
+    queue.put(Frame("chat", "a"))
+    queue.put(Frame("chat", "b"))
+    await until(lambda: ws.send_text.await_count == 2)
+
+    assert [c.args[0] for c in ws.send_text.await_args_list] == ["a", "b"]
+    await queue.close()
+
+
+def test_overflow_drops_oldest_disposable_frame():
+    queue = SendQueue(AsyncMock(), max_size=3)
+
+    queue.put(Frame("whiteboard-cursors", "c1"))
+    queue.put(Frame("chat", "m1"))
+    queue.put(Frame("whiteboard-cursors", "c2"))
+    assert queue.put(Frame("chat", "m2"))
+
+    assert [frame.text for _, frame in queue._frames] == ["m1", "c2", "m2"]
+    assert queue.dropped == 1
+
+
+def test_user_list_is_coalesced():
+    queue = SendQueue(AsyncMock())
+
+    queue.put(Frame("user-list", "v1"))
+    queue.put(Frame("chat", "m1"))
+    queue.put(Frame("user-list", "v2"))
+
+    assert [frame.text for _, frame in queue._frames] == ["v2", "m1"]
+
+
+@pytest.mark.asyncio
+async def test_overflow_without_disposable_frames_disconnects():
+    ws = AsyncMock()
+    queue = SendQueue(ws, max_size=2, policies={"cursor": OverflowPolicy.DROP_OLDEST})
+
+    queue.put(Frame("chat", "m1"))
+    queue.put(Frame("chat", "m2"))
+    assert queue.put(Frame("cursor", "c1"))
+    assert not queue.put(Frame("chat", "m3"))
+    assert queue.closed
+
+    queue.start()
+    await until(lambda: ws.close.await_count)
+    ws.close.assert_awaited_once()
+    ws.send_text.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_stalled_send_disconnects_after_timeout():
+    ws = AsyncMock()
+
+    async def stalled_send(_):
+        await asyncio.sleep(10)
+
+    ws.send_text.side_effect = stalled_send
+    queue = SendQueue(ws, slow_consumer_timeout=0.01)
+    queue.start()
+    queue.put(Frame("chat", "m1"))
+
+    await until(lambda: ws.close.await_count)
+    assert queue.closed
+    ws.close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_reattach_replays_what_the_client_missed():
+    dropped = AsyncMock()
+    queue = SendQueue(dropped, replay_size=2)
+    queue.start()
+    for text in ("before", "s1", "m1", "m2"):
+        queue.put(Frame("session" if text == "s1" else "chat", text))
+    await until(lambda: dropped.send_text.await_count == 4)
+    assert queue.sent == 2
+
+    # the socket died: sends fail but frames keep queueing for a reattach
+    dropped.send_text.side_effect = ConnectionError
+    queue.put(Frame("chat", "m3"))
+    queue.put(Frame("chat", "m4"))
+    await until(lambda: queue._task.done())
+    assert not queue.closed
+
+    # m3 was counted as sent and went nowhere, m1 is older than the replay buffer
+    assert not await queue.reattach(AsyncMock(), False, 0, Frame("session", "hello"))
+    ws = AsyncMock()
+    assert await queue.reattach(ws, False, 2, Frame("session", "hello"))
+    await until(lambda: ws.send_text.await_count == 3)
+    assert [c.args[0] for c in ws.send_text.await_args_list] == ["hello", "m3", "m4"]
+    assert queue.sent == 4
+    await queue.close()
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+from ice import ice_candidates
+from sfu import NegotiationState, SFUManager
+
+
+async def publish(sfu: SFUManager, user_id: str) -> RTCPeerConnection:
+    sharer = RTCPeerConnection()
+    sharer.addTrack(VideoStreamTrack())
+    await sharer.setLocalDescription(await sharer.createOffer())
+    await sharer.setRemoteDescription(await sfu.handle_offer("room", user_id, sharer.localDescription.sdp, True))
+    return sharer
+
+
+@pytest.mark.asyncio
+async def test_viewer_connection_is_renegotiated_and_reused_across_sharers():
+    sfu = SFUManager()
+    signals: asyncio.Queue = asyncio.Queue()
+    frames: asyncio.Queue = asyncio.Queue()
+    viewer = RTCPeerConnection()
+    tracks = []
+
+    async def on_signal(room_id, user_id, data):
+        signals.put_nowait((user_id, data))
+
+    sfu.on_signal = on_signal
+
+    @viewer.on("track")
+    def on_track(track):
+        tracks.append(track)
+
+        async def read():
+            while True:
+                frames.put_nowait(await track.recv())
+
+        if track.kind == "video":
+            asyncio.ensure_future(read())
+
+    async def receives_from_current_sharer():
+        selector = sfu._connections["viewer"].selector
+        while True:
+            await asyncio.wait_for(frames.get(), timeout=10)
+            if selector.layer is not None and selector.layer in sfu._room_media["room"].video_layers:
+                return
+
+    sharers = []
+    try:
+        # offers no audio slot, so the SFU has to offer its audio track itself
+        viewer.addTransceiver("video", direction="recvonly")
+        await viewer.setLocalDescription(await viewer.createOffer())
+        await viewer.setRemoteDescription(await sfu.handle_offer("room", "viewer", viewer.localDescription.sdp, False))
+        await sfu.renegotiate("viewer")
+
+        user_id, data = await asyncio.wait_for(signals.get(), timeout=10)
+        assert (user_id, data["type"]) == ("viewer", "offer")
+        await viewer.setRemoteDescription(RTCSessionDescription(sdp=data["sdp"], type="offer"))
+        await viewer.setLocalDescription(await viewer.createAnswer())
+        await sfu.handle_answer("viewer", viewer.localDescription.sdp)
+        assert sorted(track.kind for track in tracks) == ["audio", "video"]
+
+        for sharer_id in ("first", "second"):
+            sharers.append(await publish(sfu, sharer_id))
+            await receives_from_current_sharer()
+            await sfu.cleanup_user("room", sharer_id)
+            assert sfu.get_room_info("room")["has_sharer"] is False
+
+        # the same tracks carried both sharers, without another handshake
+        assert len(tracks) == 2
+        assert signals.empty()
+    finally:
+        await viewer.close()
+        for sharer in sharers:
+            await sharer.close()
+        await sfu.close()
+
+
+@pytest.mark.asyncio
+async def test_candidates_before_the_offer_are_applied_once_it_is_answered():
+    sfu = SFUManager()
+    viewer = RTCPeerConnection()
+    candidate = {"candidate": "candidate:1 1 UDP 2122252543 192.0.2.1 50000 typ host", "sdpMid": "0"}
+    applied_before = ice_candidates.value(outcome="applied")
+    try:
+        await sfu.handle_ice_candidate("viewer", candidate)
+        assert sfu.get_user_info("viewer") is None
+
+        viewer.addTransceiver("video", direction="recvonly")
+        await viewer.setLocalDescription(await viewer.createOffer())
+        await sfu.handle_offer("room", "viewer", viewer.localDescription.sdp, False)
+
+        assert sfu.get_user_info("viewer")["negotiation_state"] == NegotiationState.ESTABLISHED.value
+        assert ice_candidates.value(outcome="applied") - applied_before == 1
+        await sfu.handle_ice_candidate("viewer", candidate)
+        assert ice_candidates.value(outcome="applied") - applied_before == 2
+    finally:
+        await viewer.close()
+        await sfu.close()
@@ -0,0 +1,22 @@
+import pytest
+from sfu_loader import LazySFU, voice_peer, voice_user
+
+
+def test_voice_peers_map_back_to_their_user():
+    assert voice_user(voice_peer("alice")) == "alice"
+    assert voice_user("alice") is None
+
+
+@pytest.mark.asyncio
+async def test_media_stack_is_only_loaded_by_signals_that_need_it():
+    sfu = LazySFU()
+    await sfu.cleanup_user("room", "alice")
+    await sfu.set_voice_state("room", "alice", False, False)
+    assert await sfu.get_peer_stats() == []
+    assert not sfu.loaded
+
+    # a candidate ahead of its offer loads the SFU, which holds it for the connection the offer creates
+    await sfu.handle_ice_candidate("alice", {"candidate": "candidate:1 1 udp 1 127.0.0.1 9 typ host"})
+    assert sfu.loaded
+    await sfu.cleanup_user("room", "alice")
+    await sfu.close()
@@ -0,0 +1,94 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+from aiortc import RTCPeerConnection
+from encoding import dumps
+from sfu_pool import SFUPool, SFUWorker, SFUWorkerError
+
+
+def fake_pool(size: int) -> SFUPool:
+    pool = SFUPool(0)
+    pool._workers = [SFUWorker(i, f"/nonexistent/{i}") for i in range(size)]
+    for worker in pool._workers:
+        worker.alive = True
+        worker.call = AsyncMock(return_value={"sdp": "v=0"})
+    return pool
+
+
+@pytest.mark.asyncio
+async def test_rooms_are_placed_on_least_loaded_worker_and_stay_there():
+    pool = fake_pool(2)
+
+    await pool.handle_offer("busy", "sharer", "offer", True)
+    await pool.handle_offer("busy", "viewer-1", "offer", False)
+    await pool.handle_offer("quiet", "viewer-2", "offer", False)
+    await pool.handle_offer("busy", "viewer-3", "offer", False)
+
+    assert pool.get_worker_loads() == [3, 1]
+    busy_worker = pool._workers[0]
+    assert busy_worker.call.await_count == 3
+
+    await pool.handle_ice_candidate("viewer-2", {"candidate": "candidate:1"})
+    pool._workers[1].call.assert_awaited_with("candidate", user="viewer-2", candidate={"candidate": "candidate:1"})
+
+    await pool.cleanup_room("busy")
+    assert pool.get_worker_loads() == [0, 1]
+    assert "busy" not in pool._rooms
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_dead_worker_is_not_used_for_placement():
+    pool = fake_pool(2)
+    pool._workers[0].alive = False
+
+    await pool.handle_offer("room", "viewer", "offer", False)
+    assert pool.get_worker_loads() == [0, 1]
+
+    pool._workers[1].alive = False
+    with pytest.raises(SFUWorkerError):
+        await pool.handle_offer("other", "viewer-2", "offer", False)
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_worker_process_answers_offer():
+    pool = SFUPool(1)
+    await pool.start()
+    client = RTCPeerConnection()
+    try:
+        client.addTransceiver("video", direction="recvonly")
+        await client.setLocalDescription(await client.createOffer())
+
+        answer = await pool.handle_offer("room", "viewer", client.localDescription.sdp, False)
+        assert answer.type == "answer"
+        assert answer.sdp.startswith("v=0")
+
+        await pool.cleanup_user("room", "viewer")
+        assert pool.get_worker_loads() == [0]
+    finally:
+        await client.close()
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_signals_from_a_worker_are_held_until_delivered_and_failures_logged(caplog):
+    delivered = asyncio.Event()
+
+    async def on_signal(room_id, user_id, data):
+        await delivered.wait()
+        raise RuntimeError("client went away")
+
+    worker = SFUWorker(0, "/nonexistent/0", on_signal)
+    reader = asyncio.StreamReader()
+    reader.feed_data(dumps({"event": "signal", "room": "r", "user": "u", "data": {}}).encode() + b"\n")
+    reader.feed_eof()
+    await worker._read_replies(reader)
+    assert len(worker._signal_tasks) == 1
+
+    delivered.set()
+    await asyncio.gather(*worker._signal_tasks, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert not worker._signal_tasks
+    assert "signal delivery failed" in caplog.text
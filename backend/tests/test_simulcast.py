@@ -0,0 +1,128 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from fractions import Fraction
+
+import pytest
+from aiortc import MediaStreamTrack
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
+from passthrough import MediaSource
+from simulcast import BandwidthEstimator, LayerSelectorTrack, TimelineTrack, VideoLayer, choose_layer
+
+
+@dataclass
+class FakePacket:
+    name: str
+    pts: int = 0
+    is_keyframe: bool = False
+    time_base: Fraction = Fraction(1, 90000)
+
+
+class QueueTrack(MediaStreamTrack):
+    kind = "video"
+
+    def __init__(self):
+        super().__init__()
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def recv(self):
+        item = await self.queue.get()
+        if item is None:
+            raise MediaStreamError
+        return item
+
+
+def layers(*bitrates):
+    return [
+        VideoLayer(rid=f"l{i}", bitrate=bitrate, source=MediaSource(kind="video", receiver=None, decoded=QueueTrack()))
+        for i, bitrate in enumerate(bitrates)
+    ]
+
+
+def published():
+    event = asyncio.Event()
+    event.set()
+    return event
+
+
+def test_choose_layer_needs_headroom_to_move_up():
+    high, mid, low = layers(2_500_000, 800_000, 200_000)
+    ordered = [high, mid, low]
+
+    assert choose_layer(ordered, 3_000_000) is high
+    assert choose_layer(ordered, 1_000_000) is mid
+    assert choose_layer(ordered, 100_000) is low
+    # 2.6 Mbps would sustain the top layer, but not with enough margin to leave the middle one
+    assert choose_layer(ordered, 2_600_000, current=mid) is mid
+    assert choose_layer(ordered, 3_000_000, current=mid) is high
+
+
+def test_estimator_backs_off_on_loss_and_probes_when_clean():
+    estimator = BandwidthEstimator(initial=2_000_000)
+    estimator.update(0, 0.0, now=0.0)
+
+    assert estimator.update(125_000, 0.0, now=1.0) == 2_160_000
+    # 1 Mbps actually sent with 30% loss
+    assert estimator.update(250_000, 0.3, now=2.0) == 850_000
+
+
+@pytest.mark.asyncio
+async def test_timeline_aligns_layers_with_different_origins():
+    origin = time.monotonic()
+    first, second = QueueTrack(), QueueTrack()
+    first.queue.put_nowait(FakePacket("a", pts=1_000_000))
+    second.queue.put_nowait(FakePacket("b", pts=42))
+
+    a = await TimelineTrack(first, origin).recv()
+    b = await TimelineTrack(second, origin).recv()
+    assert abs(a.pts - b.pts) < 900  # same capture instant within 10 ms
+
+
+@pytest.mark.asyncio
+async def test_selector_switches_layers_only_on_keyframes():
+    high, low = layers(2_500_000, 200_000)
+    selector = LayerSelectorTrack(MediaRelay(), [high, low], published())
+    selector.estimator.estimate = 100_000
+
+    low.source.decoded.queue.put_nowait(FakePacket("low-0"))
+    low.source.decoded.queue.put_nowait(FakePacket("low-1", is_keyframe=True))
+    assert (await selector.recv()).name == "low-1"
+    assert selector.layer is low
+
+    selector.select(high)
+    high.source.decoded.queue.put_nowait(FakePacket("high-delta"))
+    low.source.decoded.queue.put_nowait(FakePacket("low-2"))
+    assert (await selector.recv()).name == "low-2"
+    assert selector.layer is low
+
+    high.source.decoded.queue.put_nowait(FakePacket("high-key", is_keyframe=True))
+    assert (await selector.recv()).name == "high-key"
+    assert selector.layer is high
+
+    selector.stop()
+
+
+@pytest.mark.asyncio
+async def test_selector_waits_out_a_sharer_change():
+    room_layers = layers(None)
+    event = published()
+    selector = LayerSelectorTrack(MediaRelay(), room_layers, event)
+    room_layers[0].source.decoded.queue.put_nowait(FakePacket("first", is_keyframe=True))
+    assert (await selector.recv()).name == "first"
+
+    # the sharer leaves: its track ends and the room forgets its layers
+    room_layers[0].source.decoded.queue.put_nowait(None)
+    room_layers.clear()
+    event.clear()
+    pending = asyncio.ensure_future(selector.recv())
+    await asyncio.sleep(0.05)
+    assert not pending.done()
+
+    room_layers.extend(layers(None))
+    event.set()
+    room_layers[0].source.decoded.queue.put_nowait(FakePacket("second", is_keyframe=True))
+    assert (await asyncio.wait_for(pending, timeout=1)).name == "second"
+    assert selector.layer is room_layers[0]
+
+    selector.stop()
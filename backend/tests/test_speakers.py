@@ -0,0 +1,102 @@
+import asyncio
+import math
+from array import array
+
+import pytest
+from aiortc import AudioStreamTrack, RTCPeerConnection, RTCSessionDescription
+from sfu import SFUManager
+from sfu_loader import voice_peer
+from speakers import SILENCE_LEVEL, ActiveSpeakers
+
+
+class ToneTrack(AudioStreamTrack):
+    """Someone talking, as far as audio levels go: a loud 440 Hz tone."""
+
+    def __init__(self):
+        super().__init__()
+        self._samples = 0
+
+    async def recv(self):
+        frame = await super().recv()
+        rate, start = frame.sample_rate, self._samples
+        self._samples += frame.samples
+        tone = array("h", (int(20000 * math.sin(2 * math.pi * 440 * (start + i) / rate)) for i in range(frame.samples)))
+        frame.planes[0].update(tone.tobytes())
+        return frame
+
+
+def test_loudest_speakers_are_ranked_and_kept_until_clearly_beaten():
+    speakers = ActiveSpeakers(count=2)
+    for _ in range(5):
+        speakers.report("alice", 10)
+        speakers.report("bob", 30)
+        speakers.report("carol", SILENCE_LEVEL + 20)
+        speakers.update()
+    assert speakers.ranking == ["alice", "bob"]
+
+    # a bit louder than bob is not enough to take his place
+    for _ in range(5):
+        speakers.report("alice", 10)
+        speakers.report("bob", 30)
+        speakers.report("carol", 25)
+        assert not speakers.update()
+    assert speakers.ranking == ["alice", "bob"]
+
+    speakers.set_muted("alice", True)
+    assert speakers.update()
+    assert speakers.ranking == ["carol", "bob"]
+
+
+async def join_call(sfu: SFUManager, signals: asyncio.Queue, user_id: str, track) -> RTCPeerConnection:
+    pc = RTCPeerConnection()
+    pc.addTrack(track)
+    await pc.setLocalDescription(await pc.createOffer())
+    peer_id = voice_peer(user_id)
+    await pc.setRemoteDescription(await sfu.handle_offer("room", peer_id, pc.localDescription.sdp, False))
+    # the other speaker slots come in a renegotiation
+    await sfu.renegotiate(peer_id)
+    signalled, data = await asyncio.wait_for(signals.get(), timeout=10)
+    assert (signalled, data["type"]) == (peer_id, "offer")
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=data["sdp"], type="offer"))
+    await pc.setLocalDescription(await pc.createAnswer())
+    await sfu.handle_answer(peer_id, pc.localDescription.sdp)
+    return pc
+
+
+@pytest.mark.asyncio
+async def test_participants_hear_only_the_active_speaker():
+    sfu = SFUManager()
+    signals: asyncio.Queue = asyncio.Queue()
+
+    async def on_signal(room_id, peer_id, data):
+        signals.put_nowait((peer_id, data))
+
+    sfu.on_signal = on_signal
+    clients = []
+    try:
+        clients.append(await join_call(sfu, signals, "alice", ToneTrack()))
+        for user_id in ("bob", "carol"):
+            clients.append(await join_call(sfu, signals, user_id, AudioStreamTrack()))
+        assert len(clients[1].getReceivers()) == 3
+
+        voice = sfu._voice["room"]
+        for _ in range(100):
+            if voice.speakers.ranking == ["alice"]:
+                break
+            await asyncio.sleep(0.1)
+        assert voice.speakers.ranking == ["alice"]
+        heard = {user: [slot.speaker for slot in slots] for user, slots in voice.listeners.items()}
+        assert heard == {"alice": [None] * 3, "bob": ["alice", None, None], "carol": ["alice", None, None]}
+        await asyncio.wait_for(clients[1].getReceivers()[0].track.recv(), timeout=10)
+
+        await sfu.set_voice_state("room", "bob", False, True)
+        assert [slot.speaker for slot in voice.listeners["bob"]] == [None] * 3
+
+        await sfu.cleanup_user("room", voice_peer("alice"))
+        assert "alice" not in voice.sources
+        assert [slot.speaker for slot in voice.listeners["carol"]] == [None] * 3
+    finally:
+        for pc in clients:
+            await pc.close()
+        await sfu.close()
+    assert "room" not in sfu._voice
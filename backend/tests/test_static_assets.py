@@ -0,0 +1,83 @@
+import gzip
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from static_assets import IMMUTABLE_CACHE, REVALIDATE_CACHE, StaticBundle
+
+SCRIPT = b"console.log('purestream');\n" * 100
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "index.html").write_text("<!doctype html><title>PureStream</title>")
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "index.html").write_text("<!doctype html><script src='guide.js'></script>")
+    (tmp_path / "assets" / "main-AbC12_x9.js").write_bytes(SCRIPT)
+    # as the build leaves it: a brotli variant next to the file it belongs to
+    (tmp_path / "assets" / "main-AbC12_x9.js.br").write_bytes(b"prebuilt brotli")
+    return StaticBundle(tmp_path)
+
+
+@pytest.fixture
+def client(bundle):
+    return TestClient(Starlette(routes=[Mount("/", app=bundle)]))
+
+
+def test_hashed_assets_are_immutable_and_served_in_the_best_accepted_encoding(bundle, client):
+    assert bundle.lookup("/assets/main-AbC12_x9.js").negotiate("gzip, br")[1].body == b"prebuilt brotli"
+
+    response = client.get("/assets/main-AbC12_x9.js", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == IMMUTABLE_CACHE
+    assert response.content == SCRIPT
+
+    response = client.get("/assets/main-AbC12_x9.js", headers={"Accept-Encoding": "br;q=0"})
+    assert "content-encoding" not in response.headers
+    assert response.content == SCRIPT
+    assert client.get("/assets/main-AbC12_x9.js.br").status_code == 404
+
+
+def test_encoding_follows_the_clients_q_values(bundle):
+    asset = bundle.lookup("/assets/main-AbC12_x9.js")
+    assert asset.negotiate("br;q=0.5, gzip;q=0.8")[0] == "gzip"
+    assert asset.negotiate("gzip;q=0.8, br")[0] == "br"
+    assert asset.negotiate("*")[0] == "br"
+    assert asset.negotiate("*, br;q=0")[0] == "gzip"
+    assert asset.negotiate("gzip;q=0, br;q=0.000")[0] is None
+    assert asset.negotiate("gzip;q=0.5, identity")[0] is None
+    # refusing identity still gets the encoding that was asked for
+    assert asset.negotiate("gzip, identity;q=0")[0] == "gzip"
+    assert asset.negotiate("gzip;q=bogus")[0] is None
+
+
+def test_index_is_revalidated_with_its_etag(client):
+    response = client.get("/")
+    assert response.headers["cache-control"] == REVALIDATE_CACHE
+    assert response.text.startswith("<!doctype html>")
+
+    etag = response.headers["etag"]
+    revalidated = client.get("/index.html", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+    assert revalidated.headers["etag"] == etag
+
+    assert client.get("/missing.js").status_code == 404
+    assert client.post("/").status_code == 405
+
+
+def test_directory_without_trailing_slash_is_redirected(client):
+    # served at /docs, the page's relative guide.js would resolve to /guide.js instead of /docs/guide.js
+    response = client.get("/docs?v=1", follow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"] == "/docs/?v=1"
+    assert client.get("/docs/").text.startswith("<!doctype html>")
+
+
+def test_prebuilt_gzip_is_used_as_is(tmp_path):
+    (tmp_path / "app.css").write_bytes(b"body{}" * 500)
+    (tmp_path / "app.css.gz").write_bytes(gzip.compress(b"body{}" * 500))
+    asset = StaticBundle(tmp_path).lookup("/app.css")
+    assert asset.negotiate("gzip")[1].body == (tmp_path / "app.css.gz").read_bytes()
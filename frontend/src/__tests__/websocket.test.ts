@@ -63,4 +63,19 @@ describe('WebSocketManager', () => {
         expect(wsManager.isConnected).toBe(false);
         expect(onClose).toHaveBeenCalled();
     });
+
+    it('should resume its session on reconnect instead of joining again', async () => {
+        const onOpen = vi.fn();
+        wsManager.on('open', onOpen);
+
+        wsManager.connect('room1', 'user1');
+        await server.connected;
+        server.send(JSON.stringify({ type: 'session', token: 'abc', resumed: false }));
+        server.send(JSON.stringify({ type: 'chat', text: 'hi' }));
+
+        wsManager.connect('room1', 'user1');
+        await server.connected;
+        await expect(server).toReceiveMessage(JSON.stringify({ type: 'resume', token: 'abc', seq: 1 }));
+        expect(onOpen).toHaveBeenCalledTimes(1);
+    });
 });
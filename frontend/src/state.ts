@@ -9,6 +9,7 @@ interface User {
 }
 
 interface ChatMessage {
+    id?: number;
     userId: string;
     username: string;
     text: string;
@@ -34,9 +35,13 @@ export interface ApplicationState {
     voicePeers: Map<string, VoicePeerState>;
     inCall: boolean;
     chat: ChatMessage[];
+    // whether the server holds messages older than chat[0], fetched a page at a time with chat-history
+    chatHasMore: boolean;
     whiteboardData: any[] | null;
 }
 
+const MAX_CHAT_MESSAGES = 500;
+
 type StateListener = (state: ApplicationState) => void;
 
 class AppState {
@@ -58,6 +63,7 @@ class AppState {
             voicePeers: new Map(),
             inCall: false,
             chat: [],
+            chatHasMore: false,
             whiteboardData: null
         };
         this._listeners = new Set();
@@ -76,6 +82,7 @@ class AppState {
     get voicePeers(): Map<string, VoicePeerState> { return this._state.voicePeers; }
     get inCall(): boolean { return this._state.inCall; }
     get chat(): ChatMessage[] { return this._state.chat; }
+    get chatHasMore(): boolean { return this._state.chatHasMore; }
     get whiteboardData(): any[] | null { return this._state.whiteboardData; }
 
     setUsername(name: string): void {
@@ -130,13 +137,26 @@ class AppState {
         this._notify();
     }
 
-    setChatHistory(messages: ChatMessage[]): void {
+    setChatHistory(messages: ChatMessage[], hasMore = false): void {
         this._state.chat = messages;
+        this._state.chatHasMore = hasMore;
+        this._notify();
+    }
+
+    prependChatHistory(messages: ChatMessage[], hasMore: boolean): void {
+        this._state.chat = [...messages, ...this._state.chat];
+        this._state.chatHasMore = hasMore;
         this._notify();
     }
 
     appendChatMessage(message: ChatMessage): void {
-        this._state.chat = [...this._state.chat, message].slice(-200);
+        const chat = [...this._state.chat, message];
+        if (chat.length > MAX_CHAT_MESSAGES) {
+            // trimmed messages can be paged back in like any older ones
+            chat.splice(0, chat.length - MAX_CHAT_MESSAGES);
+            this._state.chatHasMore = true;
+        }
+        this._state.chat = chat;
         this._notify();
     }
 
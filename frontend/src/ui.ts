@@ -227,10 +227,12 @@ export function updateVoiceControls(muted: boolean, deafened: boolean, inCall =
     createIcons({ icons });
 }
 
-export function renderChat(messages: any[], selfId: string) {
+export function renderChat(messages: any[], selfId: string, keepScroll = false) {
     if (!chatMessagesEl) return;
+    // with keepScroll, older messages added above leave the visible ones where they were
+    const fromBottom = chatMessagesEl.scrollHeight - chatMessagesEl.scrollTop;
     chatMessagesEl.innerHTML = "";
-    messages.slice(-200).forEach(msg => {
+    messages.forEach(msg => {
         const isMe = msg.userId === selfId;
         const row = document.createElement("div");
         row.className = "flex flex-col gap-1";
@@ -255,7 +257,7 @@ export function renderChat(messages: any[], selfId: string) {
         row.appendChild(body);
         chatMessagesEl.appendChild(row);
     });
-    chatMessagesEl.scrollTop = chatMessagesEl.scrollHeight;
+    chatMessagesEl.scrollTop = keepScroll ? chatMessagesEl.scrollHeight - fromBottom : chatMessagesEl.scrollHeight;
 }
 
 export function setupUIListeners() {
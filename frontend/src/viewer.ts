@@ -23,6 +23,10 @@ import { getRelativePath, FRONTEND_URL } from "./config.js";
 createIcons({ icons });
 
 let connectionTimeout: ReturnType<typeof setTimeout> | null = null;
+// seq of the last roster snapshot/delta applied; null until the first snapshot arrives
+let rosterSeq: number | null = null;
+// an older chat page has been asked for and not arrived yet
+let chatHistoryPending = false;
 
 const copyRoomIdBtn = document.getElementById("copy-room-id") as HTMLButtonElement;
 const sidebar = document.getElementById("sidebar") as HTMLElement;
@@ -40,6 +44,7 @@ const deafenBtn = document.getElementById("deafen-btn") as HTMLButtonElement;
 const videoStage = document.getElementById("video-stage") as HTMLElement;
 const joinCallBtn = document.getElementById("join-call-btn") as HTMLButtonElement;
 const chatForm = document.getElementById("chat-form") as HTMLFormElement;
+const chatMessages = document.getElementById("chat-messages") as HTMLElement;
 const chatInput = document.getElementById("chat-input") as HTMLInputElement;
 const urlParams = new URLSearchParams(window.location.search);
 const roomId = urlParams.get("room");
@@ -169,7 +174,7 @@ async function toggleCall() {
         return;
     }
 
-    const success = await voice.start(state.users.filter(u => u.inCall), state.userId);
+    const success = await voice.start();
     if (success) {
         state.setInCall(true);
         ws.send({ type: "call-state", inCall: true });
@@ -185,12 +190,6 @@ async function toggleCall() {
             icon.setAttribute("data-lucide", "phone-off");
             createIcons({ icons, nameAttr: 'data-lucide', attrs: { class: "w-5 h-5 group-hover:text-red-400 transition-colors" } });
         }
-
-        state.users.forEach(u => {
-            if (u.id !== state.userId && u.inCall) {
-                voice.connectToUser(u.id);
-            }
-        });
     } else {
 
         showToast("Microphone access denied. Voice call unavailable.", "error");
@@ -230,23 +229,52 @@ copyRoomIdBtn.onclick = () => {
 
 function initConnection() {
     ws.on("open", () => {
+        rosterSeq = null;
         ws.send({ type: "join", username: state.username });
     });
 
-    ws.on("user-list", (msg: any) => {
-        state.setUsers(msg.users);
-        msg.users.forEach((u: any) => {
+    function applyUsers(users: any[], changed: any[]) {
+        state.setUsers(users);
+        changed.forEach((u: any) => {
             if (u.id !== state.userId) {
                 state.setVoicePeerState(u.id, u.muted, u.deafened);
             }
         });
-        renderUserList(msg.users, state.sharerId, state.userId, state.voicePeers);
+        renderUserList(users, state.sharerId, state.userId, state.voicePeers);
+    }
 
-        if (voice.isActive) {
-            msg.users.filter((u: any) => u.inCall && u.id !== state.userId).forEach((u: any) => voice.connectToUser(u.id));
+    function applyRosterDelta(msg: any, apply: () => void) {
+        if (rosterSeq === null || msg.seq <= rosterSeq) return;
+        if (msg.seq !== rosterSeq + 1) {
+            // missed a delta: drop to the next snapshot instead of guessing
+            rosterSeq = null;
+            ws.send({ type: "roster-sync" });
+            return;
         }
+        rosterSeq = msg.seq;
+        apply();
+    }
+
+    function upsertUser(user: any) {
+        const exists = state.users.some(u => u.id === user.id);
+        const users = exists ? state.users.map(u => u.id === user.id ? user : u) : [...state.users, user];
+        applyUsers(users, [user]);
+    }
+
+    ws.on("user-list", (msg: any) => {
+        if (rosterSeq !== null && msg.seq < rosterSeq) return;
+        rosterSeq = msg.seq;
+        applyUsers(msg.users, msg.users);
     });
 
+    ws.on("user-joined", (msg: any) => applyRosterDelta(msg, () => upsertUser(msg.user)));
+
+    ws.on("user-updated", (msg: any) => applyRosterDelta(msg, () => upsertUser(msg.user)));
+
+    ws.on("user-left", (msg: any) => applyRosterDelta(msg, () => {
+        applyUsers(state.users.filter(u => u.id !== msg.userId), []);
+    }));
+
     ws.on("sharer-changed", (msg: any) => {
         state.setSharer(msg.sharerId, msg.sharerName);
         renderUserList(state.users, msg.sharerId, state.userId, state.voicePeers);
@@ -282,7 +310,11 @@ function initConnection() {
     });
 
     ws.on("signal", async (msg: any) => {
-        await rtc.handleSignal(msg.sender, msg.data);
+        if (msg.sender === "sfu-voice") {
+            await voice.handleSignal(msg.data);
+        } else {
+            await rtc.handleSignal(msg.sender, msg.data);
+        }
     });
 
     ws.on("close", () => {
@@ -309,10 +341,6 @@ function initConnection() {
         }
     });
 
-    ws.on("voice-signal", async (msg: any) => {
-        await voice.handleSignal(msg.sender, msg.data);
-    });
-
     ws.on("voice-state", (msg: any) => {
         state.setVoicePeerState(msg.userId, msg.muted, msg.deafened);
         renderUserList(state.users, state.sharerId, state.userId, state.voicePeers);
@@ -325,9 +353,6 @@ function initConnection() {
         if (msg.userId === state.userId) {
             state.setInCall(msg.inCall);
             updateVoiceControls(state.voiceMuted, state.voiceDeafened, msg.inCall);
-        } else if (state.inCall && msg.inCall) {
-            console.log("[viewer] User joined call, checking connection:", msg.userId);
-            voice.connectToUser(msg.userId);
         }
 
         renderUserList(state.users, state.sharerId, state.userId, state.voicePeers);
@@ -339,8 +364,14 @@ function initConnection() {
     });
 
     ws.on("chat-history", (msg: any) => {
-        state.setChatHistory(msg.messages || []);
-        renderChat(state.chat, state.userId);
+        chatHistoryPending = false;
+        if (msg.before == null) {
+            state.setChatHistory(msg.messages || [], !!msg.hasMore);
+            renderChat(state.chat, state.userId);
+        } else {
+            state.prependChatHistory(msg.messages || [], !!msg.hasMore);
+            renderChat(state.chat, state.userId, true);
+        }
     });
 
     voice.setOnStateChange((muted, deafened) => {
@@ -386,6 +417,14 @@ function initConnection() {
         ws.send({ type: "chat", text, username: state.username });
     });
 
+    // joins only bring the latest page of chat; scrolling to the top fetches the page before it
+    chatMessages?.addEventListener("scroll", () => {
+        const oldest = state.chat[0]?.id;
+        if (chatMessages.scrollTop > 40 || !state.chatHasMore || chatHistoryPending || oldest == null) return;
+        chatHistoryPending = true;
+        ws.send({ type: "chat-history", before: oldest });
+    });
+
     setupWhiteboardToolbar();
 }
 
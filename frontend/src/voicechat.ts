@@ -1,41 +1,43 @@
 import { ws } from "./websocket.js";
+import { getIceServers } from "./webrtc/config.js";
 
-const RTC_CONFIG: RTCConfiguration = {
-    iceServers: [
-        { urls: "stun:stun.l.google.com:19302" },
-        { urls: "stun:stun1.l.google.com:19302" }
-    ]
-};
+// the SFU's end of the call audio connection, as the target and sender of its signals
+const VOICE_TARGET = "sfu-voice";
 
 type StateChangeCallback = (muted: boolean, deafened: boolean) => void;
 
+type VoiceSignal =
+    | { type: "offer"; sdp: string }
+    | { type: "answer"; sdp: string }
+    | { type: "busy"; retryAfter: number }
+    | { type: "candidate"; candidate: RTCIceCandidateInit };
+
 export class VoiceChatManager {
-    private _peers: Map<string, RTCPeerConnection>;
-    private _pendingCandidates: Map<string, RTCIceCandidateInit[]>;
+    // one connection to the SFU: the microphone goes up, the call's active speakers come down on a few tracks
+    private _pc: RTCPeerConnection | null;
     private _localStream: MediaStream | null;
     private _audioElements: Map<string, HTMLAudioElement>;
+    // applied one at a time, so an SFU offer that follows its answer waits for the answer to be set
+    private _signals: Promise<void>;
     private _muted: boolean;
     private _deafened: boolean;
     private _onStateChange: StateChangeCallback | null;
-    private _myUserId: string | null;
 
     constructor() {
-        this._peers = new Map();
-        this._pendingCandidates = new Map();
+        this._pc = null;
         this._localStream = null;
         this._audioElements = new Map();
+        this._signals = Promise.resolve();
         this._muted = false;
         this._deafened = false;
         this._onStateChange = null;
-        this._myUserId = null;
     }
 
     setOnStateChange(callback: StateChangeCallback): void {
         this._onStateChange = callback;
     }
 
-    async start(userList: any[], myUserId: string): Promise<boolean> {
-        this._myUserId = myUserId;
+    async start(): Promise<boolean> {
         try {
             this._localStream = await navigator.mediaDevices.getUserMedia({
                 audio: {
@@ -44,13 +46,8 @@ export class VoiceChatManager {
                     autoGainControl: true
                 }
             });
-
-            for (const user of userList) {
-                if (user.id !== myUserId) {
-                    this.connectToUser(user.id);
-                }
-            }
-
+            this._localStream.getAudioTracks().forEach(t => t.enabled = !this._muted);
+            await this._connect();
             return true;
         } catch (err) {
             console.error("Failed to get microphone:", err);
@@ -63,141 +60,94 @@ export class VoiceChatManager {
             this._localStream.getTracks().forEach(t => t.stop());
             this._localStream = null;
         }
-        this._closeAllPeers();
+        this._pc?.close();
+        this._pc = null;
         this._audioElements.forEach(audio => audio.remove());
         this._audioElements.clear();
-        this._myUserId = null;
-    }
-
-    connectToUser(targetId: string): void {
-        if (this._localStream && !this._peers.has(targetId)) {
-            if (this._myUserId && this._myUserId > targetId) {
-                this._initiateConnection(targetId);
-            }
-        }
     }
 
-    private async _initiateConnection(targetId: string): Promise<void> {
+    private async _connect(): Promise<void> {
         if (!this._localStream) return;
+        const iceServers = await getIceServers();
 
-        const pc = this._createPeer(targetId);
-        this._localStream.getTracks().forEach(t => pc.addTrack(t, this._localStream!));
-
-        const offer = await pc.createOffer();
-        await pc.setLocalDescription(offer);
-
-        ws.send({
-            type: "voice-signal",
-            target: targetId,
-            data: { type: "offer", sdp: offer }
-        });
-    }
-
-    async handleSignal(senderId: string, data: any): Promise<void> {
-        if (data.type === "offer") {
-            if (!this._localStream) return;
-
-            const pc = this._createPeer(senderId);
-            await pc.setRemoteDescription(new RTCSessionDescription(data.sdp));
-            const queued = this._pendingCandidates.get(senderId) || [];
-            for (const candidate of queued) {
-                await pc.addIceCandidate(new RTCIceCandidate(candidate));
-            }
-            this._pendingCandidates.delete(senderId);
-
-            this._localStream.getTracks().forEach(t => pc.addTrack(t, this._localStream!));
-
-            const answer = await pc.createAnswer();
-            await pc.setLocalDescription(answer);
+        this._pc?.close();
+        const pc = new RTCPeerConnection({ iceServers });
+        this._pc = pc;
 
+        pc.onicecandidate = (e: RTCPeerConnectionIceEvent) => {
+            if (!e.candidate) return;
             ws.send({
-                type: "voice-signal",
-                target: senderId,
-                data: { type: "answer", sdp: answer }
+                type: "signal",
+                target: VOICE_TARGET,
+                data: { type: "candidate", candidate: e.candidate.toJSON() }
             });
-        } else if (data.type === "answer") {
-            const pc = this._peers.get(senderId);
-            if (pc && pc.signalingState === "have-local-offer") {
-                await pc.setRemoteDescription(new RTCSessionDescription(data.sdp));
-
-                const queued = this._pendingCandidates.get(senderId) || [];
-                for (const candidate of queued) {
-                    await pc.addIceCandidate(new RTCIceCandidate(candidate));
-                }
-                this._pendingCandidates.delete(senderId);
-            }
-        } else if (data.candidate) {
-            const pc = this._peers.get(senderId);
-            if (!pc) return;
-
-            if (pc.remoteDescription) {
-                await pc.addIceCandidate(new RTCIceCandidate(data.candidate));
-            } else {
-                if (!this._pendingCandidates.has(senderId)) {
-                    this._pendingCandidates.set(senderId, []);
-                }
-                this._pendingCandidates.get(senderId)!.push(data.candidate);
-            }
-        }
-    }
-
-    private _createPeer(remoteId: string): RTCPeerConnection {
-        if (this._peers.has(remoteId)) {
-            this._peers.get(remoteId)!.close();
-        }
-
-        const pc = new RTCPeerConnection(RTC_CONFIG);
-        this._peers.set(remoteId, pc);
-
-        pc.onicecandidate = (e: RTCPeerConnectionIceEvent) => {
-            if (e.candidate) {
-                ws.send({
-                    type: "voice-signal",
-                    target: remoteId,
-                    data: { candidate: e.candidate }
-                });
-            }
         };
 
         pc.ontrack = (e: RTCTrackEvent) => {
-            let audio = this._audioElements.get(remoteId);
+            // each track is a slot the SFU fills with whoever is speaking; an idle one is simply silent
+            const id = e.track.id;
+            let audio = this._audioElements.get(id);
             if (!audio) {
                 audio = document.createElement("audio");
                 audio.autoplay = true;
-                audio.id = `voice-audio-${remoteId}`;
+                audio.id = `voice-audio-${id}`;
                 document.body.appendChild(audio);
-                this._audioElements.set(remoteId, audio);
+                this._audioElements.set(id, audio);
             }
-            audio.srcObject = e.streams[0];
+            audio.srcObject = new MediaStream([e.track]);
             audio.muted = this._deafened;
         };
 
         pc.onconnectionstatechange = () => {
-            if (pc.connectionState === "disconnected" || pc.connectionState === "failed") {
-                this._removePeer(remoteId);
+            if (pc.connectionState === "failed" && this._pc === pc) {
+                this._audioElements.forEach(audio => audio.remove());
+                this._audioElements.clear();
+                this._connect();
             }
         };
 
-        return pc;
+        this._localStream.getTracks().forEach(t => pc.addTrack(t, this._localStream!));
+        const offer = await pc.createOffer();
+        await pc.setLocalDescription(offer);
+        ws.send({
+            type: "signal",
+            target: VOICE_TARGET,
+            data: { type: "offer", sdp: offer.sdp }
+        });
     }
 
-    private _removePeer(id: string): void {
-        const pc = this._peers.get(id);
-        if (pc) {
-            pc.close();
-            this._peers.delete(id);
-        }
-        this._pendingCandidates.delete(id);
-        const audio = this._audioElements.get(id);
-        if (audio) {
-            audio.remove();
-            this._audioElements.delete(id);
-        }
+    handleSignal(data: VoiceSignal): Promise<void> {
+        this._signals = this._signals
+            .then(() => this._applySignal(data))
+            .catch(e => console.error("[voice] Failed to apply signal:", e));
+        return this._signals;
     }
 
-    private _closeAllPeers(): void {
-        this._peers.forEach(pc => pc.close());
-        this._peers.clear();
+    private async _applySignal(data: VoiceSignal): Promise<void> {
+        const pc = this._pc;
+        if (!pc) return;
+
+        if (data.type === "offer") {
+            // the SFU adding the speaker slots our offer had no room for
+            await pc.setRemoteDescription({ type: "offer", sdp: data.sdp });
+            const answer = await pc.createAnswer();
+            await pc.setLocalDescription(answer);
+            ws.send({
+                type: "signal",
+                target: VOICE_TARGET,
+                data: { type: "answer", sdp: answer.sdp }
+            });
+        } else if (data.type === "answer") {
+            if (pc.signalingState === "have-local-offer") {
+                await pc.setRemoteDescription({ type: "answer", sdp: data.sdp });
+            }
+        } else if (data.type === "busy") {
+            setTimeout(() => {
+                if (this._pc === pc) this._connect();
+            }, data.retryAfter);
+        } else if ("candidate" in data) {
+            await pc.addIceCandidate(new RTCIceCandidate(data.candidate));
+        }
     }
 
     setMuted(muted: boolean): void {
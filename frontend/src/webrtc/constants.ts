@@ -17,3 +17,11 @@ export const DEFAULT_CONFIG = {
     reconnectAttempts: 3,
     reconnectDelay: 2000 // 2 seconds
 };
+
+// Published as separate transceivers of the same screen track; the SFU forwards each viewer the best layer
+// its connection sustains.
+export const SIMULCAST_LAYERS = [
+    { rid: "h", scaleResolutionDownBy: 1, maxBitrate: DEFAULT_CONFIG.maxBitrate }, // kbps
+    { rid: "m", scaleResolutionDownBy: 2, maxBitrate: 1200 },
+    { rid: "l", scaleResolutionDownBy: 4, maxBitrate: 200 }
+] as const;
@@ -1,7 +1,6 @@
 import { ws } from "../websocket.js";
-import { ConnectionState, DEFAULT_CONFIG } from "./constants.js";
+import { ConnectionState, DEFAULT_CONFIG, SIMULCAST_LAYERS } from "./constants.js";
 import { getIceServers } from "./config.js";
-import { applyVideoEncoding } from "./utils.js";
 
 interface WebRTCConfig {
     maxBitrate: number;
@@ -16,7 +15,9 @@ type TrackCallback = (stream: MediaStream, id: string) => void;
 type DisconnectCallback = (id: string) => void;
 
 type SignalMessage =
+    | { type: "offer"; sdp: string }
     | { type: "answer"; sdp: string }
+    | { type: "busy"; retryAfter: number }
     | { type: "candidate"; candidate: RTCIceCandidateInit };
 
 class WebRTCManager {
@@ -24,6 +25,11 @@ class WebRTCManager {
     private rtcConfig?: RTCConfiguration;
     private localStream?: MediaStream;
     private pc?: RTCPeerConnection;
+    // a viewer connection outlives sharers: the SFU switches the media behind the same tracks
+    private subscribed = false;
+    private remoteStream?: MediaStream;
+    // applied one at a time, so an SFU offer that follows its answer waits for the answer to be set
+    private signals: Promise<void> = Promise.resolve();
     private onTrack?: TrackCallback;
     private onDisconnect?: DisconnectCallback;
     private connectionState: ConnectionState = ConnectionState.NEW;
@@ -90,6 +96,8 @@ class WebRTCManager {
 
         this.pc?.close();
         this.pc = undefined;
+        this.subscribed = false;
+        this.remoteStream = undefined;
 
         this.onDisconnect?.(source);
     }
@@ -99,6 +107,8 @@ class WebRTCManager {
 
         this.pc?.close();
         this.pc = new RTCPeerConnection(this.rtcConfig);
+        this.subscribed = !publish;
+        this.remoteStream = undefined;
 
         this.pc.onicecandidate = e => {
             if (!e.candidate) return;
@@ -117,15 +127,28 @@ class WebRTCManager {
         };
 
         this.pc.ontrack = e => {
+            this.remoteStream = e.streams[0];
             this.onTrack?.(e.streams[0], "sfu");
             e.track.onended = () => this.cleanup("remote");
         };
 
+        const layerTransceivers: [typeof SIMULCAST_LAYERS[number], RTCRtpTransceiver][] = [];
         if (publish && this.localStream) {
             for (const track of this.localStream.getTracks()) {
-                const sender = this.pc.addTrack(track, this.localStream);
-                if (track.kind === "video") {
-                    applyVideoEncoding(sender, this.config.maxBitrate).catch(() => { });
+                if (track.kind !== "video") {
+                    this.pc.addTrack(track, this.localStream);
+                    continue;
+                }
+                for (const layer of SIMULCAST_LAYERS) {
+                    const transceiver = this.pc.addTransceiver(track, {
+                        direction: "sendonly",
+                        streams: [this.localStream],
+                        sendEncodings: [{
+                            scaleResolutionDownBy: layer.scaleResolutionDownBy,
+                            maxBitrate: Math.min(layer.maxBitrate, this.config.maxBitrate) * 1000
+                        }]
+                    });
+                    layerTransceivers.push([layer, transceiver]);
                 }
             }
         } else {
@@ -142,19 +165,53 @@ class WebRTCManager {
             data: {
                 type: "offer",
                 sdp: offer.sdp,
-                intent: publish ? "publish" : "subscribe"
+                intent: publish ? "publish" : "subscribe",
+                layers: layerTransceivers.map(([layer, transceiver]) => ({
+                    mid: transceiver.mid,
+                    rid: layer.rid,
+                    bitrate: Math.min(layer.maxBitrate, this.config.maxBitrate) * 1000
+                }))
             }
         });
     }
 
     connectToSharer() {
+        const live = this.pc && !["failed", "closed"].includes(this.pc.connectionState);
+        if (live && this.subscribed && this.remoteStream) {
+            this.onTrack?.(this.remoteStream, "sfu");
+            return;
+        }
         this.connectToSFU(false);
     }
 
-    async handleSignal(_: string, data: SignalMessage) {
+    handleSignal(_: string, data: SignalMessage): Promise<void> {
+        this.signals = this.signals
+            .then(() => this.applySignal(data))
+            .catch(e => console.error("[webrtc] Failed to apply signal:", e));
+        return this.signals;
+    }
+
+    private async applySignal(data: SignalMessage) {
         if (!this.pc) return;
 
-        if (data.type === "answer") {
+        if (data.type === "offer") {
+            // the SFU renegotiating to add tracks our offer had no slot for
+            await this.pc.setRemoteDescription({ type: "offer", sdp: data.sdp });
+            const answer = await this.pc.createAnswer();
+            await this.pc.setLocalDescription(answer);
+            ws.send({
+                type: "signal",
+                target: "sfu",
+                data: { type: "answer", sdp: answer.sdp }
+            });
+        } else if (data.type === "busy") {
+            // the SFU shed our offer under load; offer again with the same intent once it has had time to drain
+            const publish = !this.subscribed;
+            const pc = this.pc;
+            setTimeout(() => {
+                if (this.pc === pc) this.connectToSFU(publish);
+            }, data.retryAfter);
+        } else if (data.type === "answer") {
             await this.pc.setRemoteDescription({
                 type: "answer",
                 sdp: data.sdp
@@ -11,6 +11,11 @@ export class WebSocketManager {
     private _reconnectAttempt: number;
     private _handlers: Map<string, Set<(data?: any) => void>>;
     private _connected: boolean;
+    // issued by the server per session; a reconnect presents it to pick the session back up
+    private _token: string | null;
+    // frames received since the session frame, so a resumed session replays only what this client missed
+    private _received: number;
+    private _resuming: boolean;
 
     constructor() {
         this._socket = null;
@@ -20,6 +25,9 @@ export class WebSocketManager {
         this._reconnectAttempt = 0;
         this._handlers = new Map();
         this._connected = false;
+        this._token = null;
+        this._received = 0;
+        this._resuming = false;
     }
 
     connect(roomId: string, userId: string): void {
@@ -41,16 +49,30 @@ export class WebSocketManager {
             this._connected = true;
             this._reconnectAttempt = 0;
             this._startHeartbeat();
-            this._emit("open");
+            if (this._token) {
+                // "open" waits for the server's answer: a fresh session needs a join, a resumed one does not
+                this._resuming = true;
+                this.send({ type: "resume", token: this._token, seq: this._received });
+            } else {
+                this._emit("open");
+            }
         };
 
         this._socket.onmessage = (event: MessageEvent) => {
+            let msg;
             try {
-                const msg = JSON.parse(event.data);
-                this._emit(msg.type, msg);
+                msg = JSON.parse(event.data);
             } catch (e) {
+                this._received++;
                 console.error("WebSocket message parse error:", e, event.data);
+                return;
+            }
+            if (msg.type === "session") {
+                this._onSession(msg);
+                return;
             }
+            this._received++;
+            this._emit(msg.type, msg);
         };
 
         this._socket.onclose = (event) => {
@@ -67,6 +89,19 @@ export class WebSocketManager {
         };
     }
 
+    private _onSession(msg: { token: string; resumed: boolean }): void {
+        const resuming = this._resuming;
+        this._resuming = false;
+        this._token = msg.token;
+        if (msg.resumed) {
+            this._emit("resumed");
+            return;
+        }
+        this._received = 0;
+        // the session we tried to resume was gone, so this one starts from scratch
+        if (resuming) this._emit("open");
+    }
+
     private _startHeartbeat(): void {
         this._stopHeartbeat();
         this._heartbeatTimer = setInterval(() => {
@@ -119,10 +154,12 @@ export class WebSocketManager {
 
     disconnect(): void {
         this._roomId = null;
+        this._token = null;
         this._stopHeartbeat();
         this._connected = false;
         if (this._socket) {
-            this._socket.close();
+            // a clean close: the server ends the session instead of holding it for a resume
+            this._socket.close(1000);
             this._socket = null;
             this._emit("close");
         }
@@ -532,7 +532,8 @@ export class WhiteboardManager {
         ws.on('whiteboard-start', this.handleWhiteboardStart.bind(this));
         ws.on('whiteboard-stop', this.handleWhiteboardStop.bind(this));
         ws.on('whiteboard-update', this.handleWhiteboardUpdate.bind(this));
-        ws.on('whiteboard-cursor', this.handleWhiteboardCursor.bind(this));
+        ws.on('whiteboard-snapshot', this.handleWhiteboardSnapshot.bind(this));
+        ws.on('whiteboard-cursors', this.handleWhiteboardCursors.bind(this));
         ws.on('user-left', this.handleUserLeft.bind(this));
     }
 
@@ -551,6 +552,19 @@ export class WhiteboardManager {
         this.clear();
     }
 
+    private async handleWhiteboardSnapshot(msg: any): Promise<void> {
+        // late joiners get the server's live canvas instead of waiting for peers to redraw
+        state.setWhiteboardData(msg.objects || []);
+        if (msg.sender && msg.sender !== state.userId) {
+            this.handleWhiteboardStart(msg);
+        }
+
+        // without a canvas yet, init() restores the snapshot once the whiteboard is shown
+        if (!this.canvas) return;
+        this.clear();
+        await this.restoreState();
+    }
+
     private async handleWhiteboardUpdate(msg: any): Promise<void> {
         if (!this.canvas || msg.sender === state.userId) return;
 
@@ -600,12 +614,15 @@ export class WhiteboardManager {
         this.canvas.renderAll();
     }
 
-    private handleWhiteboardCursor(msg: any): void {
-        if (msg.sender === state.userId) return;
+    private handleWhiteboardCursors(msg: any): void {
+        // the server batches every cursor that moved since its last tick, ours included
+        for (const cursor of msg.cursors || []) {
+            if (cursor.sender === state.userId) continue;
 
-        const { x, y } = msg.data;
-        const username = msg.username || 'Unknown';
-        this.updateRemoteCursor(msg.sender, x, y, username);
+            const { x, y } = cursor.data;
+            const username = cursor.username || 'Unknown';
+            this.updateRemoteCursor(cursor.sender, x, y, username);
+        }
     }
 
     private handleUserLeft(msg: any): void {
@@ -1,5 +1,11 @@
 import { defineConfig } from 'vite';
 import { resolve } from 'path';
+import { writeFileSync } from 'fs';
+import { brotliCompressSync, gzipSync, constants } from 'zlib';
+
+// the backend serves these variants as they are, so it never compresses on the request path
+const PRECOMPRESS = /\.(js|css|html|json|svg|txt|map)$/;
+const PRECOMPRESS_MIN_SIZE = 1024;
 
 export default defineConfig({
   base: './',
@@ -16,6 +22,23 @@ export default defineConfig({
     }
   },
   plugins: [
+    {
+      name: "precompress",
+      apply: "build",
+      writeBundle(options, bundle) {
+        for (const [fileName, output] of Object.entries(bundle)) {
+          if (!PRECOMPRESS.test(fileName)) continue;
+          const source = output.type === "chunk" ? output.code : output.source;
+          const body = Buffer.from(source);
+          if (body.length < PRECOMPRESS_MIN_SIZE) continue;
+          const path = resolve(options.dir!, fileName);
+          writeFileSync(`${path}.br`, brotliCompressSync(body, {
+            params: { [constants.BROTLI_PARAM_QUALITY]: constants.BROTLI_MAX_QUALITY }
+          }));
+          writeFileSync(`${path}.gz`, gzipSync(body, { level: 9 }));
+        }
+      }
+    },
     {
       name: "beacon-file-runtime-html",
       enforce: "post",